@@ -1,11 +1,21 @@
 from google.adk.agents import LlmAgent
 
-def create_auditor_agent(model_name: str = "gemini-3-flash-preview") -> LlmAgent:
+LOCAL_EVIDENCE_INSTRUCTION = """
+LOCAL RETRIEVAL MODE:
+There is no Librarian in this pipeline. The "RETRIEVED PASSAGES" section of the request replaces its output:
+each passage is labelled [Context] or [Target] and comes with its REAL Filename and Page/Section.
+Use ONLY these passages as evidence and as sources (copy Filename and Page/Section exactly).
+If the passages do not answer the question, say so and apply the NO evidence format below.
+"""
+
+def create_auditor_agent(model_name: str = "gemini-3-flash-preview", local_evidence: bool = False, before_model_callback=None) -> LlmAgent:
     """
     Creates the Auditor agent.
     
     Role: The Compliance Specialist.
     Task: Evaluates compliance based on the information provided.
+    With `local_evidence`, the evidence comes from locally retrieved passages instead of the Librarian.
+    `before_model_callback` is run before every model call (e.g. to attach a context cache).
     """
     return LlmAgent(
         name="Auditor",
@@ -67,5 +77,6 @@ If NO evidence is found, respond:
 - Spiegazione: Il documento non contiene informazioni relative a questa domanda.
 
 Trust nothing without proof. Be precise and professional.
-"""
+""" + (LOCAL_EVIDENCE_INSTRUCTION if local_evidence else ""),
+        before_model_callback=before_model_callback,
     )
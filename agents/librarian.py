@@ -1,11 +1,20 @@
 from google.adk.agents import LlmAgent
 
-def create_librarian_agent(model_name: str = "gemini-3-flash-preview") -> LlmAgent:
+PREFEED_INSTRUCTION = """
+PRE-RETRIEVED PASSAGES:
+The request may contain a "RETRIEVED PASSAGES" section, produced by a local search index over the documents.
+Each passage comes with its REAL Filename and Page/Section: start from these passages, quote them, and copy
+their Filename and Page/Section exactly when citing them. Search the documents further only if they are not sufficient.
+"""
+
+def create_librarian_agent(model_name: str = "gemini-3-flash-preview", prefeed: bool = False, before_model_callback=None) -> LlmAgent:
     """
     Creates the Librarian agent.
     
     Role: The Archivist.
     Task: Has access to the PDF files. Finds relevant paragraphs ("Grounding").
+    With `prefeed`, it starts from the passages of the local retrieval index included in the request.
+    `before_model_callback` is run before every model call (e.g. to attach a context cache).
     """
     return LlmAgent(
         name="Librarian",
@@ -46,6 +55,7 @@ IMPORTANT:
 - È ASSOLUTAMENTE VIETATO inventare nomi di file, pagine o sezioni. Riporta ciò che è reale e disponibile.
 
 Do NOT interpret or evaluate compliance - just report what the documents say with actual text.
-"""
+""" + (PREFEED_INSTRUCTION if prefeed else ""),
+        before_model_callback=before_model_callback,
     )
 
@@ -10,21 +10,40 @@ class ComplianceOrchestrator(SequentialAgent):
     """
     pass
 
-def create_orchestrator_agent(model_name: str = "gemini-3-flash-preview") -> SequentialAgent:
+LIBRARIAN_MODES = ("llm", "prefeed", "replace")
+
+def create_orchestrator_agent(model_name: str = "gemini-3-flash-preview", librarian_mode: str = "llm",
+                              before_model_callback=None) -> SequentialAgent:
     """
     Creates the Orchestrator agent (as a Sequential Pipeline for V1).
     
     Structure:
     1. Librarian: Finds info.
     2. Auditor: Evaluates info.
+
+    `librarian_mode` controls how evidence is retrieved:
+    - "llm": the Librarian searches the documents (default).
+    - "prefeed": the Librarian starts from the top-k passages of the local index, sent with the request.
+    - "replace": no Librarian; the Auditor works directly on the locally retrieved passages
+      (one LLM call less per row).
+    `before_model_callback` (a callback or a list of callbacks) is passed to every LLM sub-agent.
     """
-    librarian = create_librarian_agent()
-    auditor = create_auditor_agent()
+    if librarian_mode not in LIBRARIAN_MODES:
+        raise ValueError(f"Unsupported librarian mode: {librarian_mode}")
+
+    auditor = create_auditor_agent(local_evidence=(librarian_mode == "replace"),
+                                   before_model_callback=before_model_callback)
+    if librarian_mode == "replace":
+        sub_agents = [auditor]
+    else:
+        librarian = create_librarian_agent(prefeed=(librarian_mode == "prefeed"),
+                                           before_model_callback=before_model_callback)
+        sub_agents = [librarian, auditor]
     
     # We wrap them in a SequentialAgent to enforce the flow
     # Librarian finds info -> Context is passed to Auditor -> Auditor answers
     return ComplianceOrchestrator(
         name="ComplianceOrchestrator",
-        sub_agents=[librarian, auditor],
+        sub_agents=sub_agents,
         description="Coordinates the retrieval and evaluation process."
     )
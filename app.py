@@ -1,11 +1,17 @@
 import streamlit as st
 import pandas as pd
 import os
+import subprocess
+import sys
 import time
 import streamlit_antd_components as sac
 from services.compliance_service import ComplianceService
+from utils.job_queue import CANCELLED, DEFAULT_QUEUE_PATH, DONE, FAILED, JobQueue
 from utils.logger import logger
 
+# Seconds between two heartbeats of a running batch: how long a Stop click can wait to be noticed
+BATCH_HEARTBEAT_SECONDS = 1.0
+
 # Page Config
 st.set_page_config(layout="wide", page_title="ADK Compliance Agent")
 
@@ -17,6 +23,50 @@ def load_css(file_name):
 # Load custom CSS
 load_css("assets/style.css")
 
+def process_uploaded_files(uploaded_files, kind):
+    """
+    Uploads Streamlit files as context/target documents in parallel, straight from memory,
+    showing per-file progress. Files this browser session already loaded (same upload id
+    and size) that are still loaded are skipped without being read again.
+    Returns the number of files processed successfully.
+    """
+    # (kind, upload id, size) -> content hash of the uploads already loaded
+    processed = st.session_state.setdefault("processed_uploads", {})
+    new_files = [f for f in uploaded_files
+                 if not service.document_registry.has(processed.get((kind, f.file_id, f.size), ""), kind)]
+    loaded = len(uploaded_files) - len(new_files)
+    if not new_files:
+        return loaded
+    progress_bar = st.progress(0)
+    for result in service.load_documents(new_files, kind=kind):
+        progress_bar.progress(result["completed"] / result["total"])
+        if result["status"] == "success":
+            uploaded = new_files[result["index"]]
+            processed[(kind, uploaded.file_id, uploaded.size)] = result["content_hash"]
+            loaded += 1
+        else:
+            st.error(f"❌ {result['filename']}: {result['error']}")
+    progress_bar.empty()
+    return loaded
+
+@st.cache_resource
+def get_job_queue():
+    """Background job queue shared by every browser session of this server."""
+    return JobQueue(os.environ.get("JOB_QUEUE_PATH", DEFAULT_QUEUE_PATH))
+
+@st.cache_resource
+def job_workers():
+    """Holder of the worker processes started by this server (see ensure_job_workers)."""
+    return {"process": None}
+
+def ensure_job_workers():
+    """Starts JOB_WORKERS worker processes (services/job_worker.py) unless they are already running."""
+    workers = job_workers()
+    count = int(os.environ.get("JOB_WORKERS", 2))
+    if count > 0 and (workers["process"] is None or workers["process"].poll() is not None):
+        workers["process"] = subprocess.Popen([sys.executable, "-m", "services.job_worker", "--workers", str(count),
+                                               "--queue", get_job_queue().path])
+
 # Initialize Service in Session State
 if "service" not in st.session_state:
     auth_mode = os.environ.get("AUTH_MODE", "ADC") # Read AUTH_MODE, default to ADC
@@ -33,6 +83,42 @@ service = st.session_state.service
 if "selected_row" not in st.session_state:
     st.session_state.selected_row = 0
 
+@st.fragment(run_every=2)
+def show_background_jobs():
+    """Polls the background jobs of this session and applies their new results to the checklist."""
+    queue = get_job_queue()
+    st.markdown("##### 🧵 Background Jobs")
+    finished_now = False
+    for job_id, last_seq in list(st.session_state.jobs.items()):
+        job = queue.get(job_id)
+        if job is None:
+            del st.session_state.jobs[job_id]
+            continue
+        for seq, result in queue.results(job_id, after_seq=last_seq):
+            service.apply_batch_result(result)
+            st.session_state.jobs[job_id] = seq
+        with st.container(border=True):
+            col_info, col_action = st.columns([4, 1])
+            done = job["completed"] + job["errors"]
+            col_info.write(f"**{job_id}** — {job['status']} ({done}/{job['total']} rows, {job['errors']} errors)")
+            col_info.progress(min(done / job["total"], 1.0) if job["total"] else 0.0)
+            if job["error"]:
+                col_info.error(job["error"])
+            if job["status"] in (DONE, FAILED, CANCELLED):
+                if col_action.button("✖️ Dismiss", key=f"dismiss_{job_id}"):
+                    del st.session_state.jobs[job_id]
+                    st.rerun()
+                finished_jobs = st.session_state.setdefault("finished_jobs", set())
+                if job_id not in finished_jobs:
+                    finished_jobs.add(job_id)
+                    finished_now = True
+            elif col_action.button("⏹️ Cancel", key=f"cancel_{job_id}"):
+                queue.cancel(job_id)
+    if finished_now:
+        # Refresh the whole page (dashboard, stats) with the final results
+        st.session_state.checklist_df = service.get_dataframe()
+        st.rerun()
+
 def mostra_interfaccia_principal():
     """
     Renders the main application interface using a tabbed layout and Mantine components.
@@ -64,13 +150,8 @@ def mostra_interfaccia_principal():
             if uploaded_context_files:
                 if st.button("📤 Process Rules", width="stretch", key="process_context"):
                     with st.spinner(f"Processing {len(uploaded_context_files)} file(s)..."):
-                        for uploaded_file in uploaded_context_files:
-                            temp_path = f"temp_{uploaded_file.name}"
-                            with open(temp_path, "wb") as f:
-                                f.write(uploaded_file.getbuffer())
-                            service.load_context_document(temp_path)
-                            os.remove(temp_path)
-                        st.toast(f'✅ Rules Loaded: {len(uploaded_context_files)} files processed.')
+                        loaded = process_uploaded_files(uploaded_context_files, "context")
+                        st.toast(f'✅ Rules Loaded: {loaded} files processed.')
 
             if service.context_doc_info:
                 st.caption(f"**Active:** {len(service.context_doc_info)} files")
@@ -88,13 +169,8 @@ def mostra_interfaccia_principal():
             if uploaded_target_files:
                 if st.button("📤 Process Content", width="stretch", key="process_target"):
                     with st.spinner(f"Processing {len(uploaded_target_files)} file(s)..."):
-                        for uploaded_file in uploaded_target_files:
-                            temp_path = f"temp_{uploaded_file.name}"
-                            with open(temp_path, "wb") as f:
-                                f.write(uploaded_file.getbuffer())
-                            service.load_target_document(temp_path)
-                            os.remove(temp_path)
-                        st.toast(f'✅ Content Loaded: {len(uploaded_target_files)} files processed.')
+                        loaded = process_uploaded_files(uploaded_target_files, "target")
+                        st.toast(f'✅ Content Loaded: {loaded} files processed.')
 
             if service.target_doc_info:
                 st.caption(f"**Active:** {len(service.target_doc_info)} files")
@@ -109,9 +185,13 @@ def mostra_interfaccia_principal():
                 "Upload Excel/CSV with questions",
                 type=["xlsx", "xls", "csv"], key="checklist_uploader"
             )
+            cluster_duplicates = st.toggle(
+                "🔗 Merge near-duplicate questions", value=False, key="checklist_cluster_duplicates",
+                help="Analyze one question per group of near-identical questions and copy its result to the others (marked in Derived_From)."
+            )
             if uploaded_excel:
                 if st.button("📊 Load Checklist", width="stretch"):
-                    df = service.load_checklist(uploaded_excel)
+                    df = service.load_checklist(uploaded_excel, cluster_duplicates=cluster_duplicates)
                     st.session_state.checklist_df = df
                     if service.question_column:
                         st.toast(f'✅ Checklist Loaded: {len(df)} items found.')
@@ -314,12 +394,30 @@ def mostra_interfaccia_principal():
             
             # Concurrency Slider
             concurrency = st.slider(
-                "⚡ Parallel Threads (Concurrency)",
+                "⚡ Parallel Rows (Concurrency)",
                 min_value=1,
-                max_value=10,
+                max_value=50,
                 value=3,
                 help="Number of agents running in parallel. Higher values are faster but may hit API limits."
             )
+            adaptive_concurrency = st.toggle(
+                "📈 Adaptive concurrency",
+                value=False,
+                help="Start from the value above, then raise it while the API keeps up and halve it on quota (429) errors."
+            )
+            pack_size = st.slider(
+                "📦 Questions per Request",
+                min_value=1,
+                max_value=10,
+                value=1,
+                help="Related questions (same category) answered by a single request. Fewer calls and document reads; rows without a usable answer are re-run one by one."
+            )
+
+            run_in_background = st.toggle(
+                "🧵 Run in background",
+                value=False,
+                help="Submit the batch to a worker process: this page stays responsive and several batches can run at once. Results appear below as they complete."
+            )
 
             rows_to_process = []
 
@@ -352,34 +450,83 @@ def mostra_interfaccia_principal():
                     except:
                         st.error("Invalid format. Use comma-separated numbers (e.g., 1, 3, 6).")
 
-            if st.button("▶️ Start Batch", disabled=not rows_to_process, type='primary', use_container_width=True):
-                # Use a unique key for the status container to avoid issues with reruns
-                status_key = f"batch_status_{time.time()}" 
-                with st.status(f"🚀 Starting parallel batch analysis ({len(rows_to_process)} items, {concurrency} threads)...", expanded=True) as status:
+            def run_batch(results, total_to_process, label):
+                with st.status(label, expanded=True) as status:
+                    # Clicking Stop reruns the script, which Streamlit interrupts at its next call: the
+                    # batch yields a heartbeat every second so that call comes even while rows are in
+                    # flight. The loop is closed, rows in flight are abandoned and stay PENDING
+                    # (cancel_batch covers any batch still running)
+                    st.button("⏹️ Stop", key="stop_batch", on_click=service.cancel_batch)
                     progress_bar = st.progress(0)
                     processed_count = 0
-                    total_to_process = len(rows_to_process)
+                    stopped = None
                     
                     # Run the batch and iterate over yielded results
-                    for result in service.batch_analyze(row_indices=rows_to_process, concurrency=concurrency):
-                        if result["status"] == "success":
-                            processed_count += 1
-                            progress_bar.progress(processed_count / total_to_process)
-                            status.write(f"✅ Processed row {result['index'] + 1} (ID: {df.at[result['index'], service.id_column] if service.id_column else result['index']})")
-                        elif result["status"] == "error":
-                            processed_count += 1 # Count errors as processed for progress bar
-                            progress_bar.progress(processed_count / total_to_process)
-                            status.write(f"❌ Error processing row {result['index'] + 1}: {result['error']}")
-                            logger.error(f"Batch item error: {result['error']}")
-                        elif result["status"] == "info":
-                            status.write(f"ℹ️ {result['message']}")
-                        
-                    status.update(label=f"✅ Batch Complete! Processed {processed_count} items", state="complete")
+                    try:
+                        for result in results:
+                            if result.get("status") == "heartbeat":
+                                progress_bar.progress(min(processed_count / total_to_process, 1.0))
+                            elif result.get("error") and "status" not in result:
+                                status.write(f"❌ {result['error']}")
+                            elif result["status"] == "success":
+                                processed_count += 1
+                                progress_bar.progress(min(processed_count / total_to_process, 1.0))
+                                origin = " (from journal)" if result.get("resumed") else ""
+                                status.write(f"✅ Processed row {result['index'] + 1} (ID: {df.at[result['index'], service.id_column] if service.id_column else result['index']}){origin}")
+                                if adaptive_concurrency and "concurrency" in result:
+                                    status.update(label=f"🚀 Batch analysis running ({processed_count}/{total_to_process}, {result['concurrency']} concurrent rows)...")
+                            elif result["status"] == "error":
+                                processed_count += 1 # Count errors as processed for progress bar
+                                progress_bar.progress(min(processed_count / total_to_process, 1.0))
+                                status.write(f"❌ Error processing row {result['index'] + 1}: {result['error']}")
+                                logger.error(f"Batch item error: {result['error']}")
+                            elif result["status"] == "info":
+                                status.write(f"ℹ️ {result['message']}")
+                            elif result["status"] == "cancelled":
+                                stopped = result
+                    finally:
+                        results.close()
+
+                    if stopped:
+                        status.update(label=f"⏹️ Batch stopped ({stopped['message']}): {processed_count} items processed, {stopped['pending']} left pending", state="error")
+                        st.toast(f"⏹️ Batch stopped: {stopped['pending']} rows left pending")
+                    else:
+                        status.update(label=f"✅ Batch Complete! Processed {processed_count} items", state="complete")
                         
                     # After batch completion, refresh the dataframe and rerun
                     st.session_state.checklist_df = service.get_dataframe()
                     st.rerun() # Rerun to update dashboard
 
+            # Runs interrupted by a restart or a page reload: completed rows are journaled
+            resumable_runs = service.resumable_runs()
+            if resumable_runs:
+                with st.expander(f"⏯️ Interrupted runs ({len(resumable_runs)})"):
+                    run = st.selectbox(
+                        "Run to resume:",
+                        resumable_runs,
+                        format_func=lambda r: f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(r['started_at']))} — {r['completed']}/{r['rows']} rows done",
+                    )
+                    if st.button("⏯️ Resume Run", use_container_width=True):
+                        run_batch(service.resume_batch(run["run_id"], heartbeat_seconds=BATCH_HEARTBEAT_SECONDS,
+                                                       concurrency=concurrency, adaptive=adaptive_concurrency),
+                                  run["rows"], f"⏯️ Resuming batch analysis ({run['rows'] - run['completed']} rows left)...")
+
+            if st.button("▶️ Start Batch", disabled=not rows_to_process, type='primary', use_container_width=True):
+                if run_in_background:
+                    ensure_job_workers()
+                    params = {"row_indices": rows_to_process, "concurrency": concurrency,
+                              "adaptive": adaptive_concurrency, "pack_size": pack_size}
+                    job_id = get_job_queue().submit(params, service.export_state(), total=len(rows_to_process))
+                    st.session_state.setdefault("jobs", {})[job_id] = 0  # Last result applied
+                    st.toast(f"🧵 Batch submitted as {job_id}")
+                else:
+                    run_batch(service.batch_analyze(row_indices=rows_to_process, concurrency=concurrency, adaptive=adaptive_concurrency,
+                                                    pack_size=pack_size, heartbeat_seconds=BATCH_HEARTBEAT_SECONDS),
+                              len(rows_to_process), f"🚀 Starting parallel batch analysis ({len(rows_to_process)} items, {concurrency} concurrent rows)...")
+
+        if st.session_state.get("jobs"):
+            show_background_jobs()
+
         # The alert below will be shown only if st.rerun() is not called from inside the batch processing loop
         # and batch_analysis_complete is set. Since we are calling rerun inside, this may not be strictly necessary,
         # but good to keep as a fallback or for clarity if behavior changes.
@@ -440,8 +587,12 @@ def mostra_wizard():
         st.title("Step 1: Upload Checklist 📋")
         st.info("Upload the Excel (.xlsx, .xls) or .csv file containing the control points.")
         uploaded_excel = st.file_uploader("Upload file", type=["xlsx", "xls", "csv"], key="wizard_checklist_uploader", label_visibility="collapsed")
+        cluster_duplicates = st.toggle(
+            "🔗 Merge near-duplicate questions", value=False, key="wizard_cluster_duplicates",
+            help="Analyze one question per group of near-identical questions and copy its result to the others (marked in Derived_From)."
+        )
         if uploaded_excel:
-            df = service.load_checklist(uploaded_excel)
+            df = service.load_checklist(uploaded_excel, cluster_duplicates=cluster_duplicates)
             st.session_state.checklist_df = df
             if service.question_column:
                 st.success(f"✅ Checklist '{uploaded_excel.name}' uploaded successfully! It contains {len(df)} rows.")
@@ -459,11 +610,7 @@ def mostra_wizard():
         uploaded_context_files = st.file_uploader("Drag files here", type=["pdf", "docx", "txt"], accept_multiple_files=True, key="wizard_context_uploader", label_visibility="collapsed")
         if uploaded_context_files:
             with st.spinner(f"Processing {len(uploaded_context_files)} context files..."):
-                for uploaded_file in uploaded_context_files:
-                    temp_path = f"temp_{uploaded_file.name}"
-                    with open(temp_path, "wb") as f: f.write(uploaded_file.getbuffer())
-                    service.load_context_document(temp_path)
-                    os.remove(temp_path)
+                process_uploaded_files(uploaded_context_files, "context")
                 st.success(f"✅ {len(service.context_doc_info)} context files uploaded and processed.")
         if service.context_doc_info:
             st.write("Uploaded context files:")
@@ -484,11 +631,7 @@ def mostra_wizard():
         uploaded_target_files = st.file_uploader("Drag files here", type=["pdf", "docx", "txt"], accept_multiple_files=True, key="wizard_target_uploader", label_visibility="collapsed")
         if uploaded_target_files:
             with st.spinner(f"Processing {len(uploaded_target_files)} target files..."):
-                for uploaded_file in uploaded_target_files:
-                    temp_path = f"temp_{uploaded_file.name}"
-                    with open(temp_path, "wb") as f: f.write(uploaded_file.getbuffer())
-                    service.load_target_document(temp_path)
-                    os.remove(temp_path)
+                process_uploaded_files(uploaded_target_files, "target")
                 st.success(f"✅ {len(service.target_doc_info)} target files uploaded and processed.")
         if service.target_doc_info:
             st.write("Uploaded target files:")
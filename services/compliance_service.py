@@ -1,27 +1,61 @@
 import asyncio
+import contextvars
+import hashlib
+import io
+import json
 import os
+import re
 import time
+import uuid
 import pandas as pd
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 from dotenv import load_dotenv
 from google.genai import Client
-from google.adk.runners import InMemoryRunner
+from google.adk.artifacts import InMemoryArtifactService
+from google.adk.memory import InMemoryMemoryService
+from google.adk.runners import InMemoryRunner, Runner
 from google.adk.sessions import InMemorySessionService
 from google.genai import types
 
 from agents.orchestrator import create_orchestrator_agent
-from utils.document_loader import DocumentLoaderFactory
+from utils.cancellation import CancellationToken, DeadlineExceeded
+from utils.concurrency import AIMDController
+from utils.context_cache import DEFAULT_TTL_SECONDS, DocumentContextCache, is_missing_cache_error
+from utils.document_loader import DocumentLoaderFactory, DocumentSource
+from utils.document_registry import DocumentRegistry
+from utils.document_router import DocumentRouter
+from utils.passage_store import PassageStore
+from utils.file_lifecycle import FileLifecycleManager
+from utils.rate_limiter import CHARS_PER_TOKEN, estimate_request_tokens, get_shared_limiter
+from utils.result_cache import DEFAULT_MAX_AGE_DAYS, ResultCache, result_key
+from utils.retrieval import LexicalIndex
+from utils.question_clusters import DEFAULT_SIMILARITY_THRESHOLD, cluster_questions
+from utils.retry import CircuitBreaker, RetryPolicy, call_with_retry
+from utils.run_journal import RunJournal, new_run_id
+from utils.session_manager import SessionManager, SessionUsage
+from utils.session_store import SQLiteSessionService, create_session_service
+from utils.uri_cache import EXPIRY_MARGIN_SECONDS, get_uri_cache
 from utils.logger import logger
 
 # Load environment variables
 load_dotenv()
 
+# Header line of each answer in a packed (multi-question) response: "### ITEM <row index>"
+PACKED_ITEM_PATTERN = re.compile(r'^[#*\s]*ITEM\s+(\d+)\b.*$', re.MULTILINE)
+
+# Version of the row prompt templates (_row_message, _packed_message): bump it when they
+# change, so results cached with the previous prompts are not reused
+PROMPT_TEMPLATE_VERSION = 1
+
+# Set while a request is retried after its context cache disappeared: sent without the cache
+_SKIP_CONTEXT_CACHE = contextvars.ContextVar("skip_context_cache", default=False)
+
 class ComplianceService:
     """
     Facade for the Compliance Agent system.
     Handles session management, file loading, and agent execution.
     """
-    def __init__(self, auth_mode: str = "API_KEY"):
+    def __init__(self, auth_mode: str = "API_KEY", librarian_mode: str = None):
         logger.info(f"Initializing ComplianceService with Auth Mode: {auth_mode}")
         if auth_mode == "API_KEY":
             api_key = os.environ.get("GOOGLE_API_KEY")
@@ -33,56 +67,410 @@ class ComplianceService:
             self.client = Client() # ADC will handle authentication
         else:
             raise ValueError(f"Unsupported authentication mode: {auth_mode}")
-        self.document_loader_factory = DocumentLoaderFactory(self.client)
+        # Uploads are tracked from upload to deletion: expired files are re-uploaded before
+        # a batch starts, and superseded/unused files are garbage-collected on a schedule
+        uri_cache = get_uri_cache()  # One instance per process, shared by every service
+        self.file_lifecycle = FileLifecycleManager(self.client, uri_cache, in_use=self._documents_in_use)
+        self.file_lifecycle.start_gc_schedule()
+        # (started_at, future, documents) of the last background validation (future None once applied)
+        self._validation = None
+        self.document_loader_factory = DocumentLoaderFactory(self.client, uri_cache, self.file_lifecycle)
+
+        # Local lexical retrieval: "llm" (Librarian searches), "prefeed" or "replace" (see create_orchestrator_agent)
+        self.librarian_mode = librarian_mode or os.environ.get("LIBRARIAN_MODE", "llm")
+        self.retrieval_top_k = int(os.environ.get("RETRIEVAL_TOP_K", 4))
+        self.retrieval_index = LexicalIndex()
+
+        # Per-row document routing: only the ROUTER_TOP_K most relevant context/target documents
+        # are listed in each row's prompt (0 disables routing: every row gets every document)
+        self.router_top_k = int(os.environ.get("ROUTER_TOP_K", 0))
+        self.router_flat_threshold = float(os.environ.get("ROUTER_FLAT_THRESHOLD", 0.2))
+        self._router = None
+        self._router_version = None
+        self._row_documents = {}
+        self._row_documents_version = None
+        # Documents listed in the last request of each row/pack session: its context cache
+        # and TPM charge cover only them (session id -> documents)
+        self._session_documents: Dict[str, list] = {}
+        self.concurrency_controller = None  # Limit of the last batch (current value and history)
+
+        # Batch rows retry rate-limit and transient errors with backoff; a circuit breaker
+        # pauses the whole batch while the backend is down instead of failing every row
+        self.retry_policy = RetryPolicy(
+            max_attempts=int(os.environ.get("RETRY_MAX_ATTEMPTS", 4)),
+            base_delay=float(os.environ.get("RETRY_BASE_DELAY", 1.0)),
+        )
+        self.circuit_failure_threshold = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.circuit_reset_seconds = float(os.environ.get("CIRCUIT_RESET_SECONDS", 30))
+        self.circuit_give_up_seconds = float(os.environ.get("CIRCUIT_GIVE_UP_SECONDS", 600))
+        self.circuit_breaker = None  # Breaker of the last batch
+
+        # Deadlines: a row (or packed request) is abandoned ROW_TIMEOUT_SECONDS after it starts,
+        # a batch is stopped after BATCH_TIMEOUT_SECONDS (0 = no deadline); see `cancel_batch`
+        self.row_timeout = float(os.environ.get("ROW_TIMEOUT_SECONDS", 600))
+        self.batch_timeout = float(os.environ.get("BATCH_TIMEOUT_SECONDS", 0))
+        self.cancel_token = None  # Token of the running batch
+
+        # Explicit context caching of the documents and agent instructions, shared by every model
+        # call on the same documents until the document set changes; with routing, one cache per
+        # routed document set (CONTEXT_CACHE_TTL_SECONDS=0 disables it)
+        cache_ttl = int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+        self.context_cache = DocumentContextCache(self.client, cache_ttl) if cache_ttl > 0 else None
+        
+        # Process-wide requests/tokens per minute budgets (GEMINI_RPM / GEMINI_TPM, 0 = unlimited),
+        # acquired before every model call of every agent, row, chat and Streamlit session
+        self.rate_limiter = get_shared_limiter(int(os.environ.get("GEMINI_RPM", 0)), int(os.environ.get("GEMINI_TPM", 0)))
         
         # ADK Setup
-        logger.info("Setting up ADK agents")
-        self.agent = create_orchestrator_agent()
-        self.runner = InMemoryRunner(self.agent, app_name="agents")
+        logger.info("Setting up ADK agents", f"Librarian mode: {self.librarian_mode}")
+        self.agent = create_orchestrator_agent(librarian_mode=self.librarian_mode,
+                                               before_model_callback=[self._attach_context_cache, self._acquire_model_capacity])
+        # Sessions live in memory (SESSION_BACKEND=memory) or in SQLite (SESSION_BACKEND=sqlite,
+        # SESSION_DB_PATH), where they survive restarts and stay out of the process heap
+        self.session_backend = os.environ.get("SESSION_BACKEND", "memory")
+        if self.session_backend == "memory":
+            self.runner = InMemoryRunner(self.agent, app_name="agents")
+        else:
+            db_path = os.environ.get("SESSION_DB_PATH", os.path.join(uri_cache.cache_dir, "sessions.sqlite"))
+            session_service = create_session_service(self.session_backend, db_path)
+            # Sessions of instances that are gone are never opened again: purge the stale ones
+            max_age_days = float(os.environ.get("SESSION_MAX_AGE_DAYS", 30))
+            if max_age_days > 0 and isinstance(session_service, SQLiteSessionService):
+                purged = session_service.purge(max_age_days * 86400)
+                if purged:
+                    logger.info("Stale sessions purged", f"{purged} not updated in {max_age_days:g} days")
+            self.runner = Runner(app_name="agents", agent=self.agent,
+                                 session_service=session_service,
+                                 artifact_service=InMemoryArtifactService(),
+                                 memory_service=InMemoryMemoryService())
         self.session_service = self.runner.session_service
+        # Sessions stay within a memory budget (LRU eviction of idle sessions); row analyses
+        # start from an empty session, chats are compacted when their history grows
+        self.session_manager = SessionManager(self.session_service, app_name="agents")
+        # The session store (SESSION_DB_PATH) may be shared with other services and workers:
+        # this instance's sessions live under their own user id, so resetting or evicting
+        # them never touches another instance's sessions. SESSION_NAMESPACE makes that id
+        # stable, so a restarted instance finds its chats again; otherwise it is random.
+        namespace = os.environ.get("SESSION_NAMESPACE", "").strip()
+        self.session_user_id = f"user_{namespace}" if namespace else f"user_{uuid.uuid4().hex[:12]}"
+
+        # Persistent memo of row analyses, keyed by question, document set, model and prompts:
+        # reruns on the same documents skip the agents (RESULT_CACHE_MAX_AGE_DAYS=0 disables it)
+        max_age_days = float(os.environ.get("RESULT_CACHE_MAX_AGE_DAYS", DEFAULT_MAX_AGE_DAYS))
+        self.result_cache = ResultCache(os.path.join(uri_cache.cache_dir, "results.sqlite"), max_age_days * 86400) if max_age_days > 0 else None
+        # Indexed passages shared with worker processes: state snapshots reference them by content hash
+        self.passage_store = PassageStore(os.path.join(uri_cache.cache_dir, "passages.sqlite"))
+        sub_agents = list(self.agent.sub_agents)
+        self.model_name = ",".join(sorted({str(getattr(agent, "model", "")) for agent in sub_agents}))
+        instructions = "\n".join(f"{getattr(agent, 'name', '')}: {getattr(agent, 'instruction', '')}" for agent in sub_agents)
+        settings = f"{PROMPT_TEMPLATE_VERSION}|{self.librarian_mode}|{self.retrieval_top_k}|{self.router_top_k}|{self.router_flat_threshold}"
+        self.prompt_version = hashlib.sha256(f"{settings}\n{instructions}".encode("utf-8")).hexdigest()[:16]
+
+        # Every completed batch row is journaled to RUN_JOURNAL_DIR (empty disables it), so an
+        # interrupted run can be resumed with `resume_batch` instead of starting over
+        journal_dir = os.environ.get("RUN_JOURNAL_DIR", os.path.join(uri_cache.cache_dir, "runs"))
+        self.run_journal = RunJournal(journal_dir) if journal_dir else None
+        self.current_run_id = None  # Journal of the last batch started or resumed
         
         # State
         self.checklist_df = None
-        self.context_doc_info = []  # Regulations, policies (the rules)
-        self.target_doc_info = []   # Documents to analyze (content to verify)
+        self.checklist_id = None  # Fingerprint of the checklist questions: chats are per checklist
+        self.category_column = None  # Detected grouping column (rows packed together share its value)
+        # Loaded documents, deduplicated by content hash. Exposed per role through
+        # context_doc_info (regulations, policies: the rules) and target_doc_info
+        # (documents to analyze: content to verify).
+        self.document_registry = DocumentRegistry()
+        # Documents each analyzed row depends on: row index -> {content_hash: filename},
+        # taken from the Fonte Context / Fonte Target citations of its justification
+        self.row_citations: Dict[int, Dict[str, str]] = {}
+        # Near-duplicate questions (load_checklist with cluster_duplicates): row index -> index
+        # of the first row of its cluster, whose analysis the row reuses in batches
+        self.duplicate_of: Dict[int, int] = {}
         self.current_session_id = None
         
         logger.success("ComplianceService initialized successfully")
 
-    def load_context_document(self, file_path: str) -> str:
+    def load_context_document(self, source: DocumentSource, filename: str = None) -> str:
         """
         Uploads a CONTEXT document (regulation/policy) and returns URI.
         These are the documents that define the rules.
+        `source` is a file path, bytes or a binary file-like object (e.g. a Streamlit UploadedFile);
+        `filename` is required for raw bytes.
         """
-        filename = os.path.basename(file_path)
-        logger.info(f"Loading CONTEXT document: {filename}")
-        try:
-            loader = self.document_loader_factory.get_loader(file_path)
-            doc_uri = loader.load_document(file_path)
-            self.context_doc_info.append({"filename": filename, "uri": doc_uri})
-            logger.success(f"Context document uploaded", f"File: {filename}, URI: {doc_uri} (Total context: {len(self.context_doc_info)})")
-            return doc_uri
-        except Exception as e:
-            logger.error(f"Failed to upload context document", str(e))
-            raise
+        return self._load_document(source, "context", filename)
     
-    def load_target_document(self, file_path: str) -> str:
+    def load_target_document(self, source: DocumentSource, filename: str = None) -> str:
         """
         Uploads a TARGET document (document to analyze) and returns URI.
         These are the documents to verify against the rules.
+        `source` is a file path, bytes or a binary file-like object (e.g. a Streamlit UploadedFile);
+        `filename` is required for raw bytes.
+        """
+        return self._load_document(source, "target", filename)
+
+    @property
+    def context_doc_info(self) -> List[Dict[str, str]]:
+        """Context documents (filename, uri, content_hash) in load order."""
+        return self.document_registry.documents("context")
+
+    @context_doc_info.setter
+    def context_doc_info(self, docs: List[Dict[str, str]]):
+        self.document_registry.replace_role("context", docs)
+
+    @property
+    def target_doc_info(self) -> List[Dict[str, str]]:
+        """Target documents (filename, uri, content_hash) in load order."""
+        return self.document_registry.documents("target")
+
+    @target_doc_info.setter
+    def target_doc_info(self, docs: List[Dict[str, str]]):
+        self.document_registry.replace_role("target", docs)
+
+    def _source_filename(self, source: DocumentSource, filename: str = None) -> str:
+        """Filename of a document source: explicit name, path basename or the object's `name`."""
+        if filename:
+            return os.path.basename(filename)
+        if isinstance(source, (str, os.PathLike)):
+            return os.path.basename(source)
+        name = getattr(source, "name", None)
+        if not name:
+            raise ValueError("A filename is required to load a document from memory")
+        return os.path.basename(name)
+
+    def _upload_document(self, source: DocumentSource, filename: str = None) -> Dict[str, str]:
+        """
+        Uploads a single document through the matching loader, unless the same content
+        is already registered (no shared state touched). Returns its registry entry.
+        """
+        filename = self._source_filename(source, filename)
+        loader = self.document_loader_factory.get_loader(filename)
+        content_hash = loader.content_hash(source)
+        existing = self.document_registry.get(content_hash)
+        if existing:
+            # Already loaded (other role, or a rerun): reuse the remote file
+            return {"filename": existing["filename"], "uri": existing["uri"], "content_hash": content_hash,
+                    "tokens": existing.get("tokens")}
+        doc_uri = loader.load_document(source, display_name=filename, content_hash=content_hash)
+        self._index_document(loader, source, content_hash, filename)
+        # Size of the document in the model's context, for the TPM budget (text estimate)
+        tokens = len(self.retrieval_index.document_text(content_hash)) // CHARS_PER_TOKEN or None
+        return {"filename": filename, "uri": doc_uri, "content_hash": content_hash, "tokens": tokens}
+
+    def _index_document(self, loader, source: DocumentSource, content_hash: str, filename: str):
+        """Adds the document's pages/paragraphs to the local retrieval index (best effort)."""
+        if self.retrieval_index.has_document(content_hash):
+            return
+        try:
+            passages = loader.extract_passages(source)
+            self.retrieval_index.add_document(content_hash, filename, passages)
+            if not passages:
+                logger.warning(f"No text extracted from {filename}", "Document not available to local retrieval")
+        except Exception as e:
+            logger.warning(f"Could not index {filename} for local retrieval", str(e))
+
+    async def _attach_context_cache(self, callback_context, llm_request):
+        """
+        ADK before-model callback: points the request at the cached documents and instruction
+        of its agent. The system instruction moves into the cache, as the API rejects both.
+        """
+        if (self.context_cache is None or _SKIP_CONTEXT_CACHE.get()
+                or llm_request.config.tools or llm_request.config.cached_content):
+            return None
+        # Creating or extending the cache calls the API: keep the event loop (other rows) running
+        cache_name = await asyncio.to_thread(
+            self.context_cache.get,
+            callback_context.agent_name,
+            llm_request.model,
+            llm_request.config.system_instruction,
+            self._request_documents(callback_context),
+            self.document_registry.version,
+        )
+        if cache_name:
+            llm_request.config.cached_content = cache_name
+            llm_request.config.system_instruction = None
+        return None
+
+    def _request_documents(self, callback_context) -> list:
+        """Documents of a model call: those routed to its row or pack, every loaded document otherwise (e.g. chats)."""
+        session = callback_context.session
+        documents = self._session_documents.get(session.id) if session is not None else None
+        return self.document_uris if documents is None else documents
+
+    async def _with_context_cache_fallback(self, operation):
+        """
+        Awaits an agent request. If it failed because its context cache was deleted on the
+        server, the cache entries are dropped (the next requests recreate them) and the
+        request is sent again without the cache.
+        """
+        try:
+            return await operation()
+        except Exception as e:
+            if self.context_cache is None or _SKIP_CONTEXT_CACHE.get() or not is_missing_cache_error(e):
+                raise
+            logger.warning("Context cache no longer available, retrying without it", str(e))
+            self.context_cache.invalidate()
+        reset = _SKIP_CONTEXT_CACHE.set(True)
+        try:
+            return await operation()
+        finally:
+            _SKIP_CONTEXT_CACHE.reset(reset)
+
+    async def _acquire_model_capacity(self, callback_context, llm_request):
+        """ADK before-model callback: waits for request and token budget before the call is sent."""
+        if self.rate_limiter.enabled:
+            documents = self._request_documents(callback_context)
+            file_tokens = {doc["uri"]: doc["tokens"] for doc in documents if doc.get("tokens")}
+            cached_tokens = 0
+            if llm_request.config.cached_content:
+                # The cached documents count against TPM on every call: the cache's own count, else our estimate
+                cached_tokens = ((self.context_cache.token_count(llm_request.config.cached_content) if self.context_cache else None)
+                                 or sum(file_tokens.values()))
+            tokens = estimate_request_tokens(llm_request, file_tokens=file_tokens, cached_tokens=cached_tokens)
+            waited = await self.rate_limiter.aacquire(tokens)
+            if waited > 1:
+                logger.info(f"{callback_context.agent_name} call delayed by the rate limiter", f"{waited:.1f}s")
+        return None
+
+    def _retrieved_passages(self, query: str) -> str:
         """
-        filename = os.path.basename(file_path)
-        logger.info(f"Loading TARGET document: {filename}")
+        Formats the top-k passages of the local index for the context and the target
+        documents, with their real filename and page/section. Empty in "llm" mode.
+        """
+        if self.librarian_mode == "llm":
+            return ""
+
+        sections = []
+        for label, docs in (("Context", self.context_doc_info), ("Target", self.target_doc_info)):
+            hashes = [doc.get("content_hash") for doc in docs]
+            for passage in self.retrieval_index.search(query, k=self.retrieval_top_k, content_hashes=hashes):
+                sections.append(f'[{label}] Filename: "{passage["filename"]}", {passage["location"]}\n"{passage["text"]}"')
+            not_indexed = [doc["filename"] for doc in docs if not self.retrieval_index.has_document(doc.get("content_hash"))]
+            if not_indexed:
+                sections.append(f"[{label}] Not searchable locally: {', '.join(not_indexed)}")
+
+        passages = "\n\n".join(sections) if sections else "(No relevant passages found)"
+        return f"RETRIEVED PASSAGES (local index - real Filename and Page/Section):\n{passages}\n"
+
+    def _register_document(self, info: Dict[str, str], kind: str) -> bool:
+        return self.document_registry.register(info["content_hash"], info["filename"], info["uri"], kind, info.get("tokens"))
+
+    def _load_document(self, source: DocumentSource, kind: str, filename: str = None) -> str:
+        label = kind.capitalize()
+        filename = self._source_filename(source, filename)
+        logger.info(f"Loading {kind.upper()} document: {filename}")
         try:
-            loader = self.document_loader_factory.get_loader(file_path)
-            doc_uri = loader.load_document(file_path)
-            self.target_doc_info.append({"filename": filename, "uri": doc_uri})
-            logger.success(f"Target document uploaded", f"File: {filename}, URI: {doc_uri} (Total target: {len(self.target_doc_info)})")
-            return doc_uri
+            info = self._upload_document(source, filename)
+            if self._register_document(info, kind):
+                total = len(self.document_registry.documents(kind))
+                logger.success(f"{label} document uploaded", f"File: {filename}, URI: {info['uri']} (Total {kind}: {total})")
+            else:
+                logger.info(f"{label} document already loaded, skipping", f"File: {filename}, URI: {info['uri']}")
+            return info["uri"]
         except Exception as e:
-            logger.error(f"Failed to upload target document", str(e))
+            logger.error(f"Failed to upload {kind} document", str(e))
             raise
+
+    def load_documents(self, sources: List[DocumentSource], kind: str = "target", max_workers: int = 4):
+        """
+        Uploads several documents (paths or named file-like objects) concurrently with a
+        bounded thread pool. Yields a progress dict per file as uploads complete; successful
+        uploads are registered in the order of `sources`, whatever the completion order.
+        """
+        import concurrent.futures
+
+        if kind not in ("context", "target"):
+            raise ValueError(f"Unsupported document kind: {kind}")
+        total = len(sources)
+        if total == 0:
+            return
+
+        logger.info(f"Loading {total} {kind.upper()} documents", f"Max parallel uploads: {max_workers}")
+
+        # Completed uploads wait here until every earlier file has completed too
+        pending_registration = {}
+        next_to_register = 0
+        completed = 0
+        registered = 0  # Documents new to the registry
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, total))) as executor:
+            future_to_pos = {executor.submit(self._upload_document, source): pos for pos, source in enumerate(sources)}
+
+            for future in concurrent.futures.as_completed(future_to_pos):
+                pos = future_to_pos[future]
+                filename = getattr(sources[pos], "name", None) or sources[pos]
+                filename = os.path.basename(filename) if isinstance(filename, (str, os.PathLike)) else "document"
+                completed += 1
+                try:
+                    info = future.result()
+                    pending_registration[pos] = info
+                    result = {"status": "success", "index": pos, "filename": filename, "uri": info["uri"],
+                              "content_hash": info["content_hash"]}
+                except Exception as e:
+                    pending_registration[pos] = None
+                    logger.error(f"Failed to upload {kind} document", f"File: {filename} - {e}")
+                    result = {"status": "error", "index": pos, "filename": filename, "error": str(e)}
+
+                # Register the contiguous prefix of finished uploads (stable order)
+                while next_to_register in pending_registration:
+                    info = pending_registration.pop(next_to_register)
+                    if info is not None and self._register_document(info, kind):
+                        registered += 1
+                    next_to_register += 1
+
+                result.update({"completed": completed, "total": total})
+                yield result
+
+        logger.success(f"{kind.capitalize()} documents loaded", f"{completed} files processed (Total {kind}: {len(self.document_registry.documents(kind))})")
+        if registered:  # Reloading the same files (e.g. a Streamlit rerun) validates nothing
+            self.start_document_validation()
     
+    def _documents_in_use(self) -> Dict[str, str]:
+        """Loaded documents tracked by content hash, as {content_hash: remote file name}."""
+        return {doc["content_hash"]: doc["uri"] for doc in self.document_uris if not doc["content_hash"].startswith("uri:")}
+
+    def start_document_validation(self, force: bool = False):
+        """
+        Checks the remote files of the loaded documents in the background (see `_ensure_documents_valid`).
+        Skipped when the same documents were validated less than EXPIRY_MARGIN_SECONDS / 2 ago
+        (or are being validated), unless `force`.
+        """
+        documents = self._documents_in_use()
+        if not documents:
+            return
+        if not force and self._validation is not None:
+            started_at, _, validated = self._validation
+            if validated == documents and time.time() - started_at <= EXPIRY_MARGIN_SECONDS / 2:
+                return
+        self._validation = (time.time(), self.file_lifecycle.start_validation(documents), documents)
+
+    def _ensure_documents_valid(self):
+        """
+        Waits for the background validation of the loaded documents (starting one if there is
+        none recent enough) and points the registry to any re-uploaded file, so that a batch
+        never runs on expired URIs.
+        """
+        self.start_document_validation()
+        if self._validation is None or self._validation[1] is None:
+            return  # Nothing loaded, or validated recently and already applied
+        started_at, future, documents = self._validation
+        self._validation = (started_at, None, documents)
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.warning("Document validation failed", str(e))
+            self._validation = None
+            return
+        for content_hash, result in results.items():
+            doc = self.document_registry.get(content_hash) or {"filename": content_hash}
+            if "name" in result:
+                self.document_registry.update_uri(content_hash, result["name"])
+                logger.info(f"Re-uploaded expired document {doc['filename']}", f"URI: {result['name']}")
+            else:
+                logger.warning(f"Could not validate document {doc['filename']}", result["error"])
+        # Re-uploads changed the URIs: they count as validated. Failures are checked again next time
+        failed = any("name" not in result for result in results.values())
+        self._validation = None if failed else (started_at, None, self._documents_in_use())
+
     @property
     def document_uri(self):
         """Backward compatibility: return first target document URI or None."""
@@ -94,10 +482,14 @@ class ComplianceService:
         # This returns a list of dictionaries
         return self.context_doc_info + self.target_doc_info
 
-    def load_checklist(self, file_path: str) -> pd.DataFrame:
+    def load_checklist(self, file_path: str, cluster_duplicates: bool = False,
+                       similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> pd.DataFrame:
         """
         Loads Excel checklist with flexible column detection.
         Looks for ID and Question columns using common naming patterns.
+        With `cluster_duplicates`, near-duplicate questions (TF-IDF cosine similarity of
+        question + description >= `similarity_threshold`) are grouped: batches analyze one
+        row per group and copy its result to the others (see `Derived_From`).
         """
         # Handle both file paths and UploadedFile objects
         filename = getattr(file_path, 'name', str(file_path))
@@ -108,6 +500,8 @@ class ComplianceService:
         
         # Force all columns to be strings to avoid PyArrow inference issues
         self.checklist_df = pd.read_excel(file_path, dtype=str)
+        self.row_citations = {}
+        self.duplicate_of = {}
         # Replace "nan" strings with empty string if any
         self.checklist_df = self.checklist_df.replace("nan", "")
         
@@ -142,12 +536,21 @@ class ComplianceService:
                 desc_col = col
                 break
 
+        # Detect Category/Section column (groups related questions)
+        category_patterns = ['category', 'categoria', 'section', 'sezione', 'area', 'group', 'gruppo', 'topic']
+        category_col = None
+        for col in self.checklist_df.columns:
+            if col not in (id_col, question_col, desc_col) and col.lower().strip() in category_patterns:
+                category_col = col
+                break
+
         # Store column mappings
         self.id_column = id_col
         self.question_column = question_col
         self.description_column = desc_col
+        self.category_column = category_col
         
-        logger.info(f"Detected columns", f"ID: {id_col}, Question: {question_col}, Description: {desc_col}")
+        logger.info(f"Detected columns", f"ID: {id_col}, Question: {question_col}, Description: {desc_col}, Category: {category_col}")
 
         # Filter out empty rows (where Question is empty)
         if self.question_column:
@@ -179,9 +582,25 @@ class ComplianceService:
         if 'Status' in self.checklist_df.columns:
             self.checklist_df['Status'] = self.checklist_df['Status'].replace('', 'PENDING')
         
+        if cluster_duplicates:
+            self._cluster_duplicate_questions(similarity_threshold)
+        self.checklist_id = self._checklist_fingerprint()
+
         logger.success(f"Checklist loaded", f"{len(self.checklist_df)} rows")
+        # The batch usually follows: check the documents' remote files meanwhile
+        self.start_document_validation()
         return self.checklist_df
     
+    def _cluster_duplicate_questions(self, similarity_threshold: float):
+        """Fills `duplicate_of` with the near-duplicate questions of the checklist."""
+        texts = [f"{self.get_question_from_row(idx)} {self.get_description_from_row(idx)}" for idx in range(len(self.checklist_df))]
+        representatives = cluster_questions(texts, similarity_threshold)
+        self.duplicate_of = {idx: rep for idx, rep in enumerate(representatives) if rep != idx}
+        if 'Derived_From' not in self.checklist_df.columns:
+            self.checklist_df['Derived_From'] = ''  # ID of the row whose analysis was copied
+        logger.info(f"Near-duplicate questions clustered",
+                    f"{len(self.duplicate_of)} of {len(self.checklist_df)} rows reuse another row's analysis")
+
     def get_question_from_row(self, row_index: int) -> str:
         """Extract question text from a row using detected column."""
         if self.question_column and self.question_column in self.checklist_df.columns:
@@ -199,14 +618,168 @@ class ComplianceService:
             return val if val != "nan" else ""
         return ""
 
-    def batch_analyze(self, row_indices: List[int] = None, concurrency: int = 3):
+    def _get_router(self) -> DocumentRouter:
+        """TF-IDF router over the indexed text of the loaded documents, refitted when they change."""
+        if self._router is None or self._router_version != self.document_registry.version:
+            texts = {doc["content_hash"]: self.retrieval_index.document_text(doc["content_hash"]) for doc in self.document_uris}
+            self._router = DocumentRouter(self.router_top_k, self.router_flat_threshold).fit(texts)
+            self._router_version = self.document_registry.version
+        return self._router
+
+    def _route_documents(self, row_indices: List[int]) -> Dict[int, Tuple[list, list]]:
+        """
+        Selects the (context, target) documents to list in each row's prompt.
+        All rows are scored at once (questions x documents matrix); rows whose scores
+        are flat, and every row when routing is disabled, get all documents.
+        """
+        context_docs, target_docs = self.context_doc_info, self.target_doc_info
+        if not self.router_top_k or not row_indices:
+            return {idx: (context_docs, target_docs) for idx in row_indices}
+
+        router = self._get_router()
+        queries = [f"{self.get_question_from_row(idx)} {self.get_description_from_row(idx)}" for idx in row_indices]
+        by_hash = {doc["content_hash"]: doc for doc in context_docs + target_docs}
+        context_routes = router.route(queries, [doc["content_hash"] for doc in context_docs])
+        target_routes = router.route(queries, [doc["content_hash"] for doc in target_docs])
+        return {
+            idx: ([by_hash[h] for h in context_route], [by_hash[h] for h in target_route])
+            for idx, context_route, target_route in zip(row_indices, context_routes, target_routes)
+        }
+
+    def _documents_for_row(self, row_index: int) -> Tuple[list, list]:
+        """Routed documents for a row, precomputed for the whole batch when available."""
+        if self._row_documents_version == self.document_registry.version and row_index in self._row_documents:
+            return self._row_documents[row_index]
+        return self._route_documents([row_index])[row_index]
+
+    def _rows_to_process(self, row_indices: List[int] = None) -> List[int]:
+        """Pending rows among `row_indices` (all pending rows if none are given)."""
+        if row_indices:
+            # Filter provided indices to include only pending ones
+            return [
+                idx for idx in row_indices 
+                if 0 <= idx < len(self.checklist_df) and self.checklist_df.at[idx, 'Status'] in ['PENDING', '']
+            ]
+        # Process all pending if no specific indices are given
+        return [
+            idx for idx in range(len(self.checklist_df)) 
+            if self.checklist_df.at[idx, 'Status'] in ['PENDING', '']
+        ]
+
+    def _rows_by_representative(self, row_indices: List[int]) -> Dict[int, List[int]]:
+        """
+        Groups rows by near-duplicate cluster: {row to analyze: [rows that will reuse its result]}.
+        The first row of each cluster among `row_indices` is the one analyzed.
+        """
+        clusters = {}
+        for idx in row_indices:
+            clusters.setdefault(self.duplicate_of.get(idx, idx), []).append(idx)
+        return {members[0]: members[1:] for members in clusters.values()}
+
+    def _pack_rows(self, row_indices: List[int], pack_size: int, pack_by: str = None) -> List[List[int]]:
+        """
+        Splits rows into packs of at most `pack_size` rows sharing the same `pack_by` value
+        (the detected category column by default; consecutive rows if there is none),
+        in checklist order.
         """
-        Analyzes items in the checklist in batch, using parallel execution.
+        if pack_size <= 1:
+            return [[idx] for idx in row_indices]
+        column = pack_by or self.category_column
+        groups = {}
+        for idx in row_indices:
+            key = str(self.checklist_df.at[idx, column]).strip() if column in self.checklist_df.columns else ""
+            groups.setdefault(key, []).append(idx)
+        return [group[i:i + pack_size] for group in groups.values() for i in range(0, len(group), pack_size)]
+
+    def _share_pack_documents(self, packs: List[List[int]]):
+        """Gives every row of a pack the union of the documents routed to its rows (they share one request)."""
+        for pack in packs:
+            if len(pack) < 2:
+                continue
+            context_docs, target_docs = {}, {}
+            for idx in pack:
+                row_context_docs, row_target_docs = self._documents_for_row(idx)
+                context_docs.update((doc["content_hash"], doc) for doc in row_context_docs)
+                target_docs.update((doc["content_hash"], doc) for doc in row_target_docs)
+            for idx in pack:
+                self._row_documents[idx] = (list(context_docs.values()), list(target_docs.values()))
+
+    def _row_result_key(self, row_index: int, question: str, packed: bool = False) -> str:
+        """
+        Result cache key of a row: its question and description, the loaded document set, model
+        and prompts, and whether it was answered within a packed request.
+        """
+        return result_key(
+            question,
+            self.get_description_from_row(row_index),
+            [doc.get("content_hash") for doc in self.context_doc_info],
+            [doc.get("content_hash") for doc in self.target_doc_info],
+            self.model_name,
+            self.prompt_version,
+            packed=packed,
+        )
+
+    @staticmethod
+    def _is_cacheable(parsed: dict) -> bool:
+        """Only answers whose RISPOSTA could be parsed are cached (a '?' is analyzed again next time)."""
+        return parsed.get("risposta", "?") != "?"
+
+    def _apply_row_result(self, row_index: int, parsed: dict, derived_from: int = None):
+        """Stores an analysis result in the checklist (rows become DRAFT), copied from row `derived_from` if given."""
+        self.checklist_df.at[row_index, 'Risposta'] = parsed['risposta']
+        self.checklist_df.at[row_index, 'Original_Risposta'] = parsed['risposta'] # Store original AI answer
+        self.checklist_df.at[row_index, 'Confidenza'] = parsed['confidenza']
+        self.checklist_df.at[row_index, 'Giustificazione'] = parsed['giustificazione']
+        self.checklist_df.at[row_index, 'Status'] = 'DRAFT'
+        self.checklist_df.at[row_index, 'Manually_Edited'] = False # Reset edit flag
+        if 'Derived_From' in self.checklist_df.columns:
+            source_id = (self.checklist_df.at[derived_from, self.id_column] if self.id_column else str(derived_from)) if derived_from is not None else ''
+            self.checklist_df.at[row_index, 'Derived_From'] = source_id
+        self._record_citations(row_index, parsed['giustificazione'])
+
+    def _checklist_fingerprint(self) -> str:
+        """Identifies the checklist questions, so the same checklist keeps its chats across restarts."""
+        questions = json.dumps([self.get_question_from_row(idx) for idx in range(len(self.checklist_df))])
+        return hashlib.sha256(questions.encode("utf-8")).hexdigest()[:12]
+
+    def _run_fingerprint(self) -> str:
+        """Identifies the loaded checklist questions and documents a journaled run was made on."""
+        payload = json.dumps({
+            "questions": [self.get_question_from_row(idx) for idx in range(len(self.checklist_df))],
+            "context": sorted(str(doc.get("content_hash")) for doc in self.context_doc_info),
+            "target": sorted(str(doc.get("content_hash")) for doc in self.target_doc_info),
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _journal_result(self, row_index: int, parsed: dict, derived_from: int = None):
+        if self.run_journal is not None and self.current_run_id:
+            self.run_journal.record(self.current_run_id, row_index, parsed, derived_from)
+
+    async def abatch_analyze(self, row_indices: List[int] = None, concurrency: int = 3,
+                             adaptive: bool = False, max_concurrency: int = 50,
+                             pack_size: int = 1, pack_by: str = None, run_id: str = None,
+                             row_timeout: float = None, batch_timeout: float = None,
+                             cancel_token: CancellationToken = None):
+        """
+        Analyzes items in the checklist in batch on the running event loop.
+        Every row is a coroutine driving `runner.run_async`; at most `concurrency` rows are
+        in flight, so hundreds of rows need neither threads nor extra loops.
+        With `adaptive`, `concurrency` is only the starting point: the limit grows while the
+        backend stays fast and healthy (up to `max_concurrency`) and halves on quota errors
+        (see `concurrency_controller` for its current value and history).
+        With `pack_size` > 1, up to `pack_size` related rows (same `pack_by` column value,
+        the detected category column by default) are answered by a single request; rows
+        whose answer is missing from the packed response are analyzed one by one.
+        Completed rows are journaled under `run_id` (a new id by default, see
+        `current_run_id`) as they finish; see `resume_batch`.
+        A row running longer than `row_timeout` seconds (ROW_TIMEOUT_SECONDS by default)
+        fails with a timeout and stays PENDING. Once `batch_timeout` (BATCH_TIMEOUT_SECONDS)
+        elapses or `cancel_token` (see `cancel_batch`) is cancelled, no row starts anymore,
+        rows in flight are abandoned and stay PENDING, and a final "cancelled" result is
+        yielded.
         Yields results as they complete.
         """
-        import concurrent.futures
-        
-        logger.info(f"Starting batch analysis", f"Concurrency: {concurrency}, Specific rows: {len(row_indices) if row_indices else 'All pending'}")
+        logger.info(f"Starting batch analysis", f"Concurrency: {concurrency}{' (adaptive)' if adaptive else ''}, Pack size: {pack_size}, Specific rows: {len(row_indices) if row_indices else 'All pending'}")
         
         if self.checklist_df is None:
             logger.error("Batch analysis failed: No checklist loaded")
@@ -218,65 +791,477 @@ class ComplianceService:
             yield {"error": "No target documents loaded"}
             return
         
-        # Determine which indices to process
-        if row_indices:
-            # Filter provided indices to include only pending ones
-            indices_to_process = [
-                idx for idx in row_indices 
-                if 0 <= idx < len(self.checklist_df) and self.checklist_df.at[idx, 'Status'] in ['PENDING', '']
-            ]
-        else:
-            # Process all pending if no specific indices are given
-            indices_to_process = [
-                idx for idx in range(len(self.checklist_df)) 
-                if self.checklist_df.at[idx, 'Status'] in ['PENDING', '']
-            ]
-        
+        indices_to_process = self._rows_to_process(row_indices)
         total_items_to_process = len(indices_to_process)
-        logger.info(f"Processing {total_items_to_process} items in parallel")
+        logger.info(f"Processing {total_items_to_process} items concurrently")
         
         if total_items_to_process == 0:
             yield {"status": "info", "message": "No pending items to process."}
             return
 
-        # Helper to run safely in thread and return index + result
-        def _threaded_worker(idx):
-            q = self.get_question_from_row(idx)
-            i_id = self.checklist_df.at[idx, self.id_column] if self.id_column else str(idx)
+        row_timeout = self.row_timeout if row_timeout is None else row_timeout
+        batch_timeout = self.batch_timeout if batch_timeout is None else batch_timeout
+        token = cancel_token or CancellationToken()
+        self.cancel_token = token
+
+        self.current_run_id = run_id or new_run_id()
+        if self.run_journal is not None:
+            params = {"concurrency": concurrency, "adaptive": adaptive, "max_concurrency": max_concurrency,
+                      "pack_size": pack_size, "pack_by": pack_by}
+            self.run_journal.start(self.current_run_id, indices_to_process, params, self._run_fingerprint())
+
+        # Expired remote files would fail rows halfway through the batch: restore them first
+        await asyncio.to_thread(self._ensure_documents_valid)
+
+        # Route documents for all rows in one vectorized pass, before the rows start
+        self._row_documents = self._route_documents(indices_to_process)
+        self._row_documents_version = self.document_registry.version
+
+        # Near-duplicate questions: one row per cluster is analyzed, the others get its result
+        followers = self._rows_by_representative(indices_to_process)
+        if len(followers) < len(indices_to_process):
+            logger.info(f"{len(indices_to_process) - len(followers)} near-duplicate rows reuse another row's analysis")
+        indices_to_process = list(followers)
+
+        # Rows already analyzed with the same question, documents and prompts: no agent call
+        cached = {}
+        if self.result_cache is not None:
+            keys = {idx: self._row_result_key(idx, self.get_question_from_row(idx)) for idx in indices_to_process}
+            # A packed run may also reuse answers of earlier packed runs (single-row answers first)
+            packed_keys = ({idx: self._row_result_key(idx, self.get_question_from_row(idx), packed=True)
+                            for idx in indices_to_process} if pack_size > 1 else {})
+            found = await self.result_cache.aget_many(list(set(keys.values()) | set(packed_keys.values())))
+            for idx in indices_to_process:
+                for key in (keys[idx], packed_keys.get(idx)):
+                    if key in found:
+                        cached[idx] = found[key]
+                        break
+            if cached:
+                logger.info(f"Reusing {len(cached)} cached results", f"{len(indices_to_process) - len(cached)} rows left to analyze")
+            indices_to_process = [idx for idx in indices_to_process if idx not in cached]
+        packs = self._pack_rows(indices_to_process, pack_size, pack_by)
+        self._share_pack_documents(packs)
+
+        if adaptive:
+            controller = AIMDController(initial=concurrency, max_limit=max(concurrency, max_concurrency))
+        else:
+            controller = AIMDController(initial=concurrency, min_limit=concurrency, max_limit=concurrency)
+        self.concurrency_controller = controller
+
+        for idx, parsed in cached.items():
+            for row in [idx] + followers[idx]:
+                derived_from = idx if row != idx else None
+                self._apply_row_result(row, parsed, derived_from)
+                self._journal_result(row, parsed, derived_from)
+                yield {"status": "success", "index": row, "data": parsed, "concurrency": controller.limit,
+                       "cached": True, "derived_from": derived_from}
+
+        def _on_circuit_change(state):
+            if state == CircuitBreaker.OPEN:
+                logger.warning("Backend unavailable: batch paused", f"Probing again in {self.circuit_reset_seconds:.0f}s")
+            elif state == CircuitBreaker.CLOSED:
+                logger.info("Backend available again: batch resumed")
+        breaker = CircuitBreaker(self.circuit_failure_threshold, self.circuit_reset_seconds,
+                                 self.circuit_give_up_seconds, on_state_change=_on_circuit_change)
+        self.circuit_breaker = breaker
+
+        async def _call(operation, label: str, counter: dict):
+            """Awaits one agent request under the concurrency limit, with retries, within the row deadline."""
+            async def _attempt():
+                counter["attempts"] += 1
+                started_at = await controller.acquire()
+                error = None
+                try:
+                    if not row_timeout:
+                        # Pure processing coroutine (no side effects on DF)
+                        return await self._with_context_cache_fallback(operation)
+                    # The deadline runs from the row's first start, across its retries
+                    deadline = counter.setdefault("deadline", time.monotonic() + row_timeout)
+                    try:
+                        return await asyncio.wait_for(self._with_context_cache_fallback(operation),
+                                                      max(0.0, deadline - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        if time.monotonic() < deadline:
+                            raise  # Timeout of the call itself: retried
+                        raise DeadlineExceeded(f"{label} exceeded its {row_timeout:.0f}s deadline")
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    await controller.release(started_at, error)
+
+            def _on_retry(attempt, kind, delay, error):
+                logger.warning(f"{label} failed ({kind.replace('_', ' ')}), retry {attempt} in {delay:.1f}s", str(error))
+
+            return await call_with_retry(_attempt, self.retry_policy, breaker, _on_retry)
+
+        def _row_data(idx):
+            return {"index": idx, "id": self.checklist_df.at[idx, self.id_column] if self.id_column else str(idx),
+                    "question": self.get_question_from_row(idx)}
+
+        async def _row_worker(idx):
+            data = _row_data(idx)
+            counter = {"attempts": 0}
             try:
-                # Use the pure processing method (no side effects on DF)
-                res = self._process_single_row(idx, q)
-                return {"index": idx, "id": i_id, "question": q, "result": res, "status": "success"}
+                res = await _call(lambda: self._aprocess_single_row(idx, data["question"]), f"Row {idx}", counter)
+                return {**data, "result": res, "status": "success", "attempts": counter["attempts"]}
             except Exception as e:
-                return {"index": idx, "id": i_id, "question": q, "error": str(e), "status": "error"}
+                return {**data, "error": str(e), "status": "error", "attempts": counter["attempts"]}
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-            future_to_idx = {executor.submit(_threaded_worker, idx): idx for idx in indices_to_process}
-            
-            for future in concurrent.futures.as_completed(future_to_idx):
-                idx = future_to_idx[future]
-                try:
-                    data = future.result()
-                    
-                    # Update DataFrame in Main Thread (Safe)
+        async def _pack_worker(pack):
+            if len(pack) == 1:
+                return [await _row_worker(pack[0])]
+            counter = {"attempts": 0}
+            answers = {}
+            try:
+                answers = await _call(lambda: self._aprocess_packed_rows(pack), f"Rows {pack}", counter)
+            except Exception as e:
+                logger.warning(f"Packed request for rows {pack} failed, analyzing them one by one", str(e))
+            missing = [idx for idx in pack if idx not in answers]
+            if answers and missing:
+                logger.warning(f"Packed response without a usable answer for rows {missing}", "Analyzing them one by one")
+            results = [{**_row_data(idx), "result": answers[idx], "status": "success", "attempts": counter["attempts"]}
+                       for idx in pack if idx in answers]
+            return results + list(await asyncio.gather(*(_row_worker(idx) for idx in missing)))
+
+        # Create the sessions of every row/pack at once: workers then skip the session lookup
+        session_ids = [self._row_session_id(pack[0]) if len(pack) == 1 else self._pack_session_id(pack) for pack in packs]
+        await self.session_manager.aprepare(self.session_user_id, session_ids, self._session_state(), reset=True)
+
+        # Cancellation (Stop button, job cancel, batch deadline) may come from any thread
+        loop = asyncio.get_running_loop()
+        cancelled = asyncio.Event()
+        unsubscribe = token.on_cancel(lambda: loop.call_soon_threadsafe(cancelled.set))
+        deadline_timer = loop.call_later(batch_timeout, token.cancel, "Batch deadline exceeded") if batch_timeout else None
+        watcher = asyncio.ensure_future(cancelled.wait())
+
+        tasks = [asyncio.ensure_future(_pack_worker(pack)) for pack in packs]
+        running = set(tasks)
+        try:
+            while running and not cancelled.is_set():
+                done, running = await asyncio.wait(running | {watcher}, return_when=asyncio.FIRST_COMPLETED)
+                running.discard(watcher)
+                for data in (data for task in done if task is not watcher for data in task.result()):
+                    idx = data["index"]
+                    # Only this coroutine updates the DataFrame, between rows (Safe)
                     if data["status"] == "success":
                         parsed = data["result"]
-                        self.checklist_df.at[idx, 'Risposta'] = parsed['risposta']
-                        self.checklist_df.at[idx, 'Original_Risposta'] = parsed['risposta'] # Store original AI answer
-                        self.checklist_df.at[idx, 'Confidenza'] = parsed['confidenza']
-                        self.checklist_df.at[idx, 'Giustificazione'] = parsed['giustificazione']
-                        self.checklist_df.at[idx, 'Status'] = 'DRAFT'
-                        self.checklist_df.at[idx, 'Manually_Edited'] = False # Reset edit flag
-                        logger.success(f"Item analyzed (Thread result)", f"ID: {data['id']}")
-                        yield {"status": "success", "index": idx, "data": parsed}
+                        logger.success(f"Item analyzed", f"ID: {data['id']}")
+                        for row in [idx] + followers[idx]:
+                            derived_from = idx if row != idx else None
+                            self._apply_row_result(row, parsed, derived_from)
+                            self._journal_result(row, parsed, derived_from)
+                            yield {"status": "success", "index": row, "data": parsed, "concurrency": controller.limit,
+                                   "derived_from": derived_from}
                     else:
-                        logger.error(f"Item analysis failed (Thread result)", f"ID: {data['id']} - {data.get('error')}")
-                        yield {"status": "error", "index": idx, "error": data.get('error')}
-                except Exception as exc:
-                    logger.error(f"Thread execution failed for index {idx}", str(exc))
-                    yield {"status": "error", "index": idx, "error": str(exc)}
-        
-        logger.success(f"Batch analysis complete")
+                        logger.error(f"Item analysis failed", f"ID: {data['id']} - {data.get('error')}")
+                        for row in [idx] + followers[idx]:
+                            yield {"status": "error", "index": row, "error": data.get('error'), "concurrency": controller.limit}
+        finally:
+            # The consumer may stop early: do not leave rows running in the background
+            for task in tasks + [watcher]:
+                task.cancel()
+            # Let the cancelled rows run their cleanup (sessions, concurrency slots, stores)
+            await asyncio.gather(*tasks, watcher, return_exceptions=True)
+            unsubscribe()
+            if deadline_timer is not None:
+                deadline_timer.cancel()
+            if self.cancel_token is token:
+                self.cancel_token = None
+
+        if running:  # Stopped before every row completed
+            abandoned = sum(len(pack) + sum(len(followers[idx]) for idx in pack)
+                            for pack, task in zip(packs, tasks) if task in running)
+            logger.warning(f"Batch analysis stopped: {token.reason}", f"{abandoned} rows left pending")
+            yield {"status": "cancelled", "message": token.reason, "pending": abandoned}
+            return
+
+        if self.run_journal is not None:
+            self.run_journal.finish(self.current_run_id)
+        logger.success(f"Batch analysis complete", f"Final concurrency: {controller.limit}")
+
+    def batch_analyze(self, row_indices: List[int] = None, concurrency: int = 3,
+                      adaptive: bool = False, max_concurrency: int = 50,
+                      pack_size: int = 1, pack_by: str = None, run_id: str = None,
+                      row_timeout: float = None, batch_timeout: float = None,
+                      cancel_token: CancellationToken = None, heartbeat_seconds: float = None):
+        """
+        Synchronous wrapper of `abatch_analyze` (e.g. for Streamlit): runs it on a private
+        event loop and yields its results as they complete. With `heartbeat_seconds`, a
+        `{"status": "heartbeat"}` item is also yielded after that long without a result;
+        closing the iterator then stops the batch (see `_iterate_sync`).
+        """
+        return self._iterate_sync(self.abatch_analyze(row_indices, concurrency, adaptive, max_concurrency,
+                                                      pack_size, pack_by, run_id=run_id, row_timeout=row_timeout,
+                                                      batch_timeout=batch_timeout, cancel_token=cancel_token),
+                                  heartbeat_seconds)
+
+    def cancel_batch(self, reason: str = "Stopped by user") -> bool:
+        """
+        Stops the running batch from any thread: no new row starts, rows in flight are
+        abandoned and stay PENDING. Returns False if no batch is running.
+        """
+        if self.cancel_token is None or self.cancel_token.cancelled:
+            return False
+        self.cancel_token.cancel(reason)
+        return True
+
+    def resumable_runs(self) -> List[dict]:
+        """Journaled runs of the loaded checklist and documents with rows left to analyze, most recent first."""
+        if self.run_journal is None or self.checklist_df is None:
+            return []
+        return [run for run in self.run_journal.list_runs(self._run_fingerprint()) if run["completed"] < run["rows"]]
+
+    async def aresume_batch(self, run_id: str, **overrides):
+        """
+        Resumes a journaled batch run: results already journaled are replayed into the
+        checklist (yielded with `"resumed": True`), then only the rows still missing are
+        analyzed, with the run's original settings (`overrides` replace some of them, e.g.
+        `concurrency`). The checklist and documents must be the ones the run started with.
+        """
+        if self.run_journal is None:
+            yield {"error": "Run journal disabled (RUN_JOURNAL_DIR)"}
+            return
+        if self.checklist_df is None:
+            logger.error("Resume failed: No checklist loaded")
+            yield {"error": "No checklist loaded"}
+            return
+        try:
+            header, results, _ = self.run_journal.load(run_id)
+        except (OSError, ValueError) as e:
+            logger.error(f"Resume failed: run {run_id} not found", str(e))
+            yield {"error": f"Unknown run: {run_id}"}
+            return
+        if header.get("fingerprint") != self._run_fingerprint():
+            logger.error(f"Resume failed: run {run_id} was made on another checklist or documents")
+            yield {"error": "The checklist or documents changed since this run started"}
+            return
+
+        logger.info(f"Resuming batch run {run_id}", f"{len(results)} journaled results, {len(header['row_indices'])} rows")
+        self.current_run_id = run_id
+        for idx, record in sorted(results.items()):
+            if idx < len(self.checklist_df):
+                self._apply_row_result(idx, record["data"], record.get("derived_from"))
+                yield {"status": "success", "index": idx, "data": record["data"], "resumed": True,
+                       "derived_from": record.get("derived_from")}
+
+        missing = [idx for idx in header["row_indices"] if idx not in results]
+        if not missing:
+            self.run_journal.finish(run_id)
+            yield {"status": "info", "message": "All rows of this run were already analyzed."}
+            return
+        async for result in self.abatch_analyze(missing, run_id=run_id, **{**header["params"], **overrides}):
+            yield result
+
+    def resume_batch(self, run_id: str, heartbeat_seconds: float = None, **overrides):
+        """Synchronous wrapper of `aresume_batch`, like `batch_analyze`."""
+        return self._iterate_sync(self.aresume_batch(run_id, **overrides), heartbeat_seconds)
+
+    def export_state(self) -> dict:
+        """
+        JSON-serializable snapshot of what a batch needs: the checklist and its detected
+        columns, near-duplicate clusters and loaded documents. Indexed passages are written
+        once to the passage store and referenced by content hash, not copied.
+        A worker process rebuilds the same service with `restore_state`.
+        """
+        indexed = [doc["content_hash"] for doc in self.document_uris if self.retrieval_index.has_document(doc.get("content_hash"))]
+        self.passage_store.put_many({h: self.retrieval_index.document_passages(h) for h in self.passage_store.missing(indexed)})
+        return {
+            "checklist": self.checklist_df.to_json(orient="split") if self.checklist_df is not None else None,
+            "columns": {"id": self.id_column, "question": self.question_column,
+                        "description": self.description_column, "category": self.category_column},
+            "duplicate_of": {str(idx): rep for idx, rep in self.duplicate_of.items()},
+            "context_docs": self.context_doc_info,
+            "target_docs": self.target_doc_info,
+            "passage_store": self.passage_store.path,
+            "indexed": indexed,
+        }
+
+    def restore_state(self, state: dict):
+        """Replaces the checklist and documents with a snapshot taken by `export_state`."""
+        checklist = state.get("checklist")
+        self.checklist_df = pd.read_json(io.StringIO(checklist), orient="split", dtype=False, convert_dates=False) if checklist else None
+        columns = state.get("columns", {})
+        self.id_column = columns.get("id")
+        self.question_column = columns.get("question")
+        self.description_column = columns.get("description")
+        self.category_column = columns.get("category")
+        self.checklist_id = self._checklist_fingerprint() if self.checklist_df is not None else None
+        self.duplicate_of = {int(idx): rep for idx, rep in state.get("duplicate_of", {}).items()}
+        self.row_citations = {}
+        self.context_doc_info, self.target_doc_info = [], []  # Drop previous entries (and their URIs) first
+        self.context_doc_info = state.get("context_docs", [])
+        self.target_doc_info = state.get("target_docs", [])
+        self.retrieval_index = LexicalIndex()
+        filenames = {doc["content_hash"]: doc["filename"] for doc in self.document_uris}
+        # The snapshot's passage store, normally this cache directory's own
+        store_path = state.get("passage_store") or self.passage_store.path
+        store = self.passage_store if store_path == self.passage_store.path else PassageStore(store_path)
+        for content_hash, passages in store.get_many(state.get("indexed", [])).items():
+            if passages:
+                self.retrieval_index.add_document(content_hash, filenames.get(content_hash, content_hash), passages)
+
+    def apply_batch_result(self, result: dict) -> bool:
+        """
+        Stores a successful batch result produced elsewhere (e.g. by a job worker) in the
+        checklist. Returns whether the result was applied.
+        """
+        if self.checklist_df is None or result.get("status") != "success" or not 0 <= result.get("index", -1) < len(self.checklist_df):
+            return False
+        self._apply_row_result(result["index"], result["data"], result.get("derived_from"))
+        return True
+
+    def shard_rows(self, row_indices: List[int] = None, shard_size: int = 50) -> List[List[int]]:
+        """
+        Splits the pending rows among `row_indices` into shards of about `shard_size` rows
+        for `submit_sharded_batch`. Near-duplicate rows stay in their cluster's shard, so
+        each cluster is still analyzed once.
+        """
+        shards, current = [], []
+        for representative, followers in self._rows_by_representative(self._rows_to_process(row_indices)).items():
+            if current and len(current) + 1 + len(followers) > shard_size:
+                shards.append(current)
+                current = []
+            current += [representative] + followers
+        return shards + ([current] if current else [])
+
+    def submit_sharded_batch(self, coordinator, row_indices: List[int] = None, shard_size: int = 50, **params) -> str:
+        """
+        Registers a batch as shards on a `ShardCoordinator`, for `services.shard_worker`
+        processes on any number of nodes. `params` are `abatch_analyze` settings
+        (concurrency, pack_size...). Returns the run id; see `merge_sharded_results`.
+        """
+        shards = self.shard_rows(row_indices, shard_size)
+        run_id = coordinator.create_run(shards, params, self.export_state())
+        logger.info(f"Sharded batch {run_id} submitted", f"{sum(len(shard) for shard in shards)} rows in {len(shards)} shards")
+        return run_id
+
+    def merge_sharded_results(self, coordinator, run_id: str) -> int:
+        """Applies the results of the completed shards of a run to the checklist. Returns the rows updated."""
+        return sum(self.apply_batch_result(result) for result in coordinator.results(run_id).values())
+
+    @staticmethod
+    def _iterate_sync(results, heartbeat_seconds: float = None):
+        """
+        Drives an async generator on a private event loop, yielding its items. With
+        `heartbeat_seconds`, `{"status": "heartbeat"}` is yielded whenever no item came for
+        that long, so the caller's thread regains control while rows are in flight (e.g.
+        Streamlit, which only notices a Stop click when the script calls it).
+        """
+        loop = asyncio.new_event_loop()
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(results.__anext__(), loop=loop)
+                done, _ = loop.run_until_complete(asyncio.wait({pending}, timeout=heartbeat_seconds or None))
+                if not done:
+                    yield {"status": "heartbeat"}
+                    continue
+                item, pending = pending, None
+                try:
+                    item = item.result()
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            if pending is not None:
+                # Closed between two items: interrupt the generator where it waits (rows are cancelled)
+                pending.cancel()
+                try:
+                    loop.run_until_complete(pending)
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
+            loop.run_until_complete(results.aclose())
+            # Nothing may outlive the loop: finish whatever is left and close its async generators
+            leftover = asyncio.all_tasks(loop)
+            if leftover:
+                for task in leftover:
+                    task.cancel()
+                loop.run_until_complete(asyncio.wait(leftover))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def _record_citations(self, row_index: int, giustificazione: str):
+        """
+        Records the documents a row's justification cites in its Fonte Context / Fonte Target
+        lines, matched by filename against the documents given to the row. A row citing
+        none of them (e.g. "Fonte non disponibile") depends on all of them.
+        """
+        row_context_docs, row_target_docs = self._documents_for_row(row_index)
+        row_docs = row_context_docs + row_target_docs
+        sources = re.findall(r'Fonte(?:\s+(?:Context|Target))?\s*:\s*(.+)', giustificazione or "", re.IGNORECASE)
+        cited_text = "\n".join(sources).lower()
+
+        cited = {}
+        for doc in row_docs:
+            filename = doc["filename"].lower()
+            stem = os.path.splitext(filename)[0]
+            if filename in cited_text or (len(stem) >= 4 and stem in cited_text):
+                cited[doc["content_hash"]] = doc["filename"]
+        self.row_citations[row_index] = cited or {doc["content_hash"]: doc["filename"] for doc in row_docs}
+
+    def _resolve_document(self, doc: str) -> Dict[str, str]:
+        """
+        Returns {content_hash: filename} for a document given by content hash, or by filename
+        (every known version with that name, loaded or still cited by analyzed rows).
+        """
+        known = {d["content_hash"]: d["filename"] for d in self.document_uris}
+        for citations in self.row_citations.values():
+            for content_hash, filename in citations.items():
+                known.setdefault(content_hash, filename)
+        if doc in known:
+            return {doc: known[doc]}
+        name = os.path.basename(doc)
+        versions = {content_hash: filename for content_hash, filename in known.items() if filename == name}
+        if not versions:
+            raise ValueError(f"Unknown document: {doc}")
+        return versions
+
+    def affected_rows(self, doc: str) -> List[int]:
+        """Indices of the analyzed rows that depend on a document (content hash or filename)."""
+        hashes = self._resolve_document(doc)
+        return sorted(idx for idx, citations in self.row_citations.items() if hashes.keys() & citations.keys())
+
+    def replace_document(self, doc: str, source: DocumentSource, filename: str = None) -> str:
+        """
+        Loads a new version of a document (given by content hash or filename) in the role of
+        the old one, and unloads the old version. Returns the new URI; rows citing the old
+        version are left untouched until `reanalyze_affected` is called (with the filename,
+        which covers every version, or the old content hash).
+        """
+        loaded = [h for h in self._resolve_document(doc) if self.document_registry.get(h)]
+        if not loaded:
+            raise ValueError(f"Document not loaded: {doc}")
+        old_hash = loaded[0]
+        old_filename = self.document_registry.get(old_hash)["filename"]
+        roles = [kind for kind in ("context", "target") if self.document_registry.has(old_hash, kind)]
+
+        uri = None
+        for kind in roles:
+            uri = self._load_document(source, kind, filename or old_filename)
+        new_hash = self.document_loader_factory.get_loader(filename or old_filename).content_hash(source)
+        if new_hash != old_hash:
+            self.document_registry.remove(old_hash)
+            self.retrieval_index.remove_document(old_hash)
+            logger.info(f"Replaced document {old_filename}", f"{len(self.affected_rows(old_hash))} analyzed rows cite the previous version")
+        return uri
+
+    def reanalyze_affected(self, doc: str, concurrency: int = 3):
+        """
+        Resets to PENDING only the rows whose analysis depends on a document (content hash
+        or filename, typically the previous version of a replaced document) and re-runs them.
+        Yields the same results as `batch_analyze`.
+        """
+        affected = self.affected_rows(doc)
+        logger.info(f"Re-analyzing rows affected by {doc}", f"{len(affected)} rows")
+        if not affected:
+            yield {"status": "info", "message": "No analyzed rows depend on this document."}
+            return
+        for idx in affected:
+            self.checklist_df.at[idx, 'Status'] = 'PENDING'
+            self.row_citations.pop(idx, None)
+        yield from self.batch_analyze(row_indices=affected, concurrency=concurrency)
 
     def chat_with_row(self, row_index: int, user_message: str) -> str:
         """
@@ -323,6 +1308,7 @@ CHECKLIST QUESTION: {question}
 ADDITIONAL DESCRIPTION/CONTEXT related to the checklist question: {description}
 
 {current_analysis}
+{self._retrieved_passages(f"{question} {description} {user_message}")}
 
 USER QUESTION: {user_message}
 
@@ -335,12 +1321,14 @@ Provide a helpful answer that:
 Be conversational and helpful. If you need to search the documents, do so and provide specific quotes.
 """
         
-        user_id = "user_default"
-        session_id = f"chat_row_{row_index}"
+        user_id = self.session_user_id
+        session_id = self._chat_session_id(row_index)
         
         self._get_or_create_session(user_id, session_id)
         
         content = types.Content(role='user', parts=[types.Part(text=chat_prompt)])
+        usage = SessionUsage()
+        usage.add(content)
         
         try:
             # Use runner.run instead of orchestrator.send_message
@@ -352,6 +1340,7 @@ Be conversational and helpful. If you need to search the documents, do so and pr
             
             response_text = ""
             for event in events:
+                usage.add(event)
                 if event.is_final_response() and event.content:
                     response_text = event.content.parts[0].text
                     break
@@ -365,31 +1354,38 @@ Be conversational and helpful. If you need to search the documents, do so and pr
         except Exception as e:
             logger.error(f"Chat failed for row {row_index}", str(e))
             return f"Error: {str(e)}"
+        finally:
+            self._release_session(user_id, session_id, usage.bytes)
 
-    def _get_or_create_session(self, user_id: str, session_id: str):
-        """Helper to ensure session exists."""
-        session = None
-        try:
-            # Check if session exists
-            session = asyncio.run(self.session_service.get_session(
-                app_name="agents", 
-                user_id=user_id, 
-                session_id=session_id
-            ))
-        except Exception:
-            pass
-            
-        if session is None:
-             # Create new session with context and target PDF URIs
-             asyncio.run(self.session_service.create_session(
-                app_name="agents", 
-                user_id=user_id, 
-                session_id=session_id,
-                state={
-                    "context_pdf_info": self.context_doc_info, # pass list of dicts
-                    "target_pdf_info": self.target_doc_info  # pass list of dicts
-                }
-            ))
+    def _session_state(self) -> dict:
+        """Initial state of new sessions: the loaded context and target documents."""
+        return {
+            "context_pdf_info": self.context_doc_info, # pass list of dicts
+            "target_pdf_info": self.target_doc_info  # pass list of dicts
+        }
+
+    @staticmethod
+    def _row_session_id(row_index: int) -> str:
+        return f"session_row_{row_index}"
+
+    def _chat_session_id(self, row_index: int) -> str:
+        """Chat session of a row of the current checklist (another checklist starts new chats)."""
+        return f"chat_{self.checklist_id}_row_{row_index}"
+
+    @staticmethod
+    def _pack_session_id(row_indices: List[int]) -> str:
+        return f"session_pack_{row_indices[0]}_{len(row_indices)}"
+
+    def _get_or_create_session(self, user_id: str, session_id: str, reset: bool = False):
+        """
+        Helper to ensure session exists (from synchronous code), emptied first with `reset`.
+        The session counts as in use until `_release_session`.
+        """
+        asyncio.run(self.session_manager.aopen(user_id, session_id, self._session_state(), reset))
+
+    def _release_session(self, user_id: str, session_id: str, added_bytes: int = 0):
+        """Ends a run started with `_get_or_create_session` (idle sessions over budget are evicted)."""
+        asyncio.run(self.session_manager.aclose(user_id, session_id, added_bytes))
 
     def _parse_response(self, response_text: str) -> dict:
         """
@@ -424,26 +1420,18 @@ Be conversational and helpful. If you need to search the documents, do so and pr
         
         return result
 
-    def _process_single_row(self, row_index: int, question: str) -> dict:
-        """
-        Internal pure method to run analysis for a single row.
-        Does NOT modify shared state (checklist_df).
-        Returns parsed result dictionary.
-        """
+    def _row_message(self, row_index: int, question: str) -> types.Content:
+        """Builds the analysis request of a row (only the documents routed to it are listed)."""
         description = self.get_description_from_row(row_index)
-        
-        if not self.target_doc_info:
-            raise ValueError("No target documents loaded")
 
-        user_id = "user_default"
-        session_id = f"session_row_{row_index}"
-        
-        # Ensure session exists (this part manages ADK session state, which is thread-safe per session_id)
-        self._get_or_create_session(user_id, session_id)
-
-        # Construct prompt
-        context_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in self.context_doc_info]) if self.context_doc_info else "  (None - analyzing without regulatory context)"
-        target_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in self.target_doc_info])
+        # Construct prompt (only the documents routed to this row)
+        row_context_docs, row_target_docs = self._documents_for_row(row_index)
+        self._session_documents[self._row_session_id(row_index)] = row_context_docs + row_target_docs
+        context_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in row_context_docs]) if row_context_docs else "  (None - analyzing without regulatory context)"
+        target_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in row_target_docs])
+        omitted = len(self.context_doc_info) + len(self.target_doc_info) - len(row_context_docs) - len(row_target_docs)
+        if omitted:
+            target_docs += f"\n  ({omitted} other loaded documents omitted: not relevant to this question)"
         
         prompt = f"""
         You are analyzing TARGET documents for compliance. 
@@ -457,6 +1445,7 @@ Be conversational and helpful. If you need to search the documents, do so and pr
         CHECKLIST QUESTION: {question}
         ADDITIONAL DESCRIPTION/DETAILS related to the checklist question: {description}
         
+        {self._retrieved_passages(f"{question} {description}")}
         TASK: Verify if the TARGET documents comply with the requirements.
         If CONTEXT documents are provided, use them to understand the rules.
         When citing a source, use the 'Filename' provided in the document list.
@@ -465,39 +1454,215 @@ Be conversational and helpful. If you need to search the documents, do so and pr
         Provide a structured response with answer, confidence, and justification including text snippets.
         """
         
-        content = types.Content(role='user', parts=[types.Part(text=prompt)])
+        return types.Content(role='user', parts=[types.Part(text=prompt)])
+
+    def _packed_message(self, row_indices: List[int]) -> types.Content:
+        """Builds a single analysis request for several rows, answered item by item ("ITEM <row index>")."""
+        row_context_docs, row_target_docs = self._documents_for_row(row_indices[0])
+        self._session_documents[self._pack_session_id(row_indices)] = row_context_docs + row_target_docs
+        context_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in row_context_docs]) if row_context_docs else "  (None - analyzing without regulatory context)"
+        target_docs = "\n".join([f'  - Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in row_target_docs])
+        omitted = len(self.context_doc_info) + len(self.target_doc_info) - len(row_context_docs) - len(row_target_docs)
+        if omitted:
+            target_docs += f"\n  ({omitted} other loaded documents omitted: not relevant to these questions)"
+
+        items = []
+        for idx in row_indices:
+            question = self.get_question_from_row(idx)
+            description = self.get_description_from_row(idx)
+            item_id = self.checklist_df.at[idx, self.id_column] if self.id_column else idx
+            items.append(f"""ITEM {idx} (Checklist ID: {item_id})
+        CHECKLIST QUESTION: {question}
+        ADDITIONAL DESCRIPTION/DETAILS related to the checklist question: {description}
+        {self._retrieved_passages(f"{question} {description}")}""")
+        items_text = "\n\n        ".join(items)
+
+        prompt = f"""
+        You are analyzing TARGET documents for compliance. 
+        
+        CONTEXT DOCUMENTS (Regulations/Policies - The Rules):
+        {context_docs}
+        
+        TARGET DOCUMENTS (Documents to Verify):
+        {target_docs}
         
-        # Run Synchronously (this thread will block here waiting for API)
-        events = self.runner.run(
-            user_id=user_id, 
-            session_id=session_id, 
-            new_message=content
-        )
+        This request contains {len(row_indices)} CHECKLIST QUESTIONS about the same documents.
+        Handle EACH item separately: evidence found for one item must not be used to answer another.
+        
+        {items_text}
+        
+        TASK: For each item, verify if the TARGET documents comply with the requirements.
+        If CONTEXT documents are provided, use them to understand the rules.
+        When citing a source, use the 'Filename' provided in the document list.
+        Otherwise, answer based on general best practices.
+        
+        OUTPUT: one block per item, in the order given. Start each block with its header line
+        "### ITEM <number>" (e.g. "### ITEM {row_indices[0]}"), followed by the structured response for that
+        item only (answer, confidence, and justification including text snippets).
+        Every item must have its block, even when no evidence is found.
+        """
+
+        return types.Content(role='user', parts=[types.Part(text=prompt)])
+
+    def _split_packed_response(self, response_text: str, row_indices: List[int]) -> Dict[int, dict]:
+        """
+        Splits a packed response into {row index: parsed result}. Items that are missing,
+        unknown or without a RISPOSTA are left out (to be analyzed on their own).
+        """
+        markers = list(PACKED_ITEM_PATTERN.finditer(response_text))
+        results = {}
+        for marker, next_marker in zip(markers, markers[1:] + [None]):
+            idx = int(marker.group(1))
+            block = response_text[marker.end():next_marker.start() if next_marker else len(response_text)]
+            if idx in row_indices and idx not in results and re.search(r'\*\*RISPOSTA:\*\*', block, re.IGNORECASE):
+                results[idx] = self._parse_response(block.strip())
+        return results
+
+    def _log_row_event(self, row_index: int, event, current_agent: str) -> str:
+        """Logs the first output of each agent for a row. Returns the current agent."""
+        if event.content and event.content.parts:
+            try:
+                text = event.content.parts[0].text
+                if text:
+                    author = getattr(event, 'author', 'unknown')
+                    # Logging of concurrent rows can be interleaved, but Logger is thread-safe enough for now
+                    if author != current_agent and author != 'user':
+                        current_agent = author
+                        if 'Librarian' in author or 'librarian' in author.lower():
+                            logger.info(f"[Row {row_index}] 📚 LIBRARIAN OUTPUT:\n{text[:200]}...")
+                        elif 'Auditor' in author or 'auditor' in author.lower():
+                            logger.info(f"[Row {row_index}] ⚖️ AUDITOR OUTPUT:\n{text[:200]}...")
+            except Exception:
+                pass
+        return current_agent
+
+    def _process_single_row(self, row_index: int, question: str, use_cache: bool = True) -> dict:
+        """
+        Internal pure method to run analysis for a single row.
+        Does NOT modify shared state (checklist_df).
+        Returns parsed result dictionary. With `use_cache=False` the row is analyzed
+        again even if a cached result exists, and the cached result is refreshed.
+        """
+        if not self.target_doc_info:
+            raise ValueError("No target documents loaded")
+
+        key = self._row_result_key(row_index, question) if self.result_cache is not None else None
+        if key and use_cache:
+            cached = self.result_cache.get(key)
+            if cached:
+                logger.info(f"[Row {row_index}] Reusing cached result")
+                return cached
+
+        user_id = self.session_user_id
+        session_id = self._row_session_id(row_index)
+        
+        # Ensure session exists, without the history of a previous analysis of the row
+        self._get_or_create_session(user_id, session_id, reset=True)
+
+        content = self._row_message(row_index, question)
+        usage = SessionUsage()
+        usage.add(content)
         
         final_response = ""
         current_agent = None
         
-        for event in events:
-            if event.content and event.content.parts:
-                try:
-                    text = event.content.parts[0].text
-                    if text:
-                        author = getattr(event, 'author', 'unknown')
-                        # Logging in threads can be interleaved, but Logger is thread-safe enough for now
-                        if author != current_agent and author != 'user':
-                            current_agent = author
-                            if 'Librarian' in author or 'librarian' in author.lower():
-                                logger.info(f"[Row {row_index}] 📚 LIBRARIAN OUTPUT:\n{text[:200]}...")
-                            elif 'Auditor' in author or 'auditor' in author.lower():
-                                logger.info(f"[Row {row_index}] ⚖️ AUDITOR OUTPUT:\n{text[:200]}...")
-                except Exception:
-                    pass
-
-            if event.is_final_response() and event.content:
-                final_response = event.content.parts[0].text
+        try:
+            # Run Synchronously (this thread will block here waiting for API)
+            events = self.runner.run(
+                user_id=user_id, 
+                session_id=session_id, 
+                new_message=content
+            )
+            
+            for event in events:
+                usage.add(event)
+                current_agent = self._log_row_event(row_index, event, current_agent)
+                if event.is_final_response() and event.content:
+                    final_response = event.content.parts[0].text
+        finally:
+            self._release_session(user_id, session_id, usage.bytes)
         
         # Parse structured response
-        return self._parse_response(final_response)
+        parsed = self._parse_response(final_response)
+        if key and self._is_cacheable(parsed):
+            self.result_cache.put(key, parsed)
+        return parsed
+
+    async def _aprocess_single_row(self, row_index: int, question: str) -> dict:
+        """
+        Async counterpart of `_process_single_row`, run on the caller's event loop.
+        Does NOT modify shared state (checklist_df).
+        Returns parsed result dictionary.
+        """
+        if not self.target_doc_info:
+            raise ValueError("No target documents loaded")
+
+        key = self._row_result_key(row_index, question) if self.result_cache is not None else None
+        if key:
+            cached = await self.result_cache.aget(key)
+            if cached:
+                return cached
+
+        user_id = self.session_user_id
+        session_id = self._row_session_id(row_index)
+        content = self._row_message(row_index, question)
+
+        final_response = ""
+        current_agent = None
+
+        # Each analysis starts from an empty session (no history of previous analyses)
+        async with self.session_manager.use(user_id, session_id, self._session_state(), reset=True) as usage:
+            usage.add(content)
+            async for event in self.runner.run_async(
+                user_id=user_id, 
+                session_id=session_id, 
+                new_message=content
+            ):
+                usage.add(event)
+                current_agent = self._log_row_event(row_index, event, current_agent)
+                if event.is_final_response() and event.content:
+                    final_response = event.content.parts[0].text
+
+        # Parse structured response
+        parsed = self._parse_response(final_response)
+        if key and self._is_cacheable(parsed):
+            await self.result_cache.aput(key, parsed)
+        return parsed
+
+    async def _aprocess_packed_rows(self, row_indices: List[int]) -> Dict[int, dict]:
+        """
+        Analyzes several rows with a single request (see `_packed_message`).
+        Does NOT modify shared state (checklist_df).
+        Returns {row index: parsed result} for the items answered in a usable form.
+        """
+        if not self.target_doc_info:
+            raise ValueError("No target documents loaded")
+
+        user_id = self.session_user_id
+        session_id = self._pack_session_id(row_indices)
+        content = self._packed_message(row_indices)
+
+        final_response = ""
+        current_agent = None
+
+        async with self.session_manager.use(user_id, session_id, self._session_state(), reset=True) as usage:
+            usage.add(content)
+            async for event in self.runner.run_async(
+                user_id=user_id, 
+                session_id=session_id, 
+                new_message=content
+            ):
+                usage.add(event)
+                current_agent = self._log_row_event(row_indices[0], event, current_agent)
+                if event.is_final_response() and event.content:
+                    final_response = event.content.parts[0].text
+
+        results = self._split_packed_response(final_response, row_indices)
+        if self.result_cache is not None:
+            for idx, parsed in results.items():
+                if self._is_cacheable(parsed):
+                    await self.result_cache.aput(self._row_result_key(idx, self.get_question_from_row(idx), packed=True), parsed)
+        return results
 
     def analyze_row(self, row_index: int, question: str) -> str:
         """
@@ -507,15 +1672,11 @@ Be conversational and helpful. If you need to search the documents, do so and pr
         logger.info(f"Analyzing row {row_index}", question[:100])
         
         try:
-            parsed = self._process_single_row(row_index, question)
+            # An explicit analysis asks for a fresh answer: bypass (and refresh) the result cache
+            parsed = self._process_single_row(row_index, question, use_cache=False)
             
             # Update DataFrame
-            self.checklist_df.at[row_index, 'Risposta'] = parsed['risposta']
-            self.checklist_df.at[row_index, 'Original_Risposta'] = parsed['risposta'] # Store original AI answer
-            self.checklist_df.at[row_index, 'Confidenza'] = parsed['confidenza']
-            self.checklist_df.at[row_index, 'Giustificazione'] = parsed['giustificazione']
-            self.checklist_df.at[row_index, 'Status'] = 'DRAFT'
-            self.checklist_df.at[row_index, 'Manually_Edited'] = False # Reset edit flag
+            self._apply_row_result(row_index, parsed)
             
             logger.success(f"Row {row_index} analyzed", f"Answer: {parsed['risposta']}, Confidence: {parsed['confidenza']}")
             return parsed['giustificazione'] # Return text for backward compatibility
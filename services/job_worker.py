@@ -0,0 +1,126 @@
+"""
+Worker processes executing the batch analysis jobs of the local job queue.
+
+    python -m services.job_worker --workers 4
+
+Each worker process owns a ComplianceService, claims queued jobs, restores the
+submitted checklist and documents and runs `batch_analyze`, appending every result
+to the queue as it completes. The Streamlit app starts JOB_WORKERS of them itself.
+
+Each process has its own rate limiter: the GEMINI_RPM / GEMINI_TPM budgets are
+divided between the workers, so together they stay within the configured quota.
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+
+from utils.cancellation import CancellationToken
+from utils.job_queue import CANCELLED, DEFAULT_QUEUE_PATH, JobQueue
+from utils.logger import logger
+
+# Seconds between two checks of a running job: cancellation, then heartbeat (rows can take minutes)
+WATCH_SECONDS = 5
+POLL_SECONDS = 1.0
+
+
+def run_job(service, queue: JobQueue, job: dict):
+    """
+    Runs one claimed job on `service`. The job id is also the batch run id: a job taken
+    over from a dead worker resumes its run journal instead of starting over.
+    """
+    job_id = job["id"]
+    service.restore_state(job["payload"])
+    # Cancelling the job in the queue stops its rows in flight, not just the next ones
+    token = CancellationToken()
+    if job.get("resumed") and service.run_journal is not None and service.run_journal.exists(job_id):
+        logger.info(f"Resuming job {job_id}")
+        results = service.resume_batch(job_id, cancel_token=token)
+    else:
+        logger.info(f"Starting job {job_id}", f"Params: {job['params']}")
+        results = service.batch_analyze(run_id=job_id, cancel_token=token, **job["params"])
+
+    stop_watching = threading.Event()
+
+    def _watch():
+        while not stop_watching.wait(WATCH_SECONDS):
+            if queue.get(job_id)["status"] == CANCELLED:
+                token.cancel("Job cancelled")
+                return
+            queue.heartbeat(job_id)
+    threading.Thread(target=_watch, daemon=True).start()
+
+    completed = None  # Rows already in the queue, read once when the first journaled result is replayed
+    try:
+        for result in results:
+            if result.get("resumed"):
+                # Journaled by the previous worker: already in the queue unless it died in between
+                if completed is None:
+                    completed = queue.completed_rows(job_id)
+                if result["index"] not in completed:
+                    queue.add_result(job_id, result)
+                continue
+            if "status" not in result and result.get("error"):
+                queue.finish(job_id, error=result["error"])
+                return
+            if result["status"] == "cancelled":
+                logger.warning(f"Job {job_id} stopped", result["message"])
+                queue.finish(job_id, error=result["message"])  # A cancelled job stays cancelled
+                return
+            queue.add_result(job_id, result)
+        queue.finish(job_id)
+    finally:
+        results.close()  # Stops the rows still running if the job ended early
+        stop_watching.set()
+
+
+def share_rate_budget(workers: int):
+    """Sets this process's GEMINI_RPM / GEMINI_TPM to its share of the budgets of `workers` processes."""
+    for name in ("GEMINI_RPM", "GEMINI_TPM"):
+        budget = int(os.environ.get(name, 0))
+        if budget and workers > 1:
+            os.environ[name] = str(max(1, budget // workers))
+
+
+def worker_loop(worker_id: str, queue_path: str = DEFAULT_QUEUE_PATH, poll_seconds: float = POLL_SECONDS,
+                workers: int = 1):
+    """Claims and runs jobs forever, with 1/`workers` of the rate budgets."""
+    from services.compliance_service import ComplianceService  # Loads .env
+
+    share_rate_budget(workers)
+    service = ComplianceService(auth_mode=os.environ.get("AUTH_MODE", "ADC"))
+    queue = JobQueue(queue_path)
+    logger.info(f"Job worker {worker_id} ready", f"Queue: {queue_path}")
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            time.sleep(poll_seconds)
+            continue
+        try:
+            run_job(service, queue, job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed", str(e))
+            queue.finish(job["id"], error=str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run batch analysis job workers")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("JOB_WORKERS", 2)))
+    parser.add_argument("--queue", default=os.environ.get("JOB_QUEUE_PATH", DEFAULT_QUEUE_PATH))
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS)
+    args = parser.parse_args(argv)
+
+    # Separate processes (not threads): each worker has its own interpreter and event loop
+    context = multiprocessing.get_context("spawn")
+    workers = max(1, args.workers)
+    processes = [context.Process(target=worker_loop, args=(f"{os.getpid()}-{i}", args.queue, args.poll, workers), daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
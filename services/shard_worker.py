@@ -0,0 +1,118 @@
+"""
+Worker processes executing the shards of sharded batch runs (see
+ComplianceService.submit_sharded_batch), on as many nodes as needed:
+
+    python -m services.shard_worker --coordinator /shared/shards.sqlite --workers 4
+
+GEMINI_RPM / GEMINI_TPM are divided between the worker processes of a node: set them
+on each node to that node's share of the project quota.
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from services.job_worker import share_rate_budget
+from utils.cancellation import CancellationToken
+from utils.logger import logger
+from utils.shard_coordinator import DEFAULT_COORDINATOR_PATH, ShardCoordinator, SQLiteShardCoordinator
+
+POLL_SECONDS = 2.0
+
+
+def run_shard(service, coordinator: ShardCoordinator, worker: str, shard: dict, params: dict) -> bool:
+    """
+    Analyzes the rows of a leased shard, renewing the lease meanwhile, and reports its
+    results. Stops early and returns False if the lease is lost to another worker.
+    """
+    run_id, number, rows = shard["run_id"], shard["shard"], shard["row_indices"]
+    # The shard's rows may have been analyzed here under an earlier, lost lease
+    service.checklist_df.loc[rows, 'Status'] = 'PENDING'
+    # Losing the lease stops the shard's rows in flight: another worker redoes them
+    lost = CancellationToken()
+    done = threading.Event()
+
+    def _renew():
+        interval = getattr(coordinator, "lease_seconds", 300) / 3
+        while not done.wait(interval):
+            if not coordinator.renew(run_id, number, worker):
+                lost.cancel("Lease lost")
+                return
+    threading.Thread(target=_renew, daemon=True).start()
+
+    results = {}
+    batch = service.batch_analyze(row_indices=rows, cancel_token=lost, **params)
+    try:
+        for result in batch:
+            if lost.cancelled:
+                logger.warning(f"Lease of shard {number} of {run_id} lost", "Another worker takes it over")
+                return False
+            if result.get("status") == "cancelled":
+                return False  # Batch deadline: the lease expires and the shard is retried
+            if result.get("status") in ("success", "error"):
+                results[result["index"]] = result
+    finally:
+        batch.close()
+        done.set()
+    return coordinator.complete(run_id, number, worker, results)
+
+
+def run_shards(service, coordinator: ShardCoordinator, worker: str, run_id: str = None,
+               exit_when_idle: bool = False, poll_seconds: float = POLL_SECONDS) -> int:
+    """Leases and runs shards (of `run_id`, or of any run) until none is left with `exit_when_idle`. Returns the shards completed."""
+    loaded_run, params, completed = None, {}, 0
+    while True:
+        shard = coordinator.lease(worker, run_id)
+        if shard is None:
+            if exit_when_idle:
+                return completed
+            time.sleep(poll_seconds)
+            continue
+        try:
+            if shard["run_id"] != loaded_run:
+                info = coordinator.run_info(shard["run_id"])
+                service.restore_state(info["payload"])
+                loaded_run, params = shard["run_id"], info["params"]
+            logger.info(f"Shard {shard['shard']} of {shard['run_id']} leased",
+                        f"{len(shard['row_indices'])} rows, attempt {shard['attempt']}")
+            completed += run_shard(service, coordinator, worker, shard, params)
+        except Exception as e:
+            # The lease expires and another worker retries the shard
+            logger.error(f"Shard {shard['shard']} of {shard['run_id']} failed", str(e))
+            loaded_run = None
+
+
+def worker_loop(worker: str, coordinator_path: str, run_id: str = None, exit_when_idle: bool = False,
+                workers: int = 1):
+    """Leases and runs shards, with 1/`workers` of the rate budgets."""
+    from services.compliance_service import ComplianceService  # Loads .env
+
+    share_rate_budget(workers)
+    service = ComplianceService(auth_mode=os.environ.get("AUTH_MODE", "ADC"))
+    run_shards(service, SQLiteShardCoordinator(coordinator_path), worker, run_id, exit_when_idle)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run sharded batch analysis workers")
+    parser.add_argument("--coordinator", default=os.environ.get("SHARD_COORDINATOR_PATH", DEFAULT_COORDINATOR_PATH))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SHARD_WORKERS", 2)))
+    parser.add_argument("--run-id", default=None, help="Only work on this run")
+    parser.add_argument("--exit-when-idle", action="store_true", help="Stop when no shard is left")
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    node = socket.gethostname()
+    workers = max(1, args.workers)
+    processes = [context.Process(target=worker_loop, args=(f"{node}-{os.getpid()}-{i}", args.coordinator,
+                                                           args.run_id, args.exit_when_idle, workers))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
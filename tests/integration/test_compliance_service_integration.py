@@ -1,8 +1,10 @@
 import unittest
 import pandas as pd
 import os
+import tempfile
 from unittest.mock import MagicMock, patch, AsyncMock
 from services.compliance_service import ComplianceService
+from utils.uri_cache import PersistentURICache
 from google.genai import Client, types
 from google.adk.agents import LlmAgent, SequentialAgent
 from google.adk.runners import InMemoryRunner
@@ -13,8 +15,20 @@ class TestComplianceServiceIntegration(unittest.TestCase):
 
     def setUp(self):
         # Patch environment variables for API_KEY auth mode
-        self.patcher_env = patch.dict(os.environ, {'AUTH_MODE': 'API_KEY', 'GOOGLE_API_KEY': 'TEST_KEY'})
+        self.patcher_env = patch.dict(os.environ, {'AUTH_MODE': 'API_KEY', 'GOOGLE_API_KEY': 'TEST_KEY', 'RESULT_CACHE_MAX_AGE_DAYS': '0', 'RUN_JOURNAL_DIR': '',
+                                                   'GEMINI_GC_INTERVAL_SECONDS': '0'})
         self.patcher_env.start()
+        # Keep the upload cache, ledger, blobs and SQLite files out of the real .gemini_cache,
+        # and the garbage collection thread off
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.patcher_uri_cache = patch('services.compliance_service.get_uri_cache',
+                                       return_value=PersistentURICache(self.cache_dir.name))
+        self.patcher_uri_cache.start()
+        self.addCleanup(self.patcher_uri_cache.stop)
+        gc_patcher = patch('services.compliance_service.FileLifecycleManager.start_gc_schedule')
+        gc_patcher.start()
+        self.addCleanup(gc_patcher.stop)
         
         # Patch google.genai.Client globally
         self.patcher_genai_client = patch('services.compliance_service.Client', autospec=True)
@@ -155,7 +169,7 @@ class TestComplianceServiceIntegration(unittest.TestCase):
         self.assertIn("No target documents loaded", response)
         self.mock_runner_instance.run.assert_not_called()
 
-        @patch('services.compliance_service.ComplianceService._process_single_row')
+        @patch('services.compliance_service.ComplianceService._aprocess_single_row', new_callable=AsyncMock)
         def test_batch_analyze_success(self, mock_process_single_row):
             # Configure mock_process_single_row to return structured response for each call
             def mock_process_single_row_side_effect(row_idx, question):
@@ -174,7 +188,7 @@ class TestComplianceServiceIntegration(unittest.TestCase):
             self.assertEqual(len(processed_results), 2)
             self.assertEqual(mock_process_single_row.call_count, 2)
     
-            # Verify final DataFrame state (implicitly updated by service.batch_analyze calling _process_single_row)
+            # Verify final DataFrame state (implicitly updated by service.batch_analyze calling _aprocess_single_row)
             self.assertEqual(self.service.checklist_df.at[0, 'Risposta'], 'Sì')
             self.assertEqual(self.service.checklist_df.at[0, 'Original_Risposta'], 'Sì')
             self.assertEqual(self.service.checklist_df.at[1, 'Risposta'], 'No')
@@ -199,7 +213,7 @@ class TestComplianceServiceIntegration(unittest.TestCase):
             self.assertIn("No target documents loaded", result['error'])
             self.mock_runner_instance.run.assert_not_called()
     
-        @patch('services.compliance_service.ComplianceService._process_single_row')
+        @patch('services.compliance_service.ComplianceService._aprocess_single_row', new_callable=AsyncMock)
         def test_batch_analyze_skips_processed(self, mock_process_single_row):
             self.service.checklist_df.at[0, 'Status'] = 'APPROVED' # Mark first item as processed
     
@@ -49,5 +49,25 @@ class TestAgentCreation(unittest.TestCase):
         self.assertIs(orchestrator.sub_agents[0], mock_librarian_agent)
         self.assertIs(orchestrator.sub_agents[1], mock_auditor_agent)
 
+    def test_create_orchestrator_agent_replace_mode(self):
+        orchestrator = create_orchestrator_agent(librarian_mode="replace")
+        self.assertEqual([agent.name for agent in orchestrator.sub_agents], ["Auditor"])
+        self.assertIn("LOCAL RETRIEVAL MODE", orchestrator.sub_agents[0].instruction)
+
+    def test_create_orchestrator_agent_prefeed_mode(self):
+        orchestrator = create_orchestrator_agent(librarian_mode="prefeed")
+        self.assertEqual([agent.name for agent in orchestrator.sub_agents], ["Librarian", "Auditor"])
+        self.assertIn("PRE-RETRIEVED PASSAGES", orchestrator.sub_agents[0].instruction)
+        self.assertNotIn("LOCAL RETRIEVAL MODE", orchestrator.sub_agents[1].instruction)
+
+    def test_create_orchestrator_agent_passes_model_callback(self):
+        callback = MagicMock(return_value=None)
+        orchestrator = create_orchestrator_agent(before_model_callback=callback)
+        self.assertTrue(all(agent.before_model_callback is callback for agent in orchestrator.sub_agents))
+
+    def test_create_orchestrator_agent_invalid_mode(self):
+        with self.assertRaisesRegex(ValueError, "Unsupported librarian mode"):
+            create_orchestrator_agent(librarian_mode="other")
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,17 +1,32 @@
 import unittest
+import json
+import tempfile
 import pandas as pd
 import os
 from unittest.mock import MagicMock, patch, mock_open
 from io import BytesIO
 from services.compliance_service import ComplianceService
+from utils.uri_cache import PersistentURICache
 from google.genai import Client
 from unittest.mock import AsyncMock
 
 class TestComplianceService(unittest.TestCase):
 
     def setUp(self):
-        self.patcher_env = patch.dict(os.environ, {'AUTH_MODE': 'API_KEY', 'GOOGLE_API_KEY': 'TEST_KEY'})
+        self.patcher_env = patch.dict(os.environ, {'AUTH_MODE': 'API_KEY', 'GOOGLE_API_KEY': 'TEST_KEY', 'RESULT_CACHE_MAX_AGE_DAYS': '0', 'RUN_JOURNAL_DIR': '',
+                                                   'GEMINI_GC_INTERVAL_SECONDS': '0'})
         self.patcher_env.start()
+        # Keep the upload cache, ledger, blobs and SQLite files out of the real .gemini_cache,
+        # and the garbage collection thread off
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.patcher_uri_cache = patch('services.compliance_service.get_uri_cache',
+                                       return_value=PersistentURICache(self.cache_dir.name))
+        self.patcher_uri_cache.start()
+        self.addCleanup(self.patcher_uri_cache.stop)
+        gc_patcher = patch('services.compliance_service.FileLifecycleManager.start_gc_schedule')
+        gc_patcher.start()
+        self.addCleanup(gc_patcher.stop)
         
         # Patch google.genai.Client globally for the test class to control its instantiation
         self.patcher_genai_client = patch('services.compliance_service.Client', autospec=True)
@@ -90,7 +105,8 @@ class TestComplianceService(unittest.TestCase):
             self.assertEqual(len(self.service.context_doc_info), 1)
             self.assertEqual(self.service.context_doc_info[0]['filename'], "test_context.pdf")
             self.assertEqual(self.service.context_doc_info[0]['uri'], "files/context_uri_1")
-            mock_load_document.assert_called_once_with(file_path)
+            mock_load_document.assert_called_once_with(file_path, display_name="test_context.pdf",
+                                                       content_hash=self.service.context_doc_info[0]["content_hash"])
             os.remove(file_path)
 
     def test_load_target_document(self):
@@ -109,10 +125,108 @@ class TestComplianceService(unittest.TestCase):
                 self.assertEqual(len(self.service.target_doc_info), 1)
                 self.assertEqual(self.service.target_doc_info[0]['filename'], "test_target.docx")
                 self.assertEqual(self.service.target_doc_info[0]['uri'], "files/target_uri_1")
-                mock_load_document.assert_called_once_with(file_path)
+                mock_load_document.assert_called_once_with(file_path, display_name="test_target.docx",
+                                                           content_hash=self.service.target_doc_info[0]["content_hash"])
                 os.remove(file_path)
 
 
+    def test_load_documents_registers_in_input_order(self):
+        import threading
+        import time as _time
+        paths = ["slow.pdf", "fast.txt", "broken.pdf"]
+        first_done = threading.Event()
+
+        def fake_upload(path):
+            if path == "slow.pdf":
+                first_done.wait(timeout=5)  # finishes after the others
+                return {"filename": path, "uri": "files/slow", "content_hash": "h_slow"}
+            if path == "broken.pdf":
+                _time.sleep(0.05)
+                first_done.set()
+                raise RuntimeError("upload failed")
+            return {"filename": path, "uri": "files/fast", "content_hash": "h_fast"}
+
+        with patch.object(self.service, '_upload_document', side_effect=fake_upload):
+            progress = list(self.service.load_documents(paths, kind="target", max_workers=3))
+
+        self.assertEqual([p["completed"] for p in progress], [1, 2, 3])
+        self.assertTrue(all(p["total"] == 3 for p in progress))
+        self.assertEqual(progress[-1]["filename"], "slow.pdf")
+        errors = [p for p in progress if p["status"] == "error"]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["filename"], "broken.pdf")
+        # Stable order: slow.pdf first even though it completed last; failed upload not registered
+        self.assertEqual([d["filename"] for d in self.service.target_doc_info], ["slow.pdf", "fast.txt"])
+
+    def test_repeated_loads_are_deduplicated_by_content(self):
+        loader = self.service.document_loader_factory.get_loader("dummy.pdf")
+        with patch.object(loader, 'load_document', return_value="files/context_uri_1") as mock_load_document:
+            for file_path in ("dup_a.pdf", "dup_b.pdf"):
+                with open(file_path, "w") as f:
+                    f.write("same content")
+            try:
+                self.service.load_context_document("dup_a.pdf")
+                self.service.load_context_document("dup_a.pdf")  # rerun
+                self.service.load_context_document("dup_b.pdf")  # same content, other name
+                self.service.load_target_document("dup_b.pdf")   # same content, other role
+            finally:
+                os.remove("dup_a.pdf")
+                os.remove("dup_b.pdf")
+
+        mock_load_document.assert_called_once_with("dup_a.pdf", display_name="dup_a.pdf",
+                                                   content_hash=self.service.context_doc_info[0]["content_hash"])
+        self.assertEqual(len(self.service.context_doc_info), 1)
+        self.assertEqual(len(self.service.target_doc_info), 1)
+        self.assertEqual(self.service.target_doc_info[0]['uri'], "files/context_uri_1")
+
+    def test_doc_info_setters_replace_role(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}, {"filename": "t.pdf", "uri": "u1"}]
+        self.assertEqual(self.service.target_doc_info, [{"filename": "t.pdf", "uri": "u1", "content_hash": "uri:u1"}])
+        self.service.target_doc_info = []
+        self.assertEqual(self.service.target_doc_info, [])
+        self.assertEqual(len(self.service.document_registry), 0)
+
+    def test_load_document_from_memory(self):
+        from io import BytesIO
+        uploaded_file = BytesIO(b"in-memory policy")
+        uploaded_file.name = "policy.txt"
+        self.mock_genai_client_instance.files.upload.return_value = MagicMock(name="file_ref")
+        self.mock_genai_client_instance.files.upload.return_value.name = "files/mem_1"
+        self.service.document_loader_factory.uri_cache.clear()
+
+        uri = self.service.load_context_document(uploaded_file)
+        uri_from_bytes = self.service.load_target_document(b"raw target bytes", filename="target.txt")
+
+        self.assertEqual(uri, "files/mem_1")
+        self.assertEqual(uri_from_bytes, "files/mem_1")
+        self.assertEqual(self.service.context_doc_info[0]['filename'], "policy.txt")
+        self.assertEqual(self.service.target_doc_info[0]['filename'], "target.txt")
+        first_call = self.mock_genai_client_instance.files.upload.call_args_list[0]
+        self.assertIs(first_call.kwargs['file'], uploaded_file)
+        self.assertEqual(first_call.kwargs['config'].mime_type, "text/plain")
+        self.assertEqual(first_call.kwargs['config'].display_name, "policy.txt")
+        self.assertFalse(os.path.exists("temp_policy.txt"))
+
+    def test_load_bytes_requires_filename(self):
+        with self.assertRaisesRegex(ValueError, "filename is required"):
+            self.service.load_target_document(b"raw bytes")
+
+    def test_retrieved_passages_only_outside_llm_mode(self):
+        self.service.target_doc_info = [{"filename": "t.txt", "uri": "u1", "content_hash": "h_t"}]
+        self.service.retrieval_index.add_document("h_t", "t.txt", [("Paragraphs 2", "Access reviews happen quarterly.")])
+
+        self.service.librarian_mode = "llm"
+        self.assertEqual(self.service._retrieved_passages("access reviews"), "")
+
+        self.service.librarian_mode = "replace"
+        block = self.service._retrieved_passages("access reviews")
+        self.assertIn('[Target] Filename: "t.txt", Paragraphs 2', block)
+        self.assertIn("Access reviews happen quarterly.", block)
+
+    def test_load_documents_rejects_unknown_kind(self):
+        with self.assertRaisesRegex(ValueError, "Unsupported document kind"):
+            list(self.service.load_documents(["a.pdf"], kind="other"))
+
     @patch('pandas.read_excel')
     def test_load_checklist_excel_default_cols(self, mock_read_excel):
         # Create a dummy Excel file data
@@ -296,6 +410,29 @@ class TestComplianceService(unittest.TestCase):
         self.assertEqual(result['risposta'], 'Sì')
         self.assertEqual(result['confidenza'], 100)
         
+    def test_process_single_row_lists_only_routed_documents(self):
+        self.service.router_top_k = 1
+        self.service.target_doc_info = [
+            {"filename": "passwords.txt", "uri": "u1", "content_hash": "h1"},
+            {"filename": "backups.txt", "uri": "u2", "content_hash": "h2"},
+        ]
+        self.service.retrieval_index.add_document("h1", "passwords.txt", [("Paragraphs 1", "Passwords are rotated every 90 days.")])
+        self.service.retrieval_index.add_document("h2", "backups.txt", [("Paragraphs 1", "Backups run nightly and are kept one year.")])
+        self.service.checklist_df.at[0, 'Question'] = 'Are passwords rotated?'
+        self.service.checklist_df.at[0, 'Description'] = ''
+
+        mock_event = MagicMock()
+        mock_event.is_final_response.return_value = True
+        mock_event.content.parts = [MagicMock(text="**RISPOSTA:** Sì")]
+        self.service.runner.run.return_value = [mock_event]
+
+        self.service._process_single_row(0, 'Are passwords rotated?')
+
+        prompt = self.service.runner.run.call_args.kwargs['new_message'].parts[0].text
+        self.assertIn('passwords.txt', prompt)
+        self.assertNotIn('backups.txt', prompt)
+        self.assertIn('1 other loaded documents omitted', prompt)
+
     def test_process_single_row_no_target_documents(self):
         self.service.target_doc_info = []
         with self.assertRaisesRegex(ValueError, "No target documents loaded"):
@@ -317,8 +454,8 @@ class TestComplianceService(unittest.TestCase):
         self.service.question_column = 'Question'
         self.service.target_doc_info = [{"filename": "t.pdf", "uri": "existing_uri"}]
         
-        # Mock _process_single_row (the actual logic)
-        self.service._process_single_row = MagicMock(return_value={
+        # Mock _aprocess_single_row (the actual logic)
+        self.service._aprocess_single_row = AsyncMock(return_value={
             'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'
         })
         
@@ -327,11 +464,768 @@ class TestComplianceService(unittest.TestCase):
         
         # Verify
         self.assertEqual(len(results), 3) # Should yield 3 results
-        self.assertEqual(self.service._process_single_row.call_count, 3)
+        self.assertEqual(self.service._aprocess_single_row.await_count, 3)
         # Check if DataFrame was updated
         self.assertEqual(self.service.checklist_df.at[0, 'Risposta'], 'Sì')
         self.assertEqual(self.service.checklist_df.at[0, 'Original_Risposta'], 'Sì')
         self.assertFalse(self.service.checklist_df.at[0, 'Manually_Edited'])
 
+    def test_record_citations_matches_cited_filenames(self):
+        self.service.context_doc_info = [{"filename": "policy.pdf", "uri": "c1", "content_hash": "hc"}]
+        self.service.target_doc_info = [
+            {"filename": "contract.docx", "uri": "t1", "content_hash": "ht1"},
+            {"filename": "annex.pdf", "uri": "t2", "content_hash": "ht2"},
+        ]
+        self.service._record_citations(0, "- Fonte Context: policy.pdf, Pagina 3\n- Fonte Target: contract, Sezione 2")
+        self.service._record_citations(1, "- Fonte: Nessuna")
+
+        self.assertEqual(self.service.row_citations[0], {"hc": "policy.pdf", "ht1": "contract.docx"})
+        # No recognizable citation: the row depends on every document it was given
+        self.assertEqual(set(self.service.row_citations[1]), {"hc", "ht1", "ht2"})
+        self.assertEqual(self.service.affected_rows("annex.pdf"), [1])
+        self.assertEqual(self.service.affected_rows("hc"), [0, 1])
+
+    def test_reanalyze_affected_reruns_only_dependent_rows(self):
+        self.service.target_doc_info = [
+            {"filename": "a.pdf", "uri": "u1", "content_hash": "ha"},
+            {"filename": "b.pdf", "uri": "u2", "content_hash": "hb"},
+        ]
+        self.service.checklist_df['Status'] = ['DRAFT', 'DRAFT']
+        self.service.row_citations = {0: {"ha": "a.pdf"}, 1: {"hb": "b.pdf"}}
+        self.service._aprocess_single_row = AsyncMock(return_value={
+            'risposta': 'No', 'confidenza': 80, 'giustificazione': '- Fonte Target: b.pdf, Pagina 1'
+        })
+
+        results = list(self.service.reanalyze_affected("a.pdf"))
+
+        self.assertEqual([r["index"] for r in results], [0])
+        self.service._aprocess_single_row.assert_awaited_once_with(0, 'Q1')
+        self.assertEqual(self.service.checklist_df.at[0, 'Status'], 'DRAFT')
+        self.assertEqual(self.service.row_citations[0], {"hb": "b.pdf"})
+        with self.assertRaisesRegex(ValueError, "Unknown document"):
+            list(self.service.reanalyze_affected("missing.pdf"))
+
+    def test_replace_document_unloads_previous_version(self):
+        self.service.target_doc_info = [{"filename": "policy.txt", "uri": "files/old", "content_hash": "old_hash"}]
+        self.service.row_citations = {1: {"old_hash": "policy.txt"}}
+        mock_loader = MagicMock()
+        mock_loader.content_hash.return_value = "new_hash"
+        mock_loader.load_document.return_value = "files/new"
+        mock_loader.extract_passages.return_value = []
+        self.service.document_loader_factory.get_loader = MagicMock(return_value=mock_loader)
+
+        uri = self.service.replace_document("policy.txt", b"new content")
+
+        self.assertEqual(uri, "files/new")
+        self.assertEqual([d["content_hash"] for d in self.service.target_doc_info], ["new_hash"])
+        self.assertEqual(self.service.affected_rows("old_hash"), [1])
+        self.assertEqual(self.service.affected_rows("policy.txt"), [1])
+
+    def test_model_requests_reference_the_context_cache(self):
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import types
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "files/t", "content_hash": "h1"}]
+        self.service.context_cache = MagicMock()
+        self.service.context_cache.get.return_value = "cachedContents/1"
+        request = LlmRequest(model="gemini", config=types.GenerateContentConfig(system_instruction="You are The Auditor"))
+
+        import asyncio
+        self.assertIsNone(asyncio.run(self.service._attach_context_cache(MagicMock(agent_name="Auditor"), request)))
+
+        self.assertEqual(request.config.cached_content, "cachedContents/1")
+        self.assertIsNone(request.config.system_instruction)
+        args = self.service.context_cache.get.call_args.args
+        self.assertEqual(args[:3], ("Auditor", "gemini", "You are The Auditor"))
+        self.assertEqual(args[4], self.service.document_registry.version)
+
+    def test_request_retried_uncached_when_its_context_cache_is_gone(self):
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import errors, types
+        import asyncio
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "files/t", "content_hash": "h1"}]
+        self.service.context_cache = MagicMock()
+        self.service.context_cache.get.return_value = "cachedContents/1"
+        attached = []
+
+        async def request():
+            llm_request = LlmRequest(model="gemini", config=types.GenerateContentConfig(system_instruction="x"))
+            await self.service._attach_context_cache(MagicMock(agent_name="Auditor"), llm_request)
+            attached.append(llm_request.config.cached_content)
+            if llm_request.config.cached_content:
+                raise errors.ClientError(404, {"error": {"message": "CachedContent not found", "status": "NOT_FOUND"}})
+            return "answer"
+
+        self.assertEqual(asyncio.run(self.service._with_context_cache_fallback(request)), "answer")
+        self.assertEqual(attached, ["cachedContents/1", None])
+        self.service.context_cache.invalidate.assert_called_once_with()
+
+    def test_model_requests_wait_for_rate_limiter_capacity(self):
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import types
+        import asyncio
+        self.service.rate_limiter = MagicMock(enabled=True)
+        self.service.rate_limiter.aacquire = AsyncMock(return_value=0.0)
+        request = LlmRequest(model="gemini", config=types.GenerateContentConfig(system_instruction="x" * 40,
+                                                                                max_output_tokens=10))
+
+        result = asyncio.run(self.service._acquire_model_capacity(MagicMock(agent_name="Auditor"), request))
+
+        self.assertIsNone(result)
+        self.service.rate_limiter.aacquire.assert_awaited_once_with(20)
+
+    def test_rate_limiter_counts_cached_documents(self):
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import types
+        import asyncio
+        self.service.rate_limiter = MagicMock(enabled=True)
+        self.service.rate_limiter.aacquire = AsyncMock(return_value=0.0)
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "files/t", "content_hash": "h1", "tokens": 3000}]
+        self.service.context_cache = MagicMock()
+        request = LlmRequest(model="gemini", config=types.GenerateContentConfig(cached_content="cachedContents/1",
+                                                                                max_output_tokens=10))
+
+        self.service.context_cache.token_count.return_value = None  # Not reported: registry estimate
+        asyncio.run(self.service._acquire_model_capacity(MagicMock(agent_name="Auditor"), request))
+        self.service.context_cache.token_count.return_value = 5000  # Counted by the API
+        asyncio.run(self.service._acquire_model_capacity(MagicMock(agent_name="Auditor"), request))
+
+        self.assertEqual([c.args[0] for c in self.service.rate_limiter.aacquire.await_args_list], [3010, 5010])
+
+    def test_context_cache_and_rate_limiter_cover_only_the_routed_documents(self):
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import types
+        import asyncio
+        policy = {"filename": "p.pdf", "uri": "files/p", "content_hash": "h1", "tokens": 1000}
+        contract = {"filename": "c.pdf", "uri": "files/c", "content_hash": "h2", "tokens": 3000}
+        self.service.context_doc_info, self.service.target_doc_info = [policy], [contract]
+        self.service._row_documents = {0: ([], [contract])}  # Row 0 routed to the contract only
+        self.service._row_documents_version = self.service.document_registry.version
+        self.service.context_cache = MagicMock()
+        self.service.context_cache.get.return_value = "cachedContents/1"
+        self.service.context_cache.token_count.return_value = None
+        self.service.rate_limiter = MagicMock(enabled=True)
+        self.service.rate_limiter.aacquire = AsyncMock(return_value=0.0)
+        self.service._row_message(0, "Q1")
+
+        async def call(session_id):
+            callback_context = MagicMock(agent_name="Auditor")
+            callback_context.session.id = session_id
+            request = LlmRequest(model="gemini", config=types.GenerateContentConfig(system_instruction="x", max_output_tokens=10))
+            await self.service._attach_context_cache(callback_context, request)
+            await self.service._acquire_model_capacity(callback_context, request)
+        asyncio.run(call("session_row_0"))
+        asyncio.run(call("chat_x_row_0"))  # Not a routed row: every document
+
+        self.assertEqual([c.args[3] for c in self.service.context_cache.get.call_args_list], [[contract], [policy, contract]])
+        self.assertEqual([c.args[0] for c in self.service.rate_limiter.aacquire.await_args_list], [3010, 4010])
+
+    def test_batch_restores_expired_documents_first(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "files/old", "content_hash": "h1"}]
+        self.service.file_lifecycle.start_validation = MagicMock()
+        self.service.file_lifecycle.start_validation.return_value.result.return_value = {"h1": {"name": "files/new"}}
+        self.service._aprocess_single_row = AsyncMock(return_value={
+            'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'
+        })
+
+        list(self.service.batch_analyze(row_indices=[0]))
+
+        self.service.file_lifecycle.start_validation.assert_called_once_with({"h1": "files/old"})
+        self.assertEqual(self.service.target_doc_info[0]["uri"], "files/new")
+
+    def test_documents_are_validated_once_while_nothing_changes(self):
+        self.service.file_lifecycle.start_validation = MagicMock()
+        self.service.file_lifecycle.start_validation.return_value.result.return_value = {"h1": {"name": "files/t"}}
+        info = {"filename": "t.pdf", "uri": "files/t", "content_hash": "h1"}
+        self.service._aprocess_single_row = AsyncMock(return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'})
+
+        with patch.object(self.service, '_upload_document', return_value=info):
+            for _ in range(3):  # Streamlit reruns load the same files again
+                list(self.service.load_documents(["t.pdf"], kind="target"))
+        list(self.service.batch_analyze(row_indices=[0]))
+        list(self.service.batch_analyze(row_indices=[1]))
+
+        self.service.file_lifecycle.start_validation.assert_called_once_with({"h1": "files/t"})
+        self.service.start_document_validation(force=True)
+        self.assertEqual(self.service.file_lifecycle.start_validation.call_count, 2)
+
+    def test_aprocess_single_row_uses_run_async(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        mock_event = MagicMock()
+        mock_event.is_final_response.return_value = True
+        mock_event.content.parts = [MagicMock(text="**RISPOSTA:** No\n**CONFIDENZA:** 70")]
+
+        async def fake_run_async(**kwargs):
+            yield mock_event
+        self.service.runner.run_async = MagicMock(side_effect=fake_run_async)
+
+        import asyncio
+        result = asyncio.run(self.service._aprocess_single_row(0, "Q1"))
+
+        self.assertEqual((result['risposta'], result['confidenza']), ('No', 70))
+        self.service.runner.run.assert_not_called()
+        self.service.session_service.create_session.assert_awaited_once()
+
+    def test_abatch_analyze_bounds_rows_in_flight(self):
+        import asyncio
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service.checklist_df = pd.concat([self.service.checklist_df] * 5, ignore_index=True)
+        in_flight, peak = 0, 0
+
+        async def fake_row(idx, question):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'}
+        self.service._aprocess_single_row = fake_row
+
+        async def collect():
+            return [result async for result in self.service.abatch_analyze(concurrency=3)]
+        results = asyncio.run(collect())
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(peak, 3)
+        self.assertTrue((self.service.checklist_df['Status'] == 'DRAFT').all())
+
+    def test_batch_retries_transient_row_failures(self):
+        from google.genai import errors
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service.retry_policy.base_delay = 0
+        outcomes = {
+            0: [errors.ServerError(503, {"error": {"code": 503, "message": "overloaded", "status": "UNAVAILABLE"}}),
+                {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'}],
+            1: [ValueError("Unparseable row")],
+        }
+
+        async def fake_row(idx, question):
+            outcome = outcomes[idx].pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        results = sorted(self.service.batch_analyze(row_indices=[0, 1], concurrency=1), key=lambda r: r["index"])
+
+        self.assertEqual([r["status"] for r in results], ["success", "error"])
+        self.assertEqual(self.service._aprocess_single_row.await_count, 3)  # Permanent error not retried
+        self.assertEqual(self.service.circuit_breaker.state, "closed")
+
+    def test_pack_rows_groups_by_category(self):
+        self.service.checklist_df['Category'] = ['A', 'B']
+        self.service.checklist_df = pd.concat([self.service.checklist_df] * 3, ignore_index=True)
+        self.service.category_column = 'Category'
+
+        self.assertEqual(self.service._pack_rows(list(range(6)), 2), [[0, 2], [4], [1, 3], [5]])
+        self.assertEqual(self.service._pack_rows(list(range(6)), 1), [[i] for i in range(6)])
+        self.service.category_column = None
+        self.assertEqual(self.service._pack_rows(list(range(6)), 4), [[0, 1, 2, 3], [4, 5]])
+
+    def test_split_packed_response(self):
+        response = """### ITEM 0
+**RISPOSTA:** Sì
+**CONFIDENZA:** 90%
+**GIUSTIFICAZIONE:**
+- Spiegazione: covered
+
+### ITEM 7
+**RISPOSTA:** No
+**CONFIDENZA:** 80%
+**GIUSTIFICAZIONE:** unknown row
+
+**ITEM 1**
+No structured answer here
+"""
+        results = self.service._split_packed_response(response, [0, 1])
+
+        self.assertEqual(list(results), [0])
+        self.assertEqual(results[0]['risposta'], 'Sì')
+        self.assertEqual(results[0]['confidenza'], 90)
+        self.assertEqual(results[0]['giustificazione'], '- Spiegazione: covered')
+
+    def test_packed_batch_falls_back_to_single_rows(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service._aprocess_packed_rows = AsyncMock(
+            return_value={0: {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Packed'}})
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'No', 'confidenza': 70, 'giustificazione': 'Single'})
+
+        results = sorted(self.service.batch_analyze(row_indices=[0, 1], pack_size=5), key=lambda r: r["index"])
+
+        self.assertEqual([r["status"] for r in results], ["success", "success"])
+        self.service._aprocess_packed_rows.assert_awaited_once_with([0, 1])
+        self.service._aprocess_single_row.assert_awaited_once_with(1, 'Q2')
+        self.assertEqual(list(self.service.checklist_df['Giustificazione']), ['Packed', 'Single'])
+
+    def test_batch_reuses_cached_results_without_agent_calls(self):
+        import tempfile
+        import shutil
+        from utils.result_cache import ResultCache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.service.result_cache = ResultCache(os.path.join(cache_dir, "results.sqlite"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        self.service.result_cache.put(self.service._row_result_key(0, 'Q1'),
+                                      {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Cached'})
+        self.service.runner.run_async = MagicMock(side_effect=AssertionError("no agent call expected"))
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'No', 'confidenza': 70, 'giustificazione': 'Fresh'})
+
+        results = list(self.service.batch_analyze(row_indices=[0, 1]))
+
+        self.assertEqual([(r["index"], r.get("cached", False)) for r in results], [(0, True), (1, False)])
+        self.service._aprocess_single_row.assert_awaited_once_with(1, 'Q2')
+        self.assertEqual(list(self.service.checklist_df['Giustificazione']), ['Cached', 'Fresh'])
+        # Another document set is another key
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u2", "content_hash": "h2"}]
+        self.assertIsNone(self.service.result_cache.get(self.service._row_result_key(0, 'Q1')))
+
+    def test_process_single_row_stores_and_reuses_results(self):
+        import tempfile
+        import shutil
+        from utils.result_cache import ResultCache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.service.result_cache = ResultCache(os.path.join(cache_dir, "results.sqlite"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        event = MagicMock()
+        event.is_final_response.return_value = True
+        event.content.parts = [MagicMock(text="**RISPOSTA:** Sì\n**CONFIDENZA:** 95%\n**GIUSTIFICAZIONE:** Found")]
+        self.service.runner.run = MagicMock(return_value=[event])
+
+        first = self.service._process_single_row(0, 'Q1')
+        second = self.service._process_single_row(0, 'Q1')
+
+        self.assertEqual(first, second)
+        self.assertEqual(second['risposta'], 'Sì')
+        self.service.runner.run.assert_called_once()
+
+    def test_result_cache_skips_unparsed_answers_and_explicit_analyses(self):
+        import tempfile
+        import shutil
+        from utils.result_cache import ResultCache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.service.result_cache = ResultCache(os.path.join(cache_dir, "results.sqlite"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        event = MagicMock()
+        event.is_final_response.return_value = True
+        event.content.parts = [MagicMock(text="The model went off script")]
+        self.service.runner.run = MagicMock(return_value=[event])
+
+        self.assertEqual(self.service._process_single_row(0, 'Q1')['risposta'], '?')
+        self.assertIsNone(self.service.result_cache.get(self.service._row_result_key(0, 'Q1')))
+
+        event.content.parts = [MagicMock(text="**RISPOSTA:** Sì\n**CONFIDENZA:** 95%\n**GIUSTIFICAZIONE:** Found")]
+        self.service._process_single_row(0, 'Q1')
+        event.content.parts = [MagicMock(text="**RISPOSTA:** No\n**CONFIDENZA:** 80%\n**GIUSTIFICAZIONE:** Revised")]
+        self.service.analyze_row(0, 'Q1')
+
+        self.assertEqual(self.service.runner.run.call_count, 3)  # analyze_row did not reuse the cached answer
+        self.assertEqual(self.service.checklist_df.at[0, 'Risposta'], 'No')
+        self.assertEqual(self.service.result_cache.get(self.service._row_result_key(0, 'Q1'))['risposta'], 'No')
+
+    def test_packed_answers_are_cached_apart_from_single_row_answers(self):
+        import asyncio
+        import tempfile
+        import shutil
+        from utils.result_cache import ResultCache
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.service.result_cache = ResultCache(os.path.join(cache_dir, "results.sqlite"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        self.service.session_manager.use = MagicMock(return_value=MagicMock(
+            __aenter__=AsyncMock(return_value=MagicMock()), __aexit__=AsyncMock(return_value=False)))
+
+        async def no_events(**kwargs):
+            return
+            yield
+        self.service.runner.run_async = no_events
+        self.service._split_packed_response = MagicMock(return_value={
+            0: {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Packed'},
+            1: {'risposta': '?', 'confidenza': 0, 'giustificazione': 'Unparsed'}})
+
+        asyncio.run(self.service._aprocess_packed_rows([0, 1]))
+
+        self.assertIsNone(self.service.result_cache.get(self.service._row_result_key(0, 'Q1')))
+        self.assertEqual(self.service.result_cache.get(self.service._row_result_key(0, 'Q1', packed=True))['giustificazione'], 'Packed')
+        self.assertIsNone(self.service.result_cache.get(self.service._row_result_key(1, 'Q2', packed=True)))
+        # Only a packed run reuses packed answers
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'No', 'confidenza': 70, 'giustificazione': 'Single'})
+        self.service._aprocess_packed_rows = AsyncMock(return_value={})
+        results = [r for r in self.service.batch_analyze(row_indices=[0], pack_size=5) if r.get("index") == 0]
+        self.assertEqual([(r["cached"], r["data"]["giustificazione"]) for r in results], [(True, 'Packed')])
+        self.service.checklist_df.at[0, 'Status'] = 'PENDING'
+        list(self.service.batch_analyze(row_indices=[0]))
+        self.service._aprocess_single_row.assert_awaited_once_with(0, 'Q1')
+
+    @patch('pandas.read_excel')
+    def test_load_checklist_clusters_duplicates(self, mock_read_excel):
+        mock_read_excel.return_value = pd.DataFrame({
+            'ID': ['1', '2', '3'],
+            'Question': ['Is data encrypted at rest?', 'Is there a backup policy?', 'Is data encrypted at rest ?'],
+        })
+        df = self.service.load_checklist("dummy.xlsx", cluster_duplicates=True)
+
+        self.assertEqual(self.service.duplicate_of, {2: 0})
+        self.assertIn('Derived_From', df.columns)
+        self.service.load_checklist("dummy.xlsx")
+        self.assertEqual(self.service.duplicate_of, {})
+
+    def test_batch_fans_out_to_near_duplicates(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service.checklist_df['Derived_From'] = ''
+        self.service.duplicate_of = {1: 0}
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Shared'})
+
+        results = list(self.service.batch_analyze(row_indices=[0, 1]))
+
+        self.service._aprocess_single_row.assert_awaited_once_with(0, 'Q1')
+        self.assertEqual([(r["index"], r["derived_from"]) for r in results], [(0, None), (1, 0)])
+        self.assertEqual(list(self.service.checklist_df['Risposta']), ['Sì', 'Sì'])
+        self.assertEqual(list(self.service.checklist_df['Derived_From']), ['', '1'])
+
+        # Re-analyzing the derived row on its own clears the mark
+        self.service.checklist_df.at[1, 'Status'] = 'PENDING'
+        list(self.service.batch_analyze(row_indices=[1]))
+        self.assertEqual(self.service.checklist_df.at[1, 'Derived_From'], '')
+
+    def test_batch_prepares_all_sessions_upfront(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service.session_manager.aprepare = AsyncMock(return_value=2)
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'})
+
+        list(self.service.batch_analyze(row_indices=[0, 1]))
+
+        args = self.service.session_manager.aprepare.await_args
+        self.assertEqual(args.args[:2], (self.service.session_user_id, ["session_row_0", "session_row_1"]))
+        self.assertTrue(args.kwargs["reset"])
+
+    def test_sessions_are_namespaced_per_instance_and_checklist(self):
+        with patch('services.compliance_service.create_orchestrator_agent'), \
+             patch('services.compliance_service.InMemoryRunner'):
+            other = ComplianceService(auth_mode="API_KEY")
+        self.assertNotEqual(other.session_user_id, self.service.session_user_id)
+
+        state = self.service.export_state()
+        self.service.restore_state(state)
+        chat = self.service._chat_session_id(0)
+        self.service.restore_state(state)
+        self.assertEqual(self.service._chat_session_id(0), chat)  # Same checklist, same chats
+        self.service.checklist_df.at[0, 'Question'] = 'Q1 revised'
+        self.service.restore_state(self.service.export_state())
+        self.assertNotEqual(self.service._chat_session_id(0), chat)
+        self.service.restore_state(state)
+        self.assertEqual(self.service._chat_session_id(0), chat)
+
+    def test_session_namespace_survives_restarts(self):
+        with patch.dict(os.environ, {'SESSION_NAMESPACE': 'audit-team'}), \
+             patch('services.compliance_service.create_orchestrator_agent'), \
+             patch('services.compliance_service.InMemoryRunner'):
+            first, restarted = ComplianceService(auth_mode="API_KEY"), ComplianceService(auth_mode="API_KEY")
+        self.assertEqual(first.session_user_id, "user_audit-team")
+        self.assertEqual(restarted.session_user_id, first.session_user_id)
+
+    def test_stale_sqlite_sessions_are_purged_at_startup(self):
+        with patch.dict(os.environ, {'SESSION_BACKEND': 'sqlite', 'SESSION_MAX_AGE_DAYS': '7'}), \
+             patch('services.compliance_service.create_orchestrator_agent'), \
+             patch('services.compliance_service.Runner'), \
+             patch('services.compliance_service.SQLiteSessionService.purge', return_value=0) as purge:
+            ComplianceService(auth_mode="API_KEY")
+        purge.assert_called_once_with(7 * 86400)
+
+    def test_interrupted_batch_resumes_missing_rows_only(self):
+        import tempfile
+        import shutil
+        from utils.run_journal import RunJournal
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir, ignore_errors=True)
+        self.service.run_journal = RunJournal(journal_dir)
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Journaled'})
+
+        # The process dies after the first row: only that row is in the journal
+        results = self.service.batch_analyze(row_indices=[0, 1], concurrency=1)
+        next(results)
+        results.close()
+        run_id = self.service.current_run_id
+        self.assertEqual(self.service.resumable_runs()[0]["completed"], 1)
+
+        # A restarted process reloads the same checklist and resumes the run
+        self.service.checklist_df['Status'] = 'PENDING'
+        self.service.checklist_df['Risposta'] = '?'
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'No', 'confidenza': 70, 'giustificazione': 'Resumed'})
+        results = list(self.service.resume_batch(run_id))
+
+        self.assertEqual([(r["index"], r.get("resumed", False)) for r in results], [(0, True), (1, False)])
+        self.service._aprocess_single_row.assert_awaited_once_with(1, 'Q2')
+        self.assertEqual(list(self.service.checklist_df['Giustificazione']), ['Journaled', 'Resumed'])
+        self.assertEqual(self.service.resumable_runs(), [])
+
+        # Another checklist cannot resume it
+        self.service.checklist_df.at[0, 'Question'] = 'Changed'
+        self.assertIn("error", list(self.service.resume_batch(run_id))[0])
+
+    def test_state_snapshot_round_trip(self):
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        self.service.retrieval_index.add_document("h1", "t.pdf", [("Page 1", "Data is encrypted at rest")])
+        self.service.duplicate_of = {1: 0}
+        state = json.loads(json.dumps(self.service.export_state()))
+        self.assertNotIn("encrypted", json.dumps(state))  # Passages are referenced, not copied
+
+        with patch('services.compliance_service.create_orchestrator_agent'), \
+             patch('services.compliance_service.InMemoryRunner'):
+            worker_service = ComplianceService(auth_mode="API_KEY")
+        worker_service.restore_state(state)
+
+        pd.testing.assert_frame_equal(worker_service.checklist_df, self.service.checklist_df)
+        self.assertEqual(worker_service.target_doc_info, self.service.target_doc_info)
+        self.assertEqual((worker_service.id_column, worker_service.question_column), ('ID', 'Question'))
+        self.assertEqual(worker_service.duplicate_of, {1: 0})
+        self.assertEqual(worker_service.retrieval_index.search("encrypted")[0]["location"], "Page 1")
+
+    def test_job_worker_streams_results_to_the_queue(self):
+        import tempfile
+        import shutil
+        from services.job_worker import run_job
+        from utils.job_queue import JobQueue
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir, ignore_errors=True)
+        queue = JobQueue(os.path.join(queue_dir, "jobs.sqlite"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        job_id = queue.submit({"row_indices": [0, 1], "concurrency": 2}, self.service.export_state(), total=2)
+        self.service._aprocess_single_row = AsyncMock(
+            return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Worker'})
+
+        run_job(self.service, queue, queue.claim("w1"))
+
+        self.assertEqual(queue.get(job_id)["status"], "done")
+        results = [result for _, result in queue.results(job_id)]
+        self.assertEqual(sorted(r["index"] for r in results), [0, 1])
+
+        # The web process applies the polled results to its own checklist
+        self.service.checklist_df['Status'] = 'PENDING'
+        self.assertTrue(all(self.service.apply_batch_result(result) for result in results))
+        self.assertEqual(list(self.service.checklist_df['Giustificazione']), ['Worker', 'Worker'])
+
+    def test_reclaimed_job_does_not_count_journaled_rows_twice(self):
+        import tempfile
+        import shutil
+        from services.job_worker import run_job
+        from utils.job_queue import JobQueue
+        from utils.run_journal import RunJournal
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        queue = JobQueue(os.path.join(tmp_dir, "jobs.sqlite"), stale_after=-1)
+        self.service.run_journal = RunJournal(os.path.join(tmp_dir, "runs"))
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        job_id = queue.submit({"row_indices": [0, 1], "concurrency": 2}, self.service.export_state(), total=2)
+        queue.claim("w1")
+        # The first worker journaled both rows, then died before queueing row 1
+        parsed = {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Worker'}
+        self.service.run_journal.start(job_id, [0, 1], {"concurrency": 2}, self.service._run_fingerprint())
+        for idx in (0, 1):
+            self.service.run_journal.record(job_id, idx, parsed)
+        queue.add_result(job_id, {"status": "success", "index": 0, "data": parsed})
+        self.service._aprocess_single_row = AsyncMock(side_effect=AssertionError("no row left to analyze"))
+
+        run_job(self.service, queue, queue.claim("w2"))
+
+        rows = [r["index"] for _, r in queue.results(job_id) if r.get("status") == "success"]
+        self.assertEqual(sorted(rows), [0, 1])
+        self.assertEqual(queue.get(job_id)["completed"], 2)
+
+    def test_job_workers_share_the_rate_budget(self):
+        from services.job_worker import share_rate_budget
+        with patch.dict(os.environ, {"GEMINI_RPM": "60", "GEMINI_TPM": "1000000"}):
+            share_rate_budget(4)
+            self.assertEqual((os.environ["GEMINI_RPM"], os.environ["GEMINI_TPM"]), ("15", "250000"))
+
+    def test_shard_workers_share_the_rate_budget(self):
+        from services import shard_worker
+        budgets = {}
+
+        def fake_service(auth_mode):
+            budgets.update(rpm=os.environ["GEMINI_RPM"], tpm=os.environ["GEMINI_TPM"])
+            return MagicMock()
+        with patch.dict(os.environ, {"GEMINI_RPM": "60", "GEMINI_TPM": "1000000"}), \
+             patch('services.compliance_service.ComplianceService', side_effect=fake_service), \
+             patch('services.shard_worker.SQLiteShardCoordinator'), \
+             patch('services.shard_worker.run_shards') as run_shards:
+            shard_worker.worker_loop("node-0", "shards.sqlite", exit_when_idle=True, workers=4)
+        run_shards.assert_called_once()
+        self.assertEqual(budgets, {"rpm": "15", "tpm": "250000"})
+
+    def test_sharded_batch_is_split_between_workers_and_merged(self):
+        import tempfile
+        import shutil
+        from services.shard_worker import run_shard, run_shards
+        from utils.shard_coordinator import SQLiteShardCoordinator
+        coordinator_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coordinator_dir, ignore_errors=True)
+        coordinator = SQLiteShardCoordinator(os.path.join(coordinator_dir, "shards.sqlite"))
+        self.service.checklist_df = pd.concat([self.service.checklist_df] * 3, ignore_index=True)
+        self.service.checklist_df['Question'] = [f'Q{i}' for i in range(6)]
+        self.service.checklist_df['Derived_From'] = ''
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1", "content_hash": "h1"}]
+        self.service.duplicate_of = {4: 1}
+        self.assertEqual(self.service.shard_rows(shard_size=2), [[0], [1, 4], [2, 3], [5]])  # Clusters are not split
+        self.assertEqual(self.service.shard_rows(shard_size=3), [[0, 1, 4], [2, 3, 5]])
+        run_id = self.service.submit_sharded_batch(coordinator, shard_size=3, concurrency=2)
+
+        # Two workers (normally processes on different nodes) share the shards
+        workers = {}
+        for name in ("node-a", "node-b"):
+            with patch('services.compliance_service.create_orchestrator_agent'), \
+                 patch('services.compliance_service.InMemoryRunner'):
+                worker = ComplianceService(auth_mode="API_KEY")
+            worker.session_service.get_session = AsyncMock(return_value=None)
+            worker.session_service.create_session = AsyncMock(return_value=None)
+            worker._aprocess_single_row = AsyncMock(
+                return_value={'risposta': 'Sì', 'confidenza': 90, 'giustificazione': name})
+            workers[name] = worker
+        shard_a = coordinator.lease("node-a", run_id)
+        workers["node-a"].restore_state(coordinator.run_info(run_id)["payload"])
+        self.assertEqual(run_shards(workers["node-b"], coordinator, "node-b", run_id, exit_when_idle=True), 1)
+        self.assertTrue(run_shard(workers["node-a"], coordinator, "node-a", shard_a, {"concurrency": 2}))
+
+        self.assertEqual(coordinator.progress(run_id)["done"], 2)
+        self.assertEqual(self.service.merge_sharded_results(coordinator, run_id), 6)
+        self.assertEqual(list(self.service.checklist_df['Giustificazione']), ['node-a', 'node-a', 'node-b', 'node-b', 'node-a', 'node-b'])
+        self.assertEqual(self.service.checklist_df.at[4, 'Derived_From'], '2')
+        self.assertEqual(workers["node-a"]._aprocess_single_row.await_count, 2)  # Row 4 reuses row 1
+
+    def test_hung_rows_fail_at_their_deadline_and_stay_pending(self):
+        import asyncio
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+
+        async def fake_row(idx, question):
+            if idx == 1:
+                await asyncio.sleep(30)  # Hung call
+            return {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'}
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        results = sorted(self.service.batch_analyze(row_indices=[0, 1], concurrency=2, row_timeout=0.2), key=lambda r: r["index"])
+
+        self.assertEqual([r["status"] for r in results], ["success", "error"])
+        self.assertIn("deadline", results[1]["error"])
+        self.assertEqual(self.service._aprocess_single_row.await_count, 2)  # Not retried
+        self.assertEqual(list(self.service.checklist_df['Status']), ['DRAFT', 'PENDING'])
+
+    def test_rows_past_their_deadline_give_back_their_rate_budget(self):
+        import asyncio
+        from google.adk.models.llm_request import LlmRequest
+        from google.genai import types
+        from utils.rate_limiter import TokenBucketLimiter
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        self.service.rate_limiter = TokenBucketLimiter(requests_per_minute=1, tokens_per_minute=100_000)
+
+        async def fake_row(idx, question):
+            request = LlmRequest(model="gemini", config=types.GenerateContentConfig(max_output_tokens=10_000))
+            await self.service._acquire_model_capacity(MagicMock(agent_name="Auditor"), request)
+            return {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'}
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        results = sorted(self.service.batch_analyze(row_indices=[0, 1], concurrency=1, row_timeout=0.2), key=lambda r: r["index"])
+
+        self.assertEqual([r["status"] for r in results], ["success", "error"])  # Row 1 waited for the next minute
+        self.assertIn("deadline", results[1]["error"])
+        limiter = self.service.rate_limiter
+        self.assertAlmostEqual(limiter._requests, 0.0, delta=0.05)  # Only row 0's request is spent
+        self.assertAlmostEqual(limiter._tokens, 90_000, delta=500)
+
+    def test_cancelled_batch_abandons_rows_in_flight(self):
+        import asyncio
+        import threading
+        from utils.cancellation import CancellationToken
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        started = threading.Event()
+
+        async def fake_row(idx, question):
+            if idx == 0:
+                return {'risposta': 'Sì', 'confidenza': 90, 'giustificazione': 'Test'}
+            started.set()
+            await asyncio.sleep(30)
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        token = CancellationToken()
+        threading.Thread(target=lambda: started.wait(5) and token.cancel("Stopped by user")).start()
+        results = list(self.service.batch_analyze(row_indices=[0, 1], concurrency=2, cancel_token=token))
+
+        self.assertEqual([r["status"] for r in results], ["success", "cancelled"])
+        self.assertEqual((results[-1]["message"], results[-1]["pending"]), ("Stopped by user", 1))
+        self.assertEqual(list(self.service.checklist_df['Status']), ['DRAFT', 'PENDING'])
+        self.assertIsNone(self.service.cancel_token)
+        self.assertFalse(self.service.cancel_batch())
+
+    def test_stopping_a_batch_finishes_rows_in_flight_before_closing_the_loop(self):
+        import asyncio
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+        started, cleaned = [], []
+
+        async def hung_run_async(**kwargs):
+            started.append(kwargs["session_id"])
+            try:
+                await asyncio.sleep(30)
+            finally:
+                await asyncio.sleep(0.05)  # Cleanup that awaits, e.g. a store flush
+                cleaned.append(kwargs["session_id"])
+            yield  # Never reached: makes this an async generator like the real runner
+        self.service.runner.run_async = MagicMock(side_effect=hung_run_async)
+
+        loops = []
+        real_new_event_loop = asyncio.new_event_loop
+
+        def new_event_loop():
+            loops.append(real_new_event_loop())
+            return loops[-1]
+        with patch('services.compliance_service.asyncio.new_event_loop', side_effect=new_event_loop):
+            results = self.service.batch_analyze(row_indices=[0, 1], concurrency=2, heartbeat_seconds=0.05)
+            while len(started) < 2:
+                self.assertEqual(next(results), {"status": "heartbeat"})
+            results.close()  # Stop click while both rows wait for the model
+
+        self.assertTrue(loops[0].is_closed())
+        self.assertEqual(asyncio.all_tasks(loops[0]), set())
+        self.assertEqual(sorted(cleaned), sorted(started))
+        self.assertFalse(any(entry["active"] for entry in self.service.session_manager._entries.values()))
+        self.assertEqual(list(self.service.checklist_df['Status']), ['PENDING', 'PENDING'])
+
+    def test_batch_deadline_stops_the_batch(self):
+        import asyncio
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+
+        async def fake_row(idx, question):
+            await asyncio.sleep(30)
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        results = list(self.service.batch_analyze(row_indices=[0, 1], concurrency=1, batch_timeout=0.2))
+
+        self.assertEqual(results, [{"status": "cancelled", "message": "Batch deadline exceeded", "pending": 2}])
+        self.assertEqual(self.service._aprocess_single_row.await_count, 1)  # The second row never started
+
+    def test_heartbeats_let_the_caller_stop_a_batch_while_rows_run(self):
+        import asyncio
+        import time
+        self.service.target_doc_info = [{"filename": "t.pdf", "uri": "u1"}]
+
+        async def fake_row(idx, question):
+            await asyncio.sleep(30)
+        self.service._aprocess_single_row = AsyncMock(side_effect=fake_row)
+
+        results = self.service.batch_analyze(row_indices=[0, 1], concurrency=2, heartbeat_seconds=0.05)
+        started = time.monotonic()
+        self.assertEqual(next(results), {"status": "heartbeat"})
+        results.close()  # The UI loop was interrupted by the Stop click
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(list(self.service.checklist_df['Status']), ['PENDING', 'PENDING'])
+        self.assertIsNone(self.service.cancel_token)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,29 @@
 import unittest
+import io
 import os
 import hashlib
+import zipfile
 from unittest.mock import patch, MagicMock
 from utils.logger import AppLogger, logger # Import both for singleton test
 from utils.document_loader import DocumentLoaderFactory, PDFLoader, BaseDocumentLoader, DocxLoader, TextLoader
+from utils.uri_cache import PersistentURICache
+from utils.retrieval import LexicalIndex, chunk_paragraphs, tokenize
+from utils.document_router import DocumentRouter
+from utils.question_clusters import cluster_questions
+from utils.docx_stream import iter_docx_blocks
+from utils.context_cache import DocumentContextCache
+from utils.file_lifecycle import FileLifecycleManager
+from utils.concurrency import AIMDController, is_rate_limit_error
+from utils.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retry, classify_error
+from utils.result_cache import ResultCache, result_key
+from utils.session_manager import SessionManager
+from utils.passage_store import PassageStore
+from utils.session_store import SQLiteSessionService
+from utils.run_journal import RunJournal
+from utils.job_queue import JobQueue
+from utils.shard_coordinator import SQLiteShardCoordinator
+from utils.cancellation import CancellationToken, DeadlineExceeded
+from utils.rate_limiter import TokenBucketLimiter, estimate_request_tokens, get_shared_limiter
 from google.genai import Client, types
 
 # Mock for google.genai.types.File
@@ -11,6 +31,41 @@ class MockFile:
     def __init__(self, name):
         self.name = name
 
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+R = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+
+def build_docx(blocks, header=None, footer=None) -> bytes:
+    """
+    Builds a minimal DOCX in memory. Blocks are paragraph strings, ("table", rows)
+    or ("break",) to close a section.
+    """
+    def paragraph(text):
+        return f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+
+    body = []
+    for block in blocks:
+        if isinstance(block, str):
+            body.append(paragraph(block))
+        elif block[0] == "table":
+            rows = "".join("<w:tr>" + "".join(f"<w:tc>{paragraph(c)}</w:tc>" for c in row) + "</w:tr>" for row in block[1])
+            body.append(f"<w:tbl>{rows}</w:tbl>")
+        else:
+            body.append('<w:p><w:pPr><w:sectPr><w:headerReference r:id="rIdH"/><w:footerReference r:id="rIdF"/></w:sectPr></w:pPr></w:p>')
+    body.append('<w:sectPr><w:headerReference r:id="rIdH"/><w:footerReference r:id="rIdF"/></w:sectPr>')
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("word/document.xml", f'<w:document {W} {R}><w:body>{"".join(body)}</w:body></w:document>')
+        archive.writestr("word/_rels/document.xml.rels",
+                         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         '<Relationship Id="rIdH" Target="header1.xml"/><Relationship Id="rIdF" Target="footer1.xml"/>'
+                         '</Relationships>')
+        if header:
+            archive.writestr("word/header1.xml", f"<w:hdr {W}>{paragraph(header)}</w:hdr>")
+        if footer:
+            archive.writestr("word/footer1.xml", f"<w:ftr {W}>{paragraph(footer)}</w:ftr>")
+    return buffer.getvalue()
+
 # Concrete implementation for testing BaseDocumentLoader methods
 class ConcreteDocumentLoader(BaseDocumentLoader):
     def load_document(self, file_path: str, display_name: str = None) -> str:
@@ -87,13 +142,14 @@ class TestAppLogger(unittest.TestCase):
 class TestDocumentLoaders(unittest.TestCase):
 
     def setUp(self):
+        import tempfile
         self.mock_client = MagicMock(spec=Client)
-        self.factory = DocumentLoaderFactory(self.mock_client)
+        # A private cache directory: the real .gemini_cache holds durable state
+        self.cache_dir = tempfile.mkdtemp()
+        self.uri_cache = PersistentURICache(self.cache_dir)
+        self.factory = DocumentLoaderFactory(self.mock_client, self.uri_cache)
         self.pdf_loader = self.factory.get_loader("dummy.pdf") # Get a PDFLoader instance
         
-        # Ensure a clean cache for each test
-        self.pdf_loader.uri_cache = {}
-        
         # Create a dummy PDF file for testing
         self.dummy_pdf_path = "test_dummy.pdf"
         self.dummy_pdf_content = b"%PDF-1.4\n1 0 obj<</Type/Catalog>>endobj\nxref\n0 1\n0000000000 65535 f\ntrailer<</Size 1/Root 1 0 R>>startxref\n0\n%%EOF"
@@ -104,12 +160,11 @@ class TestDocumentLoaders(unittest.TestCase):
         if os.path.exists(self.dummy_pdf_path):
             os.remove(self.dummy_pdf_path)
         # Clean up any created cache files and directory
-        if os.path.exists(ConcreteDocumentLoader(self.mock_client).cache_dir): # Use ConcreteDocumentLoader to get cache_dir
-            import shutil
-            shutil.rmtree(ConcreteDocumentLoader(self.mock_client).cache_dir)
+        import shutil
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
 
     def test_calculate_hash(self):
-        loader_instance = ConcreteDocumentLoader(self.mock_client) # Use concrete class for hash test
+        loader_instance = ConcreteDocumentLoader(self.mock_client, self.uri_cache) # Use concrete class for hash test
         hash1 = loader_instance._calculate_hash(self.dummy_pdf_content)
         
         content2 = b"some other content"
@@ -119,6 +174,34 @@ class TestDocumentLoaders(unittest.TestCase):
         hash3 = loader_instance._calculate_hash(self.dummy_pdf_content)
         self.assertEqual(hash1, hash3)
 
+    def test_streaming_hash_matches_in_memory_hash(self):
+        import io
+        loader_instance = ConcreteDocumentLoader(self.mock_client, self.uri_cache)
+        expected = loader_instance._calculate_hash(self.dummy_pdf_content)
+
+        self.assertEqual(loader_instance.content_hash(self.dummy_pdf_path), expected)
+
+        stream = io.BytesIO(self.dummy_pdf_content)
+        stream.seek(5)
+        self.assertEqual(loader_instance.content_hash(stream), expected)
+        self.assertEqual(stream.tell(), 5)  # Position restored for the upload
+
+    @patch('builtins.print')
+    def test_docx_loader_cache_hit_skips_conversion(self, mock_print):
+        docx_loader = self.factory.get_loader("dummy.docx")
+        docx_path = "test_dummy.docx"
+        with open(docx_path, "wb") as f:
+            f.write(b"not really a docx")
+        try:
+            docx_loader.uri_cache[docx_loader.content_hash(docx_path)] = "files/cached_docx"
+            with patch('utils.document_loader.write_docx_text') as mock_convert:
+                uri = docx_loader.load_document(docx_path)
+            mock_convert.assert_not_called()
+            self.mock_client.files.upload.assert_not_called()
+            self.assertEqual(uri, "files/cached_docx")
+        finally:
+            os.remove(docx_path)
+
     @patch('builtins.print')
     def test_pdf_loader_upload_and_cache_new_file(self, mock_print):
         mock_uploaded_file = MockFile(name="files/12345")
@@ -145,5 +228,1108 @@ class TestDocumentLoaders(unittest.TestCase):
         self.assertEqual(uri, "files/cached_uri")
         self.assertIn(file_hash, self.pdf_loader.uri_cache)
 
+    @patch('builtins.print')
+    def test_stream_with_known_hash_is_not_hashed_again(self, mock_print):
+        import io
+        self.mock_client.files.upload.return_value = MockFile(name="files/12345")
+        stream = io.BytesIO(self.dummy_pdf_content)
+        content_hash = self.pdf_loader.content_hash(stream)
+
+        with patch.object(self.pdf_loader, '_hash_stream') as mock_hash:
+            uri = self.pdf_loader.load_document(stream, display_name="upload.pdf", content_hash=content_hash)
+
+        mock_hash.assert_not_called()
+        self.assertEqual(uri, "files/12345")
+        self.assertEqual(self.pdf_loader.uri_cache.get(content_hash), "files/12345")
+
+    @patch('builtins.print')
+    def test_loaders_share_persistent_cache(self, mock_print):
+        self.mock_client.files.upload.return_value = MockFile(name="files/12345")
+        self.pdf_loader.load_document(self.dummy_pdf_path)
+
+        # A fresh factory (e.g. after a restart) reuses the upload recorded on disk
+        restarted_factory = DocumentLoaderFactory(self.mock_client, PersistentURICache(self.cache_dir))
+        self.assertIs(restarted_factory.get_loader("a.txt").uri_cache, restarted_factory.get_loader("b.pdf").uri_cache)
+        uri = restarted_factory.get_loader("dummy.pdf").load_document(self.dummy_pdf_path)
+
+        self.assertEqual(uri, "files/12345")
+        self.mock_client.files.upload.assert_called_once()
+
+
+    @patch('builtins.print')
+    def test_docx_loader_uploads_from_memory(self, mock_print):
+        uploaded = {}
+        def fake_upload(file, config):
+            uploaded["content"] = file.read()
+            return MockFile(name="files/docx_mem")
+        self.mock_client.files.upload.side_effect = fake_upload
+
+        uri = self.factory.get_loader("policy.docx").load_document(
+            build_docx(["Policy paragraph"]), display_name="policy.docx")
+
+        self.assertEqual(uri, "files/docx_mem")
+        call = self.mock_client.files.upload.call_args
+        self.assertEqual(call.kwargs['config'].mime_type, "text/plain")
+        self.assertIn(b"Policy paragraph", uploaded["content"])
+        self.assertFalse([f for f in os.listdir(self.pdf_loader.cache_dir) if f.endswith(".txt")])
+
+    def test_docx_loader_extracts_tables_headers_and_footers(self):
+        data = build_docx(
+            ["Access policy", ("table", [["Control", "Owner"], ["MFA", "IT Security"]]), ("break",), "Second section"],
+            header="Confidential", footer="Page footer",
+        )
+        blocks = [text for _, text in iter_docx_blocks(io.BytesIO(data))]
+
+        self.assertEqual(blocks, [
+            "[Section 1]", "Access policy", "[Table 1]", "Control | Owner", "MFA | IT Security",
+            "[Section 1 header] Confidential", "[Section 1 footer] Page footer",
+            "[Section 2]", "Second section",
+        ])
+        passages = DocxLoader(self.mock_client, self.uri_cache).extract_passages(data)
+        self.assertEqual([location for location, _ in passages], ["Section 1, Paragraphs 1-6", "Section 2, Paragraphs 1"])
+        self.assertIn("MFA | IT Security", passages[0][1])
+
+
+class TestPersistentURICache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_entries_survive_restart(self):
+        cache = PersistentURICache(self.cache_dir)
+        cache.put("hash1", "files/abc", size=10)
+
+        reloaded = PersistentURICache(self.cache_dir)
+        self.assertIn("hash1", reloaded)
+        self.assertEqual(reloaded["hash1"], "files/abc")
+        self.assertEqual(reloaded.get_entry("hash1")["size"], 10)
+
+    def test_expired_entries_are_evicted(self):
+        cache = PersistentURICache(self.cache_dir, ttl_seconds=60)
+        cache.put("old", "files/old", uploaded_at=0)
+        cache.put("new", "files/new")
+
+        self.assertNotIn("old", cache)
+        self.assertIsNone(cache.get("old"))
+        self.assertEqual(cache.get("new"), "files/new")
+        self.assertEqual(len(PersistentURICache(self.cache_dir, ttl_seconds=60)), 1)
+
+    def test_size_budget_evicts_least_recently_used(self):
+        cache = PersistentURICache(self.cache_dir, max_bytes=100)
+        cache.put("a", "files/a", size=60)
+        cache.put("b", "files/b", size=30)
+        cache.get("a")  # "a" is now the most recently used entry
+        cache.put("c", "files/c", size=30)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertLessEqual(cache.total_size(), 100)
+
+    def test_corrupted_index_is_ignored(self):
+        with open(os.path.join(self.cache_dir, PersistentURICache.INDEX_FILENAME), "w") as f:
+            f.write("{not json")
+        cache = PersistentURICache(self.cache_dir)
+        self.assertEqual(len(cache), 0)
+
+    def test_instances_sharing_a_directory_merge_their_writes(self):
+        first, second = PersistentURICache(self.cache_dir), PersistentURICache(self.cache_dir)
+        first.put("a", "files/a")
+        second.put("b", "files/b")
+        second.remove("b")
+
+        self.assertEqual(first.get("b"), None)
+        reloaded = PersistentURICache(self.cache_dir)
+        self.assertEqual(reloaded.get("a"), "files/a")
+        self.assertNotIn("b", reloaded)
+        self.assertEqual(second.get("a"), "files/a")  # Written by the other instance
+
+    def test_cache_hits_write_the_index_in_batches(self):
+        cache = PersistentURICache(self.cache_dir)
+        cache.put("a", "files/a")
+        with patch('utils.uri_cache.write_json') as mock_write:
+            for _ in range(5):
+                cache.get("a")
+        mock_write.assert_not_called()
+        with patch('utils.uri_cache.ACCESS_WRITE_INTERVAL_SECONDS', 0):
+            last_used = cache.get_entry("a")["last_used"]
+            cache.get("a")
+        self.assertGreaterEqual(PersistentURICache(self.cache_dir).get_entry("a")["last_used"], last_used)
+
+    def test_size_budget_read_from_environment_at_creation(self):
+        with patch.dict(os.environ, {"GEMINI_CACHE_MAX_BYTES": "123"}):
+            self.assertEqual(PersistentURICache(self.cache_dir).max_bytes, 123)
+        self.assertEqual(PersistentURICache(self.cache_dir, max_bytes=7).max_bytes, 7)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, "results.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_key_ignores_formatting_but_not_documents_or_prompts(self):
+        key = result_key("Is X  compliant?", "Details", ["c1"], ["t1", "t2"], "gemini", "v1")
+        self.assertEqual(key, result_key(" is x compliant? ", "details", ["c1"], ["t2", "t1"], "gemini", "v1"))
+        self.assertNotEqual(key, result_key("Is X compliant?", "Details", ["c1"], ["t1"], "gemini", "v1"))
+        self.assertNotEqual(key, result_key("Is X compliant?", "Details", [], ["t1", "t2", "c1"], "gemini", "v1"))
+        self.assertNotEqual(key, result_key("Is X compliant?", "Details", ["c1"], ["t1", "t2"], "gemini", "v2"))
+        self.assertNotEqual(key, result_key("Is X compliant?", "Details", ["c1"], ["t1", "t2"], "gemini", "v1", packed=True))
+
+    def test_results_survive_restart_sync_and_async(self):
+        import asyncio
+        result = {"risposta": "Sì", "confidenza": 90, "giustificazione": "Found"}
+        ResultCache(self.path).put("k1", result)
+        asyncio.run(ResultCache(self.path).aput("k2", result))
+
+        cache = ResultCache(self.path)
+        self.assertEqual(cache.get("k2"), result)
+        self.assertEqual(asyncio.run(cache.aget_many(["k1", "k2", "k3"])), {"k1": result, "k2": result})
+        self.assertIsNone(asyncio.run(cache.aget("k3")))
+
+    def test_old_results_are_ignored(self):
+        cache = ResultCache(self.path, max_age_seconds=60)
+        cache.put("k1", {"risposta": "Sì"})
+        with patch("utils.result_cache.time.time", return_value=__import__("time").time() + 120):
+            self.assertIsNone(cache.get("k1"))
+
+
+@patch('utils.file_lifecycle.logger')
+class TestFileLifecycleManager(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.client = MagicMock()
+        self.uri_cache = PersistentURICache(self.cache_dir)
+        self.lifecycle = FileLifecycleManager(self.client, self.uri_cache, grace_seconds=0)
+
+    def tearDown(self):
+        import shutil
+        self.lifecycle.stop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _upload(self, content_hash, name, payload=b"content"):
+        self.uri_cache.put(content_hash, name, size=len(payload))
+        self.lifecycle.record(content_hash, name, io.BytesIO(payload), "text/plain", "notes.txt")
+
+    def test_expired_file_is_reuploaded_from_local_copy(self, mock_logger):
+        from google.genai import errors
+        self._upload("h1", "files/old")
+        self.client.files.get.side_effect = errors.ClientError(404, {"error": {"message": "not found"}})
+        self.client.files.upload.return_value = MockFile(name="files/new")
+
+        results = self.lifecycle.start_validation({"h1": "files/old"}).result()
+
+        self.assertEqual(results, {"h1": {"name": "files/new"}})
+        config = self.client.files.upload.call_args.kwargs["config"]
+        self.assertEqual((config.mime_type, config.display_name), ("text/plain", "notes.txt"))
+        self.assertEqual(self.uri_cache.get("h1"), "files/new")
+        self.assertEqual(set(self.lifecycle.uploads()), {"files/old", "files/new"})
+
+    def test_file_about_to_expire_is_reuploaded(self, mock_logger):
+        import datetime
+        self._upload("h1", "files/old")
+        soon = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=30)
+        later = soon + datetime.timedelta(days=1)
+        self.client.files.get.side_effect = [
+            types.File(name="files/old", state="ACTIVE", expiration_time=later),
+            types.File(name="files/old", state="ACTIVE", expiration_time=soon),
+        ]
+        self.client.files.upload.return_value = MockFile(name="files/new")
+
+        self.assertEqual(self.lifecycle.validate({"h1": "files/old"}), {})
+        self.assertEqual(self.lifecycle.validate({"h1": "files/old"}), {"h1": {"name": "files/new"}})
+
+    def test_missing_local_copy_is_reported(self, mock_logger):
+        self.client.files.get.return_value = types.File(name="files/x", state="FAILED")
+        results = self.lifecycle.validate({"unknown": "files/x"})
+        self.assertIn("No local copy", results["unknown"]["error"])
+
+    def test_garbage_collection_keeps_current_and_in_use_files(self, mock_logger):
+        self._upload("h1", "files/v1")
+        self._upload("h1", "files/v2")  # Superseded v1
+        self._upload("h2", "files/used")
+        self.uri_cache.remove("h2")     # No longer cached, but still loaded
+        self._upload("h3", "files/gone")
+        self.uri_cache.remove("h3")
+        self.lifecycle.in_use = lambda: {"h2": "files/used"}
+
+        removed = self.lifecycle.collect_garbage()
+
+        deleted = sorted(call.kwargs["name"] for call in self.client.files.delete.call_args_list)
+        self.assertEqual(deleted, ["files/gone", "files/v1"])
+        self.assertEqual(set(self.lifecycle.uploads()), {"files/v2", "files/used"})
+        self.assertEqual(sorted(os.listdir(self.lifecycle.blob_dir)), ["h1", "h2"])
+        self.assertEqual(removed, {"remote": 2, "local": 1})
+
+    def test_garbage_collection_keeps_uploads_of_other_instances(self, mock_logger):
+        other = FileLifecycleManager(self.client, PersistentURICache(self.cache_dir), grace_seconds=0)
+        self._upload("h1", "files/mine")
+        other.uri_cache.put("h2", "files/theirs", size=7)
+        other.record("h2", "files/theirs", b"theirs!", "text/plain", "theirs.txt")
+
+        self.lifecycle.collect_garbage()
+
+        self.client.files.delete.assert_not_called()
+        self.assertEqual(set(self.lifecycle.uploads()), {"files/mine", "files/theirs"})
+        self.assertEqual(sorted(os.listdir(self.lifecycle.blob_dir)), ["h1", "h2"])
+        other.stop()
+
+    def test_recent_uploads_are_kept_for_the_grace_period(self, mock_logger):
+        self.lifecycle.grace_seconds = 3600
+        self._upload("h1", "files/v1")
+        self._upload("h1", "files/v2")
+
+        self.assertEqual(self.lifecycle.collect_garbage(), {"remote": 0, "local": 0})
+        self.client.files.delete.assert_not_called()
+
+    def test_uploads_from_disk_are_reuploaded_from_their_source(self, mock_logger):
+        source = os.path.join(self.cache_dir, "policy.pdf")
+        with open(source, "wb") as f:
+            f.write(b"%PDF source")
+        self.uri_cache.put("h1", "files/old")
+        self.lifecycle.record("h1", "files/old", source, "application/pdf", "policy.pdf")
+        self.assertEqual(os.listdir(self.lifecycle.blob_dir), [])  # Not copied
+        self.client.files.upload.return_value = MockFile(name="files/new")
+
+        self.assertEqual(self.lifecycle.reupload("h1", "files/old"), "files/new")
+        self.assertEqual(self.client.files.upload.call_args.kwargs["file"], source)
+
+        with open(source, "wb") as f:
+            f.write(b"changed")
+        with self.assertRaises(FileNotFoundError):
+            self.lifecycle.reupload("h1", "files/new")
+
+    def test_local_copies_stay_within_their_budget(self, mock_logger):
+        self.lifecycle.blob_max_bytes = 10
+        self._upload("h1", "files/1", b"123456")
+        os.utime(self.lifecycle._blob_path("h1"), (0, 0))  # Oldest copy
+        self._upload("h2", "files/2", b"abcdef")
+        self._upload("h3", "files/3", b"x" * 11)  # Over the whole budget: not copied
+
+        self.assertEqual(sorted(os.listdir(self.lifecycle.blob_dir)), ["h2"])
+
+
+class TestAIMDController(unittest.TestCase):
+
+    def _rate_limit(self):
+        from google.genai import errors
+        return errors.ClientError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+
+    def test_grows_by_one_per_healthy_round(self):
+        controller = AIMDController(initial=2, max_limit=4, window=4)
+        for _ in range(4):
+            controller.observe(1.0)
+        self.assertEqual(controller.limit, 3)
+        for _ in range(3):
+            controller.observe(1.0)
+        self.assertEqual(controller.limit, 4)
+        for _ in range(8):
+            controller.observe(1.0)
+        self.assertEqual(controller.limit, 4)  # Capped
+        self.assertEqual([h["reason"] for h in controller.history], ["initial", "healthy round", "healthy round"])
+
+    def test_holds_when_latency_degrades(self):
+        controller = AIMDController(initial=2, max_limit=10, window=2)
+        controller.observe(1.0)
+        controller.observe(1.0)
+        self.assertEqual(controller.limit, 3)
+        for _ in range(3):
+            controller.observe(5.0)
+        self.assertEqual(controller.limit, 3)
+
+    def test_halves_once_per_burst_of_rate_limits(self):
+        controller = AIMDController(initial=8, max_limit=10)
+        started_at = controller.history[0]["time"] - 1
+        for _ in range(4):
+            controller.observe(1.0, self._rate_limit(), started_at=started_at)
+        self.assertEqual(controller.limit, 4)
+        # A row started after the decrease is a new signal
+        controller.observe(1.0, self._rate_limit(), started_at=controller.history[-1]["time"])
+        self.assertEqual(controller.limit, 2)
+        self.assertTrue(is_rate_limit_error(RuntimeError("429 Too Many Requests")))
+        self.assertFalse(is_rate_limit_error(ValueError("bad request")))
+
+    def test_fixed_limit_gates_in_flight_rows(self):
+        import asyncio
+        controller = AIMDController(initial=2, min_limit=2, max_limit=2)
+        peak = 0
+
+        async def row():
+            nonlocal peak
+            started_at = await controller.acquire()
+            peak = max(peak, controller.in_flight)
+            await asyncio.sleep(0.01)
+            await controller.release(started_at, self._rate_limit())
+
+        async def run():
+            await asyncio.gather(*(row() for _ in range(6)))
+        asyncio.run(run())
+
+        self.assertEqual((peak, controller.limit, controller.in_flight), (2, 2, 0))
+
+
+class TestRetry(unittest.TestCase):
+
+    def _api_error(self, code, status):
+        from google.genai import errors
+        cls = errors.ServerError if code >= 500 else errors.ClientError
+        return cls(code, {"error": {"code": code, "message": status, "status": status}})
+
+    def test_classify_error(self):
+        import httpx
+        self.assertEqual(classify_error(self._api_error(429, "RESOURCE_EXHAUSTED")), "rate_limit")
+        self.assertEqual(classify_error(self._api_error(503, "UNAVAILABLE")), "transient")
+        self.assertEqual(classify_error(httpx.ConnectError("refused")), "transient")
+        self.assertEqual(classify_error(self._api_error(400, "INVALID_ARGUMENT")), "permanent")
+        self.assertEqual(classify_error(ValueError("No target documents loaded")), "permanent")
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+        delays = [policy.delay(attempt) for attempt in range(1, 10) for _ in range(20)]
+        self.assertTrue(all(0 <= d <= 5.0 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_retries_transient_errors_only(self):
+        import asyncio
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise self._api_error(503, "UNAVAILABLE")
+            return "ok"
+
+        async def invalid():
+            calls.append(1)
+            raise self._api_error(400, "INVALID_ARGUMENT")
+
+        policy = RetryPolicy(max_attempts=4, base_delay=0)
+        retries = []
+        self.assertEqual(asyncio.run(call_with_retry(flaky, policy, on_retry=lambda *args: retries.append(args[:2]))), "ok")
+        self.assertEqual(retries, [(1, "transient"), (2, "transient")])
+
+        calls.clear()
+        with self.assertRaises(Exception):
+            asyncio.run(call_with_retry(invalid, policy))
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_breaker_pauses_then_probes(self):
+        import asyncio
+        states = []
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05, give_up_after=1, on_state_change=states.append)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+
+        async def wait_for_probe():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await breaker.before_call()
+            return loop.time() - start
+        self.assertGreaterEqual(asyncio.run(wait_for_probe()), 0.04)
+        self.assertEqual(breaker.state, "half_open")
+        breaker.record_failure()  # Failed probe reopens at once
+        self.assertEqual(breaker.state, "open")
+        breaker.record_success()
+        self.assertEqual(states, ["open", "half_open", "open", "closed"])
+
+    def test_circuit_breaker_gives_up_on_long_outages(self):
+        import asyncio
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, give_up_after=0)
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(breaker.before_call())
+
+
+class TestTokenBucketLimiter(unittest.TestCase):
+
+    def test_unlimited_by_default(self):
+        limiter = TokenBucketLimiter()
+        self.assertFalse(limiter.enabled)
+        self.assertEqual([limiter.reserve(10_000) for _ in range(100)], [0.0] * 100)
+
+    def test_requests_wait_in_order_once_the_budget_is_spent(self):
+        limiter = TokenBucketLimiter(requests_per_minute=60)
+        self.assertEqual(limiter.reserve(), 0.0)
+        limiter._requests = 0.0  # Bucket just emptied
+        waits = [limiter.reserve() for _ in range(3)]
+        # One request per second: each caller waits one second more than the previous one
+        for wait, expected in zip(waits, [1, 2, 3]):
+            self.assertAlmostEqual(wait, expected, delta=0.05)
+
+    def test_token_budget_is_enforced_and_capped(self):
+        limiter = TokenBucketLimiter(tokens_per_minute=6000)
+        self.assertEqual(limiter.reserve(6000), 0.0)
+        self.assertAlmostEqual(limiter.reserve(600), 6.0, delta=0.05)  # 100 tokens per second
+        # Larger than the whole budget: waits for one full bucket, not forever
+        self.assertAlmostEqual(limiter.reserve(10 ** 9), 66.0, delta=0.05)
+
+    def test_async_acquire_sleeps_the_reserved_wait(self):
+        import asyncio
+        limiter = TokenBucketLimiter(requests_per_minute=600)
+        limiter._requests = 0.0
+        self.assertAlmostEqual(asyncio.run(limiter.aacquire()), 0.1, delta=0.02)
+
+    def test_reservation_cancelled_while_waiting_is_refunded(self):
+        import asyncio
+        limiter = TokenBucketLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        limiter.reserve(6000)  # Both buckets spent
+
+        async def cancelled_wait():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(limiter.aacquire(600), 0.05)
+        asyncio.run(cancelled_wait())
+
+        # Only the refill since then is owed, not the abandoned request
+        self.assertAlmostEqual(limiter.reserve(600), 6.0, delta=0.2)
+
+    def test_shared_limiter_is_process_wide(self):
+        first = get_shared_limiter(100, 0)
+        second = get_shared_limiter(100, 0)
+        self.assertIs(first, second)
+        self.assertIs(get_shared_limiter(200, 5000), first)
+        self.assertEqual((first.requests_per_minute, first.tokens_per_minute), (200, 5000))
+        get_shared_limiter(0, 0)
+
+    def test_estimate_request_tokens(self):
+        from google.adk.models.llm_request import LlmRequest
+        request = LlmRequest(contents=[types.Content(role="user", parts=[types.Part(text="x" * 400)])],
+                             config=types.GenerateContentConfig(system_instruction="y" * 400, max_output_tokens=50))
+        self.assertEqual(estimate_request_tokens(request), 250)
+
+    def test_estimate_request_tokens_counts_documents(self):
+        from google.adk.models.llm_request import LlmRequest
+        parts = [types.Part(text="x" * 400), types.Part.from_uri(file_uri="https://host/v1beta/files/abc", mime_type="application/pdf")]
+        request = LlmRequest(contents=[types.Content(role="user", parts=parts)],
+                             config=types.GenerateContentConfig(max_output_tokens=50))
+        self.assertEqual(estimate_request_tokens(request, file_tokens={"files/abc": 2000}), 2150)
+        self.assertEqual(estimate_request_tokens(request, cached_tokens=1000), 1150)
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        from google.adk.sessions import InMemorySessionService
+        self.service = InMemorySessionService()
+
+    def test_budgets_read_from_environment_at_creation(self):
+        env = {"SESSION_MEMORY_BUDGET_MB": "1", "SESSION_MAX_COUNT": "5", "SESSION_COMPACT_KB": "2"}
+        with patch.dict(os.environ, env):
+            manager = SessionManager(self.service)
+        self.assertEqual((manager.max_bytes, manager.max_sessions, manager.compact_bytes), (1024 * 1024, 5, 2048))
+        manager = SessionManager(self.service, max_bytes=10, max_sessions=1, compact_bytes=3)
+        self.assertEqual((manager.max_bytes, manager.max_sessions, manager.compact_bytes), (10, 1, 3))
+
+    def _event(self, text, author="Auditor"):
+        from google.adk.events import Event
+        return Event(author=author, content=types.Content(role="model", parts=[types.Part(text=text)]))
+
+    async def _run(self, manager, session_id, text, reset=False):
+        """One run adding an event of `text` to the session, as the runner would."""
+        async with manager.use("u", session_id, {"docs": 1}, reset=reset) as usage:
+            session = await self.service.get_session(app_name="agents", user_id="u", session_id=session_id)
+            event = self._event(text)
+            await self.service.append_event(session, event)
+            usage.add(event)
+
+    async def _events(self, session_id):
+        session = await self.service.get_session(app_name="agents", user_id="u", session_id=session_id)
+        return None if session is None else [e.content.parts[0].text for e in session.events]
+
+    def test_reset_starts_analyses_from_an_empty_session(self):
+        import asyncio
+
+        async def scenario():
+            manager = SessionManager(self.service)
+            await self._run(manager, "row", "first", reset=True)
+            await self._run(manager, "row", "second", reset=True)
+            await self._run(manager, "chat", "hello")
+            await self._run(manager, "chat", "again")
+            return await self._events("row"), await self._events("chat")
+        self.assertEqual(asyncio.run(scenario()), (["second"], ["hello", "again"]))
+
+    def test_idle_sessions_are_evicted_least_recently_used_first(self):
+        import asyncio
+
+        async def scenario():
+            manager = SessionManager(self.service, max_bytes=3 * 1000, max_sessions=10)
+            for session_id in ("a", "b", "c"):
+                await self._run(manager, session_id, "x" * 400)
+            await self._run(manager, "a", "x" * 400)  # "a" becomes the most recently used
+            return manager, [await self._events(k) is not None for k in ("a", "b", "c")]
+        manager, alive = asyncio.run(scenario())
+        # "a" now holds two runs: evicting "b", the least recently used, is enough
+        self.assertEqual(alive, [True, False, True])
+        self.assertEqual(manager.evicted, 1)
+        self.assertLessEqual(manager.total_bytes, manager.max_bytes)
+
+        async def running_is_kept():
+            manager = SessionManager(self.service, max_bytes=0)
+            async with manager.use("u", "busy") as usage:
+                usage.bytes += 100
+                await manager.aevict()
+                kept = await self._events("busy") is not None
+            return kept, await self._events("busy") is not None
+        self.assertEqual(asyncio.run(running_is_kept()), (True, False))
+
+    def test_lru_order_decides_which_session_goes(self):
+        import asyncio
+
+        async def scenario():
+            manager = SessionManager(self.service, max_sessions=2)
+            await self._run(manager, "a", "1")
+            await self._run(manager, "b", "2")
+            await self._run(manager, "a", "3")
+            await self._run(manager, "c", "4")
+            return [await self._events(k) is not None for k in ("a", "b", "c")]
+        self.assertEqual(asyncio.run(scenario()), [True, False, True])
+
+    def test_prepared_sessions_skip_lookups(self):
+        import asyncio
+        from unittest.mock import AsyncMock
+
+        async def scenario():
+            manager = SessionManager(self.service)
+            await self._run(manager, "row_0", "previous analysis")
+            fresh_manager = SessionManager(self.service)  # e.g. after a restart: registry empty
+            prepared = await fresh_manager.aprepare("u", ["row_0", "row_1", "row_2", "row_1"], {"docs": 2}, reset=True)
+            self.service.get_session = AsyncMock(side_effect=AssertionError("lookup on the hot path"))
+            self.service.create_session = AsyncMock(side_effect=AssertionError("creation on the hot path"))
+            for session_id in ("row_0", "row_1", "row_2"):
+                await fresh_manager.aopen("u", session_id, reset=True)
+                await fresh_manager.aclose("u", session_id, 100)
+            return prepared, self.service.sessions["agents"]["u"]
+        prepared, sessions = asyncio.run(scenario())
+        self.assertEqual(prepared, 3)
+        self.assertEqual(sorted(sessions), ["row_0", "row_1", "row_2"])
+        self.assertEqual(sessions["row_0"].events, [])  # Previous history dropped by the reset
+        self.assertEqual(sessions["row_0"].state, {"docs": 2})
+
+    def test_prepare_resets_only_used_sessions(self):
+        import asyncio
+
+        async def scenario():
+            manager = SessionManager(self.service)
+            self.assertEqual(await manager.aprepare("u", ["a", "b"], reset=True), 2)
+            await self._run(manager, "a", "analysis", reset=True)
+            return await manager.aprepare("u", ["a", "b"], reset=True), await self._events("a")
+        self.assertEqual(asyncio.run(scenario()), (1, []))
+
+    def test_large_sessions_are_compacted_to_recent_events(self):
+        import asyncio
+
+        async def scenario():
+            manager = SessionManager(self.service, compact_bytes=2000, keep_events=2)
+            for i in range(5):
+                await self._run(manager, "chat", f"{i}" * 600)
+            session = await self.service.get_session(app_name="agents", user_id="u", session_id="chat")
+            return [e.content.parts[0].text[0] for e in session.events], session.state
+        texts, state = asyncio.run(scenario())
+        self.assertLessEqual(len(texts), 4)
+        self.assertEqual(texts[-1], "4")
+        self.assertEqual(state, {"docs": 1})
+
+
+class TestSQLiteSessionService(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, "sessions.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _event(self, text, state_delta=None):
+        from google.adk.events import Event, EventActions
+        return Event(author="Auditor", content=types.Content(role="model", parts=[types.Part(text=text)]),
+                     actions=EventActions(state_delta=state_delta or {}))
+
+    def test_sessions_and_state_survive_restart(self):
+        import asyncio
+
+        async def write():
+            service = SQLiteSessionService(self.path)
+            session = await service.create_session(app_name="agents", user_id="u", session_id="chat",
+                                                   state={"docs": 1, "app:model": "gemini", "user:lang": "it"})
+            await service.append_event(session, self._event("hello", {"step": 1}))
+            await service.append_event(session, self._event("again", {"step": 2, "user:lang": "en"}))
+            await service.flush()
+            return session.state
+
+        self.assertEqual(asyncio.run(write())["step"], 2)
+
+        async def read():
+            service = SQLiteSessionService(self.path)
+            session = await service.get_session(app_name="agents", user_id="u", session_id="chat")
+            other = await service.create_session(app_name="agents", user_id="u", session_id="other")
+            return session, other
+
+        session, other = asyncio.run(read())
+        self.assertEqual([e.content.parts[0].text for e in session.events], ["hello", "again"])
+        self.assertEqual(session.state, {"docs": 1, "step": 2, "app:model": "gemini", "user:lang": "en"})
+        self.assertEqual(other.state, {"app:model": "gemini", "user:lang": "en"})
+
+    def test_create_rejects_existing_sessions_and_delete_removes_events(self):
+        import asyncio
+        from google.adk.errors.already_exists_error import AlreadyExistsError
+
+        async def scenario():
+            service = SQLiteSessionService(self.path)
+            session = await service.create_session(app_name="agents", user_id="u", session_id="row")
+            await service.append_event(session, self._event("answer"))
+            with self.assertRaises(AlreadyExistsError):
+                await service.create_session(app_name="agents", user_id="u", session_id="row")
+            listed = await service.list_sessions(app_name="agents", user_id="u")
+            await service.delete_session(app_name="agents", user_id="u", session_id="row")
+            await service.create_session(app_name="agents", user_id="u", session_id="row")
+            recreated = await service.get_session(app_name="agents", user_id="u", session_id="row")
+            return [s.id for s in listed.sessions], recreated.events
+        self.assertEqual(asyncio.run(scenario()), (["row"], []))
+
+    def test_appends_are_batched_and_recent_events_limit_reads(self):
+        import asyncio
+        from google.adk.sessions.base_session_service import GetSessionConfig
+
+        async def scenario():
+            service = SQLiteSessionService(self.path)
+            session = await service.create_session(app_name="agents", user_id="u", session_id="chat")
+            with patch.object(service, "flush", wraps=service.flush) as flush:
+                for i in range(5):
+                    await service.append_event(session, self._event(str(i)))
+                writes_during_appends = flush.call_count
+            recent = await service.get_session(app_name="agents", user_id="u", session_id="chat",
+                                               config=GetSessionConfig(num_recent_events=2))
+            return writes_during_appends, [e.content.parts[0].text for e in recent.events]
+        self.assertEqual(asyncio.run(scenario()), (0, ["3", "4"]))
+
+    def test_pending_events_are_written_at_exit(self):
+        import asyncio
+
+        async def scenario():
+            service = SQLiteSessionService(self.path)
+            session = await service.create_session(app_name="agents", user_id="u", session_id="chat")
+            await service.append_event(session, self._event("hello"))
+            return service
+        asyncio.run(scenario()).flush_sync()
+        session = asyncio.run(SQLiteSessionService(self.path).get_session(app_name="agents", user_id="u", session_id="chat"))
+        self.assertEqual([e.content.parts[0].text for e in session.events], ["hello"])
+
+
+    def test_purge_deletes_sessions_not_updated_recently(self):
+        import asyncio
+        import sqlite3
+
+        async def write():
+            service = SQLiteSessionService(self.path)
+            for user_id in ("gone", "alive"):
+                session = await service.create_session(app_name="agents", user_id=user_id, session_id="chat",
+                                                       state={"user:lang": "it"})
+                await service.append_event(session, self._event("hello"))
+            await service.flush()
+            return service
+        service = asyncio.run(write())
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("UPDATE sessions SET update_time = update_time - 7200 WHERE user_id = 'gone'")
+
+        self.assertEqual(service.purge(3600), 1)
+        self.assertEqual(service.purge(3600), 0)
+
+        async def read():
+            return [await service.get_session(app_name="agents", user_id=user_id, session_id="chat")
+                    for user_id in ("gone", "alive")]
+        gone, alive = asyncio.run(read())
+        self.assertIsNone(gone)
+        self.assertEqual(len(alive.events), 1)
+        with sqlite3.connect(self.path) as conn:
+            self.assertEqual(conn.execute("SELECT user_id FROM events").fetchall(), [("alive",)])
+            self.assertEqual(conn.execute("SELECT user_id FROM user_states").fetchall(), [("alive",)])
+
+
+class TestRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.journal_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+
+    def test_journal_survives_a_crash_mid_write(self):
+        journal = RunJournal(self.journal_dir)
+        journal.start("run1", [0, 1, 2], {"concurrency": 3}, "fp")
+        journal.record("run1", 0, {"risposta": "Sì"})
+        journal.record("run1", 2, {"risposta": "Sì"}, derived_from=0)
+        with open(os.path.join(self.journal_dir, "run1.jsonl"), "a") as f:
+            f.write('{"type": "result", "index": 1, "da')  # Process killed while writing
+
+        header, results, finished = RunJournal(self.journal_dir).load("run1")
+        self.assertEqual(header["params"], {"concurrency": 3})
+        self.assertEqual(sorted(results), [0, 2])
+        self.assertEqual(results[2]["derived_from"], 0)
+        self.assertFalse(finished)
+        self.assertEqual([(r["run_id"], r["completed"], r["finished"]) for r in journal.list_runs("fp")], [("run1", 2, False)])
+        self.assertEqual(journal.list_runs("other"), [])
+
+    def test_resumed_run_keeps_its_start_record(self):
+        journal = RunJournal(self.journal_dir)
+        journal.start("run1", [0, 1], {"pack_size": 1}, "fp")
+        journal.record("run1", 0, {"risposta": "Sì"})
+        RunJournal(self.journal_dir).start("run1", [1], {"pack_size": 1}, "fp")
+
+        header, results, finished = journal.load("run1")
+        self.assertEqual(header["row_indices"], [0, 1])
+        self.assertEqual(sorted(results), [0])
+        self.assertFalse(finished)
+        journal.finish("run1")
+        self.assertFalse(journal.exists("run1"))  # Nothing left to resume
+
+    def test_runs_listed_from_first_and_last_records(self):
+        journal = RunJournal(self.journal_dir)
+        journal.start("run1", list(range(500)), {}, "fp")
+        for idx in range(400):
+            journal.record("run1", idx, {"risposta": "Sì", "giustificazione": "x" * 500})
+        journal.record("run1", 3, {"risposta": "No"})  # Same row again: not counted twice
+        with patch.object(journal, "load", side_effect=AssertionError("full read")):
+            self.assertEqual([(r["run_id"], r["rows"], r["completed"]) for r in journal.list_runs("fp")], [("run1", 500, 400)])
+        # Resumed in another process: the count carries on
+        resumed = RunJournal(self.journal_dir)
+        resumed.start("run1", [], {}, "fp")
+        resumed.record("run1", 450, {"risposta": "Sì"})
+        self.assertEqual(resumed.list_runs("fp")[0]["completed"], 401)
+
+    def test_finished_and_expired_runs_are_not_listed(self):
+        journal = RunJournal(self.journal_dir)
+        journal.start("done", [0], {}, "fp")
+        journal._append("done", {"type": "finish", "time": 0})  # Journal that could not be deleted
+        journal.start("old", [0], {}, "fp")
+        os.utime(os.path.join(self.journal_dir, "old.jsonl"), (0, 0))
+
+        self.assertEqual(journal.list_runs("fp"), [])
+        self.assertEqual([r["run_id"] for r in journal.list_runs("fp", include_finished=True)], ["done"])
+        self.assertFalse(journal.exists("old"))
+        with patch.dict(os.environ, {"RUN_JOURNAL_RETENTION_DAYS": "2"}):
+            self.assertEqual(RunJournal(self.journal_dir).retention_seconds, 2 * 86400)
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.queue_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.queue_dir, "jobs.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+
+    def test_jobs_are_claimed_once_in_submission_order(self):
+        queue = JobQueue(self.path)
+        first = queue.submit({"concurrency": 3}, {"checklist": "a"}, total=2)
+        second = queue.submit({"concurrency": 5}, {"checklist": "b"}, total=1)
+
+        job = JobQueue(self.path).claim("w1")
+        self.assertEqual((job["id"], job["params"], job["payload"], job["resumed"]), (first, {"concurrency": 3}, {"checklist": "a"}, False))
+        self.assertEqual(queue.claim("w2")["id"], second)
+        self.assertIsNone(queue.claim("w3"))
+
+        queue.add_result(first, {"status": "success", "index": 0})
+        queue.add_result(first, {"status": "error", "index": 1})
+        queue.finish(first)
+        self.assertEqual(queue.completed_rows(first), {0})
+        self.assertEqual(queue.completed_rows(second), set())
+        self.assertEqual([seq for seq, _ in queue.results(first)], [1, 2])
+        self.assertEqual(queue.results(first, after_seq=1), [(2, {"status": "error", "index": 1})])
+        self.assertEqual({k: queue.get(first)[k] for k in ("status", "completed", "errors")},
+                         {"status": "done", "completed": 1, "errors": 1})
+
+    def test_silent_workers_lose_their_job_and_cancelled_jobs_stay_cancelled(self):
+        queue = JobQueue(self.path, stale_after=60)
+        job_id = queue.submit({}, {})
+        queue.claim("dead")
+        self.assertIsNone(queue.claim("w2"))
+        with patch("utils.job_queue.time.time", return_value=__import__("time").time() + 120):
+            job = queue.claim("w2")
+        self.assertEqual((job["id"], job["resumed"], queue.get(job_id)["worker"]), (job_id, True, "w2"))
+
+        self.assertTrue(queue.cancel(job_id))
+        queue.finish(job_id)
+        self.assertEqual(queue.get(job_id)["status"], "cancelled")
+        self.assertFalse(queue.cancel(job_id))
+
+
+class TestPassageStore(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.store_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.store_dir, "passages.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def test_passages_are_stored_once_and_read_by_other_processes(self):
+        store = PassageStore(self.path)
+        self.assertEqual(store.missing(["h1", "h2"]), ["h1", "h2"])
+        store.put_many({"h1": [("Page 1", "Data is encrypted at rest")]})
+
+        self.assertEqual(store.missing(["h1", "h2"]), ["h2"])
+        self.assertEqual(PassageStore(self.path).get_many(["h1", "h2"]), {"h1": [("Page 1", "Data is encrypted at rest")]})
+
+    def test_passages_not_used_recently_are_purged(self):
+        PassageStore(self.path).put_many({"h1": [("Page 1", "text")]})
+        with patch("utils.passage_store.time.time", return_value=__import__("time").time() + 2 * 86400):
+            self.assertEqual(PassageStore(self.path, max_age_seconds=86400).get_many(["h1"]), {})
+
+
+class TestSQLiteShardCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.coordinator_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.coordinator_dir, "shards.sqlite")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.coordinator_dir, ignore_errors=True)
+
+    def test_shards_are_leased_once_and_results_merged(self):
+        coordinator = SQLiteShardCoordinator(self.path)
+        run_id = coordinator.create_run([[0, 1], [2]], {"concurrency": 3}, {"checklist": "x"})
+        self.assertEqual(coordinator.run_info(run_id), {"params": {"concurrency": 3}, "payload": {"checklist": "x"}})
+
+        first = coordinator.lease("a")
+        second = SQLiteShardCoordinator(self.path).lease("b")
+        self.assertEqual((first["row_indices"], second["row_indices"]), ([0, 1], [2]))
+        self.assertIsNone(coordinator.lease("c"))
+
+        self.assertTrue(coordinator.complete(run_id, first["shard"], "a", {0: {"status": "success"}, 1: {"status": "success"}}))
+        self.assertFalse(coordinator.complete(run_id, second["shard"], "a", {2: {"status": "success"}}))  # Not a's shard
+        self.assertEqual(coordinator.progress(run_id), {"shards": 2, "pending": 0, "leased": 1, "done": 1, "rows": 2})
+        self.assertEqual(sorted(coordinator.results(run_id)), [0, 1])
+
+    def test_expired_leases_are_reassigned_and_stale_results_rejected(self):
+        coordinator = SQLiteShardCoordinator(self.path, lease_seconds=60)
+        run_id = coordinator.create_run([[0]], {}, {})
+        dead = coordinator.lease("dead")
+        self.assertTrue(coordinator.renew(run_id, dead["shard"], "dead"))
+        with patch("utils.shard_coordinator.time.time", return_value=__import__("time").time() + 120):
+            retry = coordinator.lease("alive")
+        self.assertEqual((retry["shard"], retry["attempt"]), (dead["shard"], 2))
+
+        self.assertFalse(coordinator.renew(run_id, dead["shard"], "dead"))
+        self.assertFalse(coordinator.complete(run_id, dead["shard"], "dead", {0: {"status": "success", "by": "dead"}}))
+        self.assertTrue(coordinator.complete(run_id, retry["shard"], "alive", {0: {"status": "success", "by": "alive"}}))
+        self.assertEqual(coordinator.results(run_id)[0]["by"], "alive")
+
+
+class TestCancellationToken(unittest.TestCase):
+
+    def test_first_cancel_wins_and_notifies_subscribers_once(self):
+        token = CancellationToken()
+        calls = []
+        token.on_cancel(lambda: calls.append("a"))
+        unsubscribe = token.on_cancel(lambda: calls.append("b"))
+        unsubscribe()
+
+        token.cancel("Stopped by user")
+        token.cancel("Batch deadline exceeded")
+        token.on_cancel(lambda: calls.append("late"))  # Already cancelled: called at once
+
+        self.assertEqual((token.cancelled, token.reason, calls), (True, "Stopped by user", ["a", "late"]))
+
+    def test_deadlines_are_not_retried(self):
+        self.assertEqual(classify_error(DeadlineExceeded("Row 1 exceeded its 600s deadline")), "permanent")
+
+
+class TestLexicalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LexicalIndex()
+        self.index.add_document("h_policy", "policy.pdf", [
+            ("Page 1", "Passwords must be rotated every 90 days and stored hashed."),
+            ("Page 2", "Backups are performed nightly and retained for one year."),
+        ])
+        self.index.add_document("h_contract", "contract.docx", [
+            ("Paragraphs 1-3", "The supplier shall perform backups of customer data every week."),
+        ])
+
+    def test_search_ranks_relevant_passages_with_location(self):
+        results = self.index.search("How often are passwords rotated?", k=2)
+        self.assertEqual(results[0]["filename"], "policy.pdf")
+        self.assertEqual(results[0]["location"], "Page 1")
+        self.assertGreater(results[0]["score"], 0)
+
+    def test_search_restricted_to_documents(self):
+        results = self.index.search("backups", k=5, content_hashes=["h_contract"])
+        self.assertEqual([r["filename"] for r in results], ["contract.docx"])
+        self.assertEqual(self.index.search("backups", content_hashes=["unknown"]), [])
+
+    def test_remove_document(self):
+        self.index.remove_document("h_policy")
+        self.assertFalse(self.index.has_document("h_policy"))
+        self.assertEqual([r["filename"] for r in self.index.search("backups passwords")], ["contract.docx"])
+        self.assertEqual(self.index.document_text("h_policy"), "")
+
+    def test_chunk_paragraphs_labels_ranges(self):
+        passages = chunk_paragraphs(["a" * 10, "", "b" * 10, "c" * 10], max_chars=25)
+        self.assertEqual(passages, [("Paragraphs 1-3", "a" * 10 + "\n" + "b" * 10), ("Paragraphs 4", "c" * 10)])
+
+    def test_tokenize_drops_stopwords(self):
+        self.assertEqual(tokenize("The policy è conforme alla norma"), ["policy", "conforme", "norma"])
+
+    def test_text_loader_extracts_passages(self):
+        loader = TextLoader(MagicMock(spec=Client), MagicMock(cache_dir="unused"))
+        passages = loader.extract_passages(b"First rule.\n\nSecond rule.")
+        self.assertEqual(passages, [("Paragraphs 1-2", "First rule.\nSecond rule.")])
+
+
+class TestDocumentRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = DocumentRouter(top_k=1, flat_threshold=0.2).fit({
+            "passwords": "Password policy: passwords rotated every 90 days, password complexity rules.",
+            "backups": "Backup policy: nightly backups, backup retention one year, restore tests.",
+            "hr": "Onboarding of employees, training plan and HR procedures.",
+            "scanned": "",  # no extractable text
+        })
+
+    def test_scores_matrix_shape(self):
+        scores = self.router.scores(["password rotation", "backup retention"])
+        self.assertEqual(scores.shape, (2, 3))
+        self.assertEqual(int(scores[0].argmax()), self.router.doc_keys.index("passwords"))
+        self.assertEqual(int(scores[1].argmax()), self.router.doc_keys.index("backups"))
+
+    def test_route_picks_top_k_and_keeps_unscored(self):
+        routes = self.router.route(["How often are passwords rotated?"], ["passwords", "backups", "hr", "scanned"])
+        self.assertEqual(routes, [["passwords", "scanned"]])
+
+    def test_route_falls_back_to_all_when_flat(self):
+        candidates = ["passwords", "backups", "hr"]
+        self.assertEqual(self.router.route(["unrelated wording entirely"], candidates), [candidates])
+
+    def test_route_keeps_all_when_few_candidates(self):
+        self.assertEqual(self.router.route(["passwords"], ["passwords"]), [["passwords"]])
+
+class TestClusterQuestions(unittest.TestCase):
+
+    def test_near_duplicates_point_to_first_occurrence(self):
+        texts = [
+            "Il documento indica il responsabile del trattamento dei dati?",
+            "Esiste una procedura di backup giornaliero?",
+            "Il documento indica il responsabile del trattamento dei dati ?",
+            "il documento  indica il responsabile del trattamento dei dati?",
+            "Il documento indica il responsabile della conservazione dei dati?",
+        ]
+        self.assertEqual(cluster_questions(texts), [0, 1, 0, 0, 4])
+
+    def test_negations_and_numbers_keep_questions_apart(self):
+        texts = [
+            "Is the policy compliant with article 5 of the regulation?",
+            "Is the policy compliant with article 6 of the regulation?",
+            "Is the policy not compliant with article 5 of the regulation?",
+        ]
+        self.assertEqual(cluster_questions(texts), [0, 1, 2])
+        self.assertEqual(cluster_questions(texts[:1]), [0])
+
+
+class FakeCachesClient:
+    """Local stand-in for the Gemini files/caches API."""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created, self.deleted = [], []
+        self.files = MagicMock()
+        self.files.get.side_effect = lambda name: MagicMock(uri=f"https://files/{name}", mime_type="application/pdf")
+        self.caches = MagicMock()
+        self.caches.create.side_effect = self._create
+        self.caches.delete.side_effect = lambda name: self.deleted.append(name)
+
+    def _create(self, model, config):
+        if self.fail:
+            raise ValueError("Cached content is too small")
+        self.created.append(config)
+        return types.CachedContent(name=f"cachedContents/{len(self.created)}",
+                                   usage_metadata=types.CachedContentUsageMetadata(total_token_count=4096))
+
+
+@patch('utils.context_cache.logger')
+class TestDocumentContextCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeCachesClient()
+        self.cache = DocumentContextCache(self.client, ttl_seconds=600)
+        self.docs = [{"filename": "policy.pdf", "uri": "files/p"}, {"filename": "contract.pdf", "uri": "files/c"}]
+
+    def test_one_cache_per_instruction_and_document_set(self, mock_logger):
+        first = self.cache.get("Auditor", "gemini", "audit", self.docs, version=1)
+        self.assertEqual(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1), first)
+        self.cache.get("Librarian", "gemini", "search", self.docs, version=1)
+        routed = self.cache.get("Auditor", "gemini", "audit", self.docs[1:], version=1)  # Rows routed to fewer files
+        self.assertEqual(self.cache.get("Auditor", "gemini", "audit", self.docs[::-1], version=1), first)
+
+        self.assertEqual(len(self.client.created), 3)
+        self.assertNotEqual(routed, first)
+        self.assertEqual(len(self.client.created[2].contents[0].parts), 2)
+        config = self.client.created[0]
+        self.assertEqual(config.system_instruction, "audit")
+        self.assertEqual(config.ttl, "600s")
+        self.assertEqual([p.file_data.file_uri for p in config.contents[0].parts[1:]], ["https://files/files/p", "https://files/files/c"])
+
+    def test_new_document_set_drops_previous_caches(self, mock_logger):
+        first = self.cache.get("Auditor", "gemini", "audit", self.docs, version=1)
+        second = self.cache.get("Auditor", "gemini", "audit", self.docs[:1], version=2)
+
+        self.assertEqual((first, second), ("cachedContents/1", "cachedContents/2"))
+        self.assertEqual(self.client.deleted, [first])
+        self.cache.clear()
+        self.assertEqual(self.client.deleted, [first, second])
+
+    def test_creation_failure_is_not_retried(self, mock_logger):
+        self.client.fail = True
+        self.assertIsNone(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1))
+        self.assertIsNone(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1))
+        self.assertEqual(self.client.caches.create.call_count, 1)
+        self.assertIsNone(self.cache.get("Auditor", "gemini", "audit", [], version=1))
+
+    def test_cache_close_to_expiry_is_extended_or_recreated(self, mock_logger):
+        now = 1000.0
+        with patch('utils.context_cache.time.time', side_effect=lambda: now):
+            first = self.cache.get("Auditor", "gemini", "audit", self.docs, version=1)
+            now += 400  # Within the refresh margin of the 600s TTL
+            self.assertEqual(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1), first)
+            self.client.caches.update.assert_called_once()
+            self.assertEqual(self.client.caches.update.call_args.kwargs["config"].ttl, "600s")
+
+            now += 400
+            self.client.caches.update.side_effect = ValueError("CachedContent not found")
+            self.assertEqual(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1), "cachedContents/2")
+
+    def test_invalidated_cache_is_created_again(self, mock_logger):
+        first = self.cache.get("Auditor", "gemini", "audit", self.docs, version=1)
+        self.assertEqual(self.cache.invalidate(first), 1)
+        self.assertEqual(self.cache.get("Auditor", "gemini", "audit", self.docs, version=1), "cachedContents/2")
+
+    def test_token_count_reported_by_the_api(self, mock_logger):
+        name = self.cache.get("Auditor", "gemini", "audit", self.docs, version=1)
+        self.assertEqual(self.cache.token_count(name), 4096)
+        self.assertIsNone(self.cache.token_count("cachedContents/unknown"))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,44 @@
+import threading
+from typing import Callable, List
+
+
+class DeadlineExceeded(RuntimeError):
+    """Raised when a row (or packed request) runs past its deadline. Never retried."""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation signal, safe to trigger from any thread (a Streamlit button,
+    a job poller, a deadline timer). Running batches subscribe with `on_cancel`; the
+    first `cancel` wins and its reason is kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.cancelled = False
+        self.reason = None
+
+    def cancel(self, reason: str = "Cancelled"):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls `callback` on cancellation (at once if already cancelled). Returns a function unsubscribing it."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._unsubscribe(callback)
+        callback()
+        return lambda: None
+
+    def _unsubscribe(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
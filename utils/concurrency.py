@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import deque
+from typing import List, Optional
+
+from google.genai import errors
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """True for quota errors (HTTP 429 / RESOURCE_EXHAUSTED), however the SDK surfaced them."""
+    if isinstance(exc, errors.APIError):
+        return exc.code == 429 or exc.status == "RESOURCE_EXHAUSTED"
+    message = str(exc)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message.upper()
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease limit on the rows in flight.
+
+    The limit grows by `increase` after every full round of successful rows (as many
+    completions as the current limit) while latency and error rate stay healthy, and is
+    multiplied by `decrease_factor` on a rate-limit error. Errors of rows started before
+    the last decrease are ignored, so one burst of 429s backs off once, not once per row.
+    With `min_limit == max_limit` it is a plain fixed-size gate.
+    """
+
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 50, increase: int = 1,
+                 decrease_factor: float = 0.5, latency_tolerance: float = 2.0, max_error_rate: float = 0.2,
+                 window: int = 20):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        # Latency is healthy up to `latency_tolerance` x the best mean latency seen so far
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.history: List[dict] = []
+        self._recent = deque(maxlen=window)  # (latency, ok) of the last completions
+        self._baseline_latency: Optional[float] = None
+        self._round_successes = 0
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+        self._record("initial")
+
+    @property
+    def adaptive(self) -> bool:
+        return self.min_limit < self.max_limit
+
+    def _record(self, reason: str):
+        self.history.append({"time": time.time(), "limit": self.limit, "reason": reason})
+
+    def _gate(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> float:
+        """Waits for a free slot. Returns the start time to pass to `release`."""
+        async with self._gate():
+            await self._gate().wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return time.time()
+
+    async def release(self, started_at: float, error: Optional[BaseException] = None):
+        """Frees a slot and adapts the limit to the outcome of the row."""
+        async with self._gate():
+            self.in_flight -= 1
+            self.observe(time.time() - started_at, error, started_at)
+            self._gate().notify_all()
+
+    def observe(self, latency: float, error: Optional[BaseException] = None, started_at: Optional[float] = None):
+        """Updates the limit after a completion (`started_at` defaults to now - latency)."""
+        started_at = started_at if started_at is not None else time.time() - latency
+        if error is not None and is_rate_limit_error(error):
+            self._recent.append((latency, False))
+            if self.adaptive and started_at >= self._last_decrease:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                self._last_decrease = time.time()
+                self._round_successes = 0
+                self._record("rate limited")
+            return
+
+        self._recent.append((latency, error is None))
+        if error is not None:
+            self._round_successes = 0
+            return
+        self._round_successes += 1
+        if self._round_successes < self.limit or len(self._recent) < min(self.limit, self._recent.maxlen):
+            return
+
+        # A full round completed: grow if latency and error rate are healthy
+        self._round_successes = 0
+        ok_latencies = [lat for lat, ok in self._recent if ok]
+        mean_latency = sum(ok_latencies) / len(ok_latencies)
+        error_rate = 1 - len(ok_latencies) / len(self._recent)
+        if self._baseline_latency is None or mean_latency < self._baseline_latency:
+            self._baseline_latency = mean_latency
+        healthy = error_rate <= self.max_error_rate and mean_latency <= self.latency_tolerance * self._baseline_latency
+        if self.adaptive and healthy and self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+            self._record("healthy round")
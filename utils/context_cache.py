@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from google.genai import Client, errors, types
+
+from utils.logger import logger
+
+DEFAULT_TTL_SECONDS = 3600
+# A cache expiring within this margin (at most half its TTL) is extended before it is handed out
+REFRESH_MARGIN_SECONDS = 300
+
+
+def is_missing_cache_error(exc: BaseException) -> bool:
+    """True for the API error of a request referencing cached content that no longer exists."""
+    return (isinstance(exc, errors.APIError) and exc.code in (400, 403, 404)
+            and "cache" in str(exc).lower())
+
+
+class DocumentContextCache:
+    """
+    Explicit Gemini context caches for the loaded document set.
+
+    One cached-content entry is created per agent instruction (the API does not accept
+    a system instruction next to cached content, so the instruction lives in the cache)
+    and set of files, holding the instruction and those context/target files: every
+    loaded file, or the files routed to a row when rows are routed. All the calls on the
+    same files then reference the entry instead of re-sending them. Entries are created
+    on first use and dropped as soon as the loaded documents change (new registry version).
+
+    The server deletes an entry when its TTL elapses: entries about to expire are
+    extended (or recreated) when they are handed out, and `invalidate` forgets an entry
+    that was deleted anyway. Calls make blocking API requests: run them off the event loop.
+    """
+
+    def __init__(self, client: Client, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._version = None
+        # (agent, model, instruction hash, documents hash) -> {"name": cache name (None when creation failed), "expires_at", "tokens"}
+        self._entries: Dict[Tuple[str, str, str], dict] = {}
+
+    def get(self, agent_name: str, model: str, system_instruction, documents: List[dict], version: int) -> Optional[str]:
+        """
+        Returns the name of the cache holding `system_instruction` and `documents`
+        (registry entries with filename and uri) for the document set `version`,
+        creating it if needed. Returns None if the cache cannot be created (e.g. the
+        content is below the model's minimum cacheable size); creation is tried again
+        once the TTL has elapsed.
+        """
+        if not documents:
+            return None
+        instruction_hash = hashlib.blake2b(str(system_instruction or "").encode("utf-8"), digest_size=16).hexdigest()
+        documents_hash = hashlib.blake2b("\n".join(sorted(doc["uri"] for doc in documents)).encode("utf-8"), digest_size=16).hexdigest()
+        key = (agent_name, model, instruction_hash, documents_hash)
+        with self._lock:
+            if version != self._version:
+                self._drop_entries()
+                self._version = version
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None and entry["name"] and entry["expires_at"] - now < min(REFRESH_MARGIN_SECONDS, self.ttl_seconds / 2):
+                if not self._extend(entry["name"]):
+                    entry = None
+                else:
+                    entry["expires_at"] = now + self.ttl_seconds
+            if entry is None or (entry["name"] is None and entry["expires_at"] <= now):
+                name, tokens = self._create(agent_name, model, system_instruction, documents)
+                entry = {"name": name, "expires_at": now + self.ttl_seconds, "tokens": tokens}
+                self._entries[key] = entry
+            return entry["name"]
+
+    def token_count(self, name: str) -> Optional[int]:
+        """Tokens held by cache `name` as counted by the API, or None if unknown."""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry["name"] == name:
+                    return entry.get("tokens")
+            return None
+
+    def invalidate(self, name: Optional[str] = None) -> int:
+        """
+        Forgets the entry of cache `name` (every entry if None), e.g. after a request failed
+        because the server deleted it: the next `get` creates it again. Returns the entries dropped.
+        """
+        with self._lock:
+            dropped = [key for key, entry in self._entries.items() if name is None or entry["name"] == name]
+            for key in dropped:
+                del self._entries[key]
+            return len(dropped)
+
+    def _create(self, agent_name: str, model: str, system_instruction, documents: List[dict]) -> Tuple[Optional[str], Optional[int]]:
+        try:
+            parts = [types.Part(text="LOADED DOCUMENTS:\n" + "\n".join(
+                f'- Filename: "{doc["filename"]}", URI: "{doc["uri"]}"' for doc in documents))]
+            for doc in documents:
+                remote = self.client.files.get(name=doc["uri"])
+                parts.append(types.Part.from_uri(file_uri=remote.uri, mime_type=remote.mime_type))
+            cache = self.client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"{agent_name} documents",
+                    system_instruction=system_instruction,
+                    contents=[types.Content(role="user", parts=parts)],
+                    ttl=f"{self.ttl_seconds}s",
+                ),
+            )
+            logger.info(f"Created context cache {cache.name} for {agent_name}", f"{len(documents)} documents")
+            return cache.name, getattr(cache.usage_metadata, "total_token_count", None)
+        except Exception as e:
+            # Not fatal: requests are sent uncached (remembered so every row does not retry)
+            logger.warning(f"Context cache not created for {agent_name}", str(e))
+            return None, None
+
+    def _extend(self, name: str) -> bool:
+        """Pushes the expiry of cache `name` one TTL ahead. False if it is gone (to be recreated)."""
+        try:
+            self.client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+            return True
+        except Exception as e:
+            logger.warning(f"Context cache {name} not extended, recreating it", str(e))
+            return False
+
+    def _drop_entries(self):
+        for entry in self._entries.values():
+            if not entry["name"]:
+                continue
+            try:
+                self.client.caches.delete(name=entry["name"])
+            except Exception as e:
+                logger.warning(f"Could not delete context cache {entry['name']}", str(e))
+        self._entries = {}
+
+    def clear(self):
+        """Deletes every cache created for the current document set."""
+        with self._lock:
+            self._drop_entries()
+            self._version = None
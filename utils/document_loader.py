@@ -1,122 +1,277 @@
+import io
 import os
+import re
 import hashlib
+import tempfile
+from typing import BinaryIO, List, Tuple, Union
 from google.genai import types
 from google.genai import Client
-from docx import Document
 from abc import ABC, abstractmethod
 
+from utils.docx_stream import iter_docx_blocks, write_docx_text
+from utils.retrieval import chunk_paragraphs
+from utils.file_lifecycle import FileLifecycleManager
+from utils.uri_cache import PersistentURICache, get_uri_cache
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# A document can be loaded from a path, raw bytes or a binary file-like object (e.g. UploadedFile)
+DocumentSource = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+
 class BaseDocumentLoader(ABC):
     """Abstract Base Class for document loaders."""
-    def __init__(self, client: Client):
+    def __init__(self, client: Client, uri_cache: PersistentURICache = None, lifecycle: FileLifecycleManager = None):
         self.client = client
-        self.cache_dir = ".gemini_cache" # Changed from .pdf_cache to .gemini_cache for generality
-        os.makedirs(self.cache_dir, exist_ok=True)
-        self.uri_cache = {}
+        # Persistent, restart-safe cache (content hash -> remote file name), shared across loaders
+        self.uri_cache = uri_cache if uri_cache is not None else get_uri_cache()
+        self.cache_dir = self.uri_cache.cache_dir
+        # Optional: records uploads (with a local copy) so expired remote files can be restored
+        self.lifecycle = lifecycle
+        # (path, inode, size, mtime) -> hash, so a file checked by the service then loaded is read once
+        self._file_hash_memo = {}
+
+    def _new_hasher(self):
+        """BLAKE2b (128-bit digest): faster than MD5 on 64-bit CPUs and collision resistant."""
+        return hashlib.blake2b(digest_size=16)
 
     def _calculate_hash(self, data: bytes) -> str:
-        """Calculates MD5 hash of the data."""
-        hasher = hashlib.md5()
+        """Calculates the content hash of in-memory data."""
+        hasher = self._new_hasher()
         hasher.update(data)
         return hasher.hexdigest()
 
+    def _hash_stream(self, stream: BinaryIO) -> str:
+        """
+        Hashes a binary stream incrementally, without loading it in memory.
+        The whole content is hashed; in-memory buffers (e.g. Streamlit's UploadedFile) zero-copy.
+        The stream position is restored afterwards so it can still be uploaded.
+        """
+        start = stream.tell()
+        stream.seek(0)
+        try:
+            if hasattr(stream, "readinto") or hasattr(stream, "getbuffer"):
+                return hashlib.file_digest(stream, self._new_hasher).hexdigest()
+            hasher = self._new_hasher()
+            for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+            return hasher.hexdigest()
+        finally:
+            stream.seek(start)
+
+    def _hash_file(self, file_path: str) -> str:
+        """Hashes a file on disk in fixed-size chunks (bounded memory, whatever the file size)."""
+        stat = os.stat(file_path)
+        memo_key = (os.path.abspath(file_path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        file_hash = self._file_hash_memo.get(memo_key)
+        if file_hash is None:
+            with open(file_path, 'rb') as f:
+                file_hash = self._hash_stream(f)
+            if len(self._file_hash_memo) >= 256:
+                self._file_hash_memo.clear()
+            self._file_hash_memo[memo_key] = file_hash
+        return file_hash
+
+    def content_hash(self, source: DocumentSource) -> str:
+        """Returns the content hash of a file path, in-memory bytes or binary stream."""
+        if isinstance(source, (str, os.PathLike)):
+            return self._hash_file(source)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return self._calculate_hash(source)
+        return self._hash_stream(source)
+
+    def _source_name(self, source: DocumentSource, display_name: str = None) -> str:
+        """Display name of a source: explicit name, file basename or the stream's `name`."""
+        if display_name:
+            return display_name
+        if isinstance(source, (str, os.PathLike)):
+            return os.path.basename(source)
+        return os.path.basename(getattr(source, "name", "") or "document")
+
+    def _source_size(self, source: DocumentSource) -> int:
+        if isinstance(source, (str, os.PathLike)):
+            return os.path.getsize(source)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return memoryview(source).nbytes
+        if hasattr(source, "getbuffer"):
+            return source.getbuffer().nbytes
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END)
+        source.seek(position)
+        return size
+
+    def _upload(self, source: DocumentSource, display_name: str, mime_type: str) -> types.File:
+        """
+        Uploads a path directly, or an in-memory source from memory with an explicit mime
+        type (no temporary file). Bytes are wrapped without copying where possible.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            return self.client.files.upload(file=source)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        else:
+            source.seek(0)
+        return self.client.files.upload(
+            file=source,
+            config=types.UploadFileConfig(mime_type=mime_type, display_name=display_name),
+        )
+
+    def _record_upload(self, file_hash: str, file_ref: types.File, payload: DocumentSource,
+                       display_name: str, mime_type: str, size: int):
+        """Caches the uploaded file name and hands the upload to the lifecycle manager, if any."""
+        self.uri_cache.put(file_hash, file_ref.name, size=size)
+        if self.lifecycle is not None:
+            self.lifecycle.record(file_hash, file_ref.name, payload, mime_type, display_name)
+
+    def _readable(self, source: DocumentSource):
+        """Path or rewound binary stream suitable for parsers (zipfile, pypdf)."""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return io.BytesIO(source)
+        if not isinstance(source, (str, os.PathLike)):
+            source.seek(0)
+        return source
+
+    def extract_passages(self, source: DocumentSource) -> List[Tuple[str, str]]:
+        """
+        Extracts (location, text) passages for the local retrieval index, e.g.
+        ("Page 3", "..."). Returns an empty list when text cannot be extracted.
+        """
+        return []
+
     @abstractmethod
-    def load_document(self, file_path: str, display_name: str = None) -> str:
+    def load_document(self, source: DocumentSource, display_name: str = None, content_hash: str = None) -> str:
         """
-        Loads a document, uploads it to Gemini, and returns the URI.
-        Caches the URI based on the file's hash to avoid re-uploading.
+        Loads a document (file path, bytes or binary file-like object), uploads it to
+        Gemini, and returns the URI.
+        Caches the URI based on the content hash to avoid re-uploading; pass `content_hash`
+        when the caller already computed it, so the source is not read again.
         """
         pass
 
-class PDFLoader(BaseDocumentLoader):
+class _DirectUploadLoader(BaseDocumentLoader):
+    """Uploads the document content as-is (formats Gemini reads natively)."""
+    mime_type = "application/octet-stream"
+    label = ""
+
+    def load_document(self, source: DocumentSource, display_name: str = None, content_hash: str = None) -> str:
+        display_name = self._source_name(source, display_name)
+
+        file_hash = content_hash or self.content_hash(source)
+        cached_name = self.uri_cache.get(file_hash)
+        if cached_name:
+            print(f"Cache hit for {display_name}{self.label}. Using cached URI.")
+            return cached_name
+
+        print(f"Uploading {display_name}{self.label}...")
+        file_ref = self._upload(source, display_name, self.mime_type)
+        print(f"Uploaded {display_name} as {file_ref.name}")
+        self._record_upload(file_hash, file_ref, source, display_name, self.mime_type, self._source_size(source))
+        return file_ref.name
+
+class PDFLoader(_DirectUploadLoader):
     """
     Handles uploading and caching of PDF documents for Gemini.
     """
-    def load_document(self, file_path: str, display_name: str = None) -> str:
-        if not display_name:
-            display_name = os.path.basename(file_path)
-
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        
-        file_hash = self._calculate_hash(file_content)
-        if file_hash in self.uri_cache:
-            print(f"Cache hit for {display_name}. Using cached URI.")
-            return self.uri_cache[file_hash]
-
-        print(f"Uploading {display_name} (PDF)...")
-        file_ref = self.client.files.upload(file=file_path) # Direct upload for PDF
-        print(f"Uploaded {display_name} as {file_ref.name}")
-        self.uri_cache[file_hash] = file_ref.name
-        return file_ref.name
+    mime_type = "application/pdf"
+    label = " (PDF)"
+
+    def extract_passages(self, source: DocumentSource) -> List[Tuple[str, str]]:
+        """One passage per page (split further if the page is long), labelled "Page N"."""
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            print("pypdf not installed: PDF not indexed for local retrieval.")
+            return []
+        passages = []
+        try:
+            reader = PdfReader(self._readable(source))
+            for page_number, page in enumerate(reader.pages, start=1):
+                text = page.extract_text() or ""
+                paragraphs = text.split("\n\n") if "\n\n" in text else [text]
+                for _, chunk in chunk_paragraphs(paragraphs):
+                    passages.append((f"Page {page_number}", chunk))
+        except Exception as e:
+            print(f"Could not extract text from PDF: {e}")
+        return passages
 
 class DocxLoader(BaseDocumentLoader):
     """
     Handles uploading and caching of DOCX documents for Gemini.
-    Converts DOCX to plain text before uploading.
+    Converts DOCX to plain text before uploading: the document XML is streamed once
+    (paragraphs, tables, headers and footers in reading order, with section markers)
+    straight into the upload buffer, so memory stays bounded whatever the page count.
     """
-    def load_document(self, file_path: str, display_name: str = None) -> str:
-        if not display_name:
-            display_name = os.path.basename(file_path)
-
-        # Convert docx to text
-        doc = Document(file_path)
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(para.text)
-        text_content = "\n".join(full_text).encode('utf-8')
-
-        file_hash = self._calculate_hash(text_content)
-        if file_hash in self.uri_cache:
+    # Converted text beyond this size spills from memory to a temporary file
+    SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+    def load_document(self, source: DocumentSource, display_name: str = None, content_hash: str = None) -> str:
+        display_name = self._source_name(source, display_name)
+
+        # Key the cache on the source file, so a cache hit skips the conversion entirely
+        file_hash = content_hash or self.content_hash(source)
+        cached_name = self.uri_cache.get(file_hash)
+        if cached_name:
             print(f"Cache hit for {display_name} (DOCX). Using cached URI.")
-            return self.uri_cache[file_hash]
+            return cached_name
 
-        # Save text content to a temporary file for upload
-        temp_txt_path = os.path.join(self.cache_dir, f"{file_hash}.txt")
-        with open(temp_txt_path, "wb") as f:
-            f.write(text_content)
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_BYTES, mode="w+b") as text_stream:
+            # Convert docx to text
+            size = write_docx_text(self._readable(source), text_stream)
 
-        print(f"Uploading {display_name} (DOCX converted to TXT)...")
-        file_ref = self.client.files.upload(file=temp_txt_path)
-        print(f"Uploaded {display_name} as {file_ref.name}")
-        self.uri_cache[file_hash] = file_ref.name
-        os.remove(temp_txt_path) # Clean up temp file
+            print(f"Uploading {display_name} (DOCX converted to TXT)...")
+            file_ref = self._upload(text_stream, display_name, "text/plain")
+            print(f"Uploaded {display_name} as {file_ref.name}")
+            self._record_upload(file_hash, file_ref, text_stream, display_name, "text/plain", size)
         return file_ref.name
 
-class TextLoader(BaseDocumentLoader):
+    def extract_passages(self, source: DocumentSource) -> List[Tuple[str, str]]:
+        """Blocks grouped into passages within each section, e.g. "Section 2, Paragraphs 4-9"."""
+        passages = []
+        section, blocks = 1, []
+        for kind, text in iter_docx_blocks(self._readable(source)):
+            if kind == "section":
+                passages.extend(chunk_paragraphs(blocks, label=f"Section {section}, Paragraphs"))
+                section, blocks = int(text.strip("[]").split()[-1]), []
+            else:
+                blocks.append(text)
+        passages.extend(chunk_paragraphs(blocks, label=f"Section {section}, Paragraphs"))
+        return passages
+
+class TextLoader(_DirectUploadLoader):
     """
     Handles uploading and caching of TXT documents for Gemini.
     """
-    def load_document(self, file_path: str, display_name: str = None) -> str:
-        if not display_name:
-            display_name = os.path.basename(file_path)
+    mime_type = "text/plain"
+    label = " (TXT)"
 
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-
-        file_hash = self._calculate_hash(file_content)
-        if file_hash in self.uri_cache:
-            print(f"Cache hit for {display_name} (TXT). Using cached URI.")
-            return self.uri_dir[file_hash]
-
-        print(f"Uploading {display_name} (TXT)...")
-        file_ref = self.client.files.upload(file=file_path) # Direct upload for TXT
-        print(f"Uploaded {display_name} as {file_ref.name}")
-        self.uri_cache[file_hash] = file_ref.name
-        return file_ref.name
+    def extract_passages(self, source: DocumentSource) -> List[Tuple[str, str]]:
+        """Blank-line separated paragraphs, grouped into passages."""
+        readable = self._readable(source)
+        if isinstance(readable, (str, os.PathLike)):
+            with open(readable, "rb") as f:
+                data = f.read()
+        else:
+            data = readable.read()
+            readable.seek(0)
+        text = data.decode("utf-8", errors="replace")
+        return chunk_paragraphs(re.split(r"\n\s*\n", text))
 
 class DocumentLoaderFactory:
     """
     Factory to get the appropriate document loader based on file extension.
     """
-    def __init__(self, client: Client):
+    def __init__(self, client: Client, uri_cache: PersistentURICache = None, lifecycle: FileLifecycleManager = None):
         self.client = client
+        # A single on-disk cache so the same content is never uploaded twice, whatever its loader
+        self.uri_cache = uri_cache if uri_cache is not None else get_uri_cache()
+        self.lifecycle = lifecycle
         self.loaders = {
-            ".pdf": PDFLoader(client),
-            ".docx": DocxLoader(client),
-            ".txt": TextLoader(client),
+            ".pdf": PDFLoader(client, self.uri_cache, lifecycle),
+            ".docx": DocxLoader(client, self.uri_cache, lifecycle),
+            ".txt": TextLoader(client, self.uri_cache, lifecycle),
         }
 
     def get_loader(self, file_path: str) -> BaseDocumentLoader:
+        """Returns the loader for a file path or file name, based on its extension."""
         file_extension = os.path.splitext(file_path)[1].lower()
         loader = self.loaders.get(file_extension)
         if not loader:
@@ -0,0 +1,109 @@
+import threading
+from typing import Dict, List, Optional
+
+DOCUMENT_ROLES = ("context", "target")
+
+
+class DocumentRegistry:
+    """
+    Content-addressed registry of the documents loaded in a service.
+
+    Documents are keyed by content hash, so the same content is only ever listed once
+    per role, whichever loader handled it and however many times it is loaded.
+    Each role keeps its documents in load order.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._documents: Dict[str, dict] = {}
+        # Insertion-ordered "sets" of content hashes per role
+        self._roles: Dict[str, Dict[str, None]] = {role: {} for role in DOCUMENT_ROLES}
+        self.version = 0  # Bumped on every change of the document set
+
+    def _check_role(self, role: str):
+        if role not in self._roles:
+            raise ValueError(f"Unsupported document kind: {role}")
+
+    def get(self, content_hash: str) -> Optional[dict]:
+        """Returns the document registered under a content hash, in any role."""
+        with self._lock:
+            doc = self._documents.get(content_hash)
+            return dict(doc) if doc else None
+
+    def has(self, content_hash: str, role: str) -> bool:
+        self._check_role(role)
+        return content_hash in self._roles[role]
+
+    def register(self, content_hash: str, filename: str, uri: str, role: str, tokens: Optional[int] = None) -> bool:
+        """
+        Registers a document for a role, with the estimate of its size in model tokens
+        if known. Returns False (no-op) if the same content is already registered for that role.
+        """
+        self._check_role(role)
+        with self._lock:
+            if content_hash in self._roles[role]:
+                return False
+            doc = self._documents.setdefault(content_hash, {
+                "filename": filename,
+                "uri": uri,
+                "content_hash": content_hash,
+            })
+            if tokens is not None:
+                doc["tokens"] = tokens
+            self._roles[role][content_hash] = None
+            self.version += 1
+            return True
+
+    def documents(self, role: str) -> List[dict]:
+        """Returns the documents of a role in load order."""
+        self._check_role(role)
+        with self._lock:
+            return [dict(self._documents[h]) for h in self._roles[role]]
+
+    def replace_role(self, role: str, docs: List[dict]):
+        """
+        Replaces all documents of a role. Entries without a `content_hash` are keyed
+        on their URI, which is unique per uploaded file.
+        """
+        self._check_role(role)
+        with self._lock:
+            previous = self._roles[role]
+            self._roles[role] = {}
+            for doc in docs:
+                content_hash = doc.get("content_hash") or f"uri:{doc['uri']}"
+                entry = self._documents.setdefault(content_hash, {
+                    "filename": doc["filename"],
+                    "uri": doc["uri"],
+                    "content_hash": content_hash,
+                })
+                if doc.get("tokens") is not None:
+                    entry["tokens"] = doc["tokens"]
+                self._roles[role][content_hash] = None
+            for content_hash in previous:
+                self._discard_if_unused(content_hash)
+            self.version += 1
+
+    def update_uri(self, content_hash: str, uri: str):
+        """Points a document to a new remote file (e.g. re-uploaded after expiry)."""
+        with self._lock:
+            if content_hash in self._documents:
+                self._documents[content_hash]["uri"] = uri
+                self.version += 1
+
+    def remove(self, content_hash: str, role: Optional[str] = None):
+        """Removes a document from one role, or from all roles if none is given."""
+        with self._lock:
+            roles = [role] if role else list(self._roles)
+            for r in roles:
+                self._check_role(r)
+                self._roles[r].pop(content_hash, None)
+            self._discard_if_unused(content_hash)
+            self.version += 1
+
+    def _discard_if_unused(self, content_hash: str):
+        if not any(content_hash in hashes for hashes in self._roles.values()):
+            self._documents.pop(content_hash, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._documents)
@@ -0,0 +1,99 @@
+import math
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils.retrieval import tokenize
+
+
+class DocumentRouter:
+    """
+    Picks the documents most relevant to each checklist question.
+
+    Documents and questions are embedded in a shared TF-IDF space; one matrix product
+    (questions x documents) scores every pair at once. When the scores of a question are
+    flat (nothing stands out), the router falls back to all documents, so a question is
+    never starved of evidence because of a weak lexical signal.
+    """
+
+    def __init__(self, top_k: int = 3, flat_threshold: float = 0.2):
+        self.top_k = top_k
+        # Relative spread (max - min) / max below which scores are considered flat
+        self.flat_threshold = flat_threshold
+        self.doc_keys: List[str] = []
+        self._doc_position: Dict[str, int] = {}
+        self._vocabulary: Dict[str, int] = {}
+        self._idf = np.zeros(0, dtype=np.float32)
+        self._doc_terms: List[Dict[int, float]] = []
+
+    def fit(self, documents: Dict[str, str]) -> "DocumentRouter":
+        """Builds the TF-IDF representation of documents given as {key: text}."""
+        self.doc_keys = [key for key, text in documents.items() if text]
+        self._doc_position = {key: i for i, key in enumerate(self.doc_keys)}
+        counts = [Counter(tokenize(documents[key])) for key in self.doc_keys]
+
+        df = Counter(term for doc_counts in counts for term in doc_counts)
+        self._vocabulary = {term: i for i, term in enumerate(df)}
+        n_docs = len(self.doc_keys)
+        self._idf = np.array([math.log((1 + n_docs) / (1 + df[t])) + 1 for t in self._vocabulary], dtype=np.float32)
+
+        # Sparse rows (term index -> L2-normalised weight); only the columns used by the
+        # questions are densified when scoring, so memory stays O(docs x query terms)
+        self._doc_terms = []
+        for doc_counts in counts:
+            weights = {self._vocabulary[t]: (1 + math.log(tf)) * self._idf[self._vocabulary[t]] for t, tf in doc_counts.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            self._doc_terms.append({i: w / norm for i, w in weights.items()})
+        return self
+
+    def scores(self, queries: List[str]) -> np.ndarray:
+        """Cosine similarity matrix of shape (len(queries), len(doc_keys))."""
+        query_counts = [Counter(t for t in tokenize(q) if t in self._vocabulary) for q in queries]
+        columns = sorted({self._vocabulary[t] for qc in query_counts for t in qc})
+        if not columns or not self.doc_keys:
+            return np.zeros((len(queries), len(self.doc_keys)), dtype=np.float32)
+        position = {term_index: j for j, term_index in enumerate(columns)}
+
+        q_matrix = np.zeros((len(queries), len(columns)), dtype=np.float32)
+        for row, qc in enumerate(query_counts):
+            for term, tf in qc.items():
+                term_index = self._vocabulary[term]
+                q_matrix[row, position[term_index]] = (1 + math.log(tf)) * self._idf[term_index]
+        q_norms = np.linalg.norm(q_matrix, axis=1, keepdims=True)
+        q_matrix /= np.where(q_norms == 0, 1, q_norms)
+
+        d_matrix = np.zeros((len(self.doc_keys), len(columns)), dtype=np.float32)
+        for row, terms in enumerate(self._doc_terms):
+            for term_index, weight in terms.items():
+                j = position.get(term_index)
+                if j is not None:
+                    d_matrix[row, j] = weight
+
+        return q_matrix @ d_matrix.T
+
+    def route(self, queries: List[str], candidates: Optional[List[str]] = None) -> List[List[str]]:
+        """
+        Returns, for each query, the keys of its top-k candidate documents, or all the
+        candidates when the scores are flat. Candidates without indexed text cannot be
+        scored and are always kept.
+        """
+        candidates = list(self.doc_keys) if candidates is None else list(candidates)
+        scored = [key for key in candidates if key in self._doc_position]
+        unscored = {key for key in candidates if key not in self._doc_position}
+        if len(scored) <= self.top_k or not queries:
+            return [candidates for _ in queries]
+
+        columns = [self._doc_position[key] for key in scored]
+        matrix = self.scores(queries)[:, columns]
+
+        routes = []
+        for row in matrix:
+            best, worst = float(row.max()), float(row.min())
+            if best <= 0 or (best - worst) / best < self.flat_threshold:
+                routes.append(candidates)
+                continue
+            top = np.argsort(-row, kind="stable")[:self.top_k]
+            chosen = {scored[i] for i in top if row[i] > 0}
+            routes.append([key for key in candidates if key in chosen or key in unscored])
+        return routes
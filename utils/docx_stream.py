@@ -0,0 +1,122 @@
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+DOCUMENT_PART = "word/document.xml"
+
+
+def _paragraph_text(paragraph: ET.Element) -> str:
+    """Text of a w:p element (runs, tabs and line breaks; deleted revisions excluded)."""
+    parts = []
+    for node in paragraph.iter():
+        if node.tag == f"{W_NS}t" and node.text:
+            parts.append(node.text)
+        elif node.tag == f"{W_NS}tab":
+            parts.append("\t")
+        elif node.tag in (f"{W_NS}br", f"{W_NS}cr"):
+            parts.append("\n")
+    return "".join(parts)
+
+
+def _relationships(archive: zipfile.ZipFile) -> Dict[str, str]:
+    """Relationship id -> part name for the main document part."""
+    try:
+        root = ET.fromstring(archive.read("word/_rels/document.xml.rels"))
+    except KeyError:
+        return {}
+    return {
+        rel.get("Id"): posixpath.normpath(posixpath.join("word", rel.get("Target", "")))
+        for rel in root.iter(f"{REL_NS}Relationship")
+    }
+
+
+def _part_text(archive: zipfile.ZipFile, part_name: str) -> str:
+    """Text of a (small) header or footer part, one line per paragraph."""
+    try:
+        root = ET.fromstring(archive.read(part_name))
+    except KeyError:
+        return ""
+    lines = (_paragraph_text(p).strip() for p in root.iter(f"{W_NS}p"))
+    return " / ".join(line for line in lines if line)
+
+
+def iter_docx_blocks(source) -> Iterator[Tuple[str, str]]:
+    """
+    Streams the text blocks of a DOCX (path or seekable binary stream) in reading order.
+
+    Yields (kind, text) tuples where kind is "section", "paragraph", "table", "row",
+    "header" or "footer". The document XML is parsed incrementally and every top-level
+    block is discarded once emitted, so memory stays bounded by the largest single
+    paragraph or table, not by the document size.
+    """
+    with zipfile.ZipFile(source) as archive:
+        relationships = _relationships(archive)
+        emitted_parts = set()  # headers/footers repeated by later sections are emitted once
+        section = 1
+        tables = 0
+        yield ("section", f"[Section {section}]")
+
+        stack: List[ET.Element] = []
+        cells: List[List[str]] = []  # paragraph texts of the open table cells
+        rows: List[List[str]] = []   # cell texts of the open table rows
+
+        with archive.open(DOCUMENT_PART) as document_xml:
+            for event, elem in ET.iterparse(document_xml, events=("start", "end")):
+                tag = elem.tag
+                if event == "start":
+                    stack.append(elem)
+                    if tag == f"{W_NS}tbl" and not rows:
+                        tables += 1
+                        yield ("table", f"[Table {tables}]")
+                    elif tag == f"{W_NS}tr":
+                        rows.append([])
+                    elif tag == f"{W_NS}tc":
+                        cells.append([])
+                    continue
+
+                stack.pop()
+                if tag == f"{W_NS}p":
+                    text = _paragraph_text(elem)
+                    if cells:
+                        cells[-1].append(text)
+                    elif text.strip():
+                        yield ("paragraph", text)
+                elif tag == f"{W_NS}tc":
+                    rows[-1].append(" ".join(t.strip() for t in cells.pop() if t.strip()))
+                elif tag == f"{W_NS}tr":
+                    row_text = " | ".join(rows.pop())
+                    if cells:
+                        cells[-1].append(row_text)  # nested table: fold into the outer cell
+                    elif row_text.strip(" |"):
+                        yield ("row", row_text)
+                elif tag == f"{W_NS}sectPr":
+                    for reference, kind in ((f"{W_NS}headerReference", "header"), (f"{W_NS}footerReference", "footer")):
+                        for ref in elem.iter(reference):
+                            part_name = relationships.get(ref.get(f"{R_NS}id"))
+                            if not part_name or part_name in emitted_parts:
+                                continue
+                            emitted_parts.add(part_name)
+                            text = _part_text(archive, part_name)
+                            if text:
+                                yield (kind, f"[Section {section} {kind}] {text}")
+                    # A sectPr inside a paragraph closes that section; the body's last one closes the document
+                    if len(stack) >= 2 and stack[-1].tag == f"{W_NS}pPr":
+                        section += 1
+                        yield ("section", f"[Section {section}]")
+
+                # Drop finished top-level blocks (children of w:body) to keep memory bounded
+                if stack and stack[-1].tag == f"{W_NS}body":
+                    stack[-1].remove(elem)
+
+
+def write_docx_text(source, output: BinaryIO) -> int:
+    """Writes the DOCX text (UTF-8, one block per line) to a binary stream. Returns bytes written."""
+    written = 0
+    for _, text in iter_docx_blocks(source):
+        written += output.write(text.encode("utf-8") + b"\n")
+    return written
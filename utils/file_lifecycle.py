@@ -0,0 +1,358 @@
+import concurrent.futures
+import datetime
+import os
+import shutil
+import threading
+import time
+import weakref
+from typing import BinaryIO, Callable, Dict, Iterable, Optional, Union
+
+from google.genai import Client, errors, types
+
+from utils.logger import logger
+from utils.uri_cache import EXPIRY_MARGIN_SECONDS, REMOTE_FILE_TTL_SECONDS, PersistentURICache, file_lock, read_json, write_json
+
+# Defaults of GEMINI_GC_INTERVAL_SECONDS, GEMINI_GC_GRACE_SECONDS and GEMINI_BLOB_MAX_BYTES
+DEFAULT_GC_INTERVAL_SECONDS = 6 * 3600
+# Remote files and local copies younger than this are never collected: another service or
+# process may have just uploaded them and still be using them
+DEFAULT_GC_GRACE_SECONDS = 24 * 3600
+# Budget of the local copies kept for in-memory uploads (uploads from a file path are re-read from it)
+DEFAULT_BLOB_MAX_BYTES = 5 * 1024 ** 3
+
+# Leftover temporary files older than this are removed by the garbage collector
+STALE_TMP_SECONDS = 3600
+
+UploadPayload = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+
+# Process-wide state, per cache directory: the managers alive (their documents in use are
+# never collected) and the stop event of the single scheduled garbage collection thread
+_registry_lock = threading.Lock()
+_managers: Dict[str, "weakref.WeakSet[FileLifecycleManager]"] = {}
+_gc_schedules: Dict[str, threading.Event] = {}
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def _validation_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Single background worker of the process for remote file validations."""
+    global _executor
+    with _registry_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-lifecycle")
+        return _executor
+
+
+class FileLifecycleManager:
+    """
+    Tracks every file uploaded to the Gemini File API, from upload to deletion.
+
+    - Every upload is recorded in a ledger (`uploads.json`) with a way to upload its
+      payload again, so an expired remote file can be re-uploaded transparently: the
+      source path for uploads from disk, otherwise a local copy (`blobs/<content hash>`)
+      within a byte budget.
+    - `validate` checks remote files (in the background with `start_validation`) and
+      re-uploads the ones that expired, failed or are about to expire.
+    - `collect_garbage` deletes superseded remote uploads, unused local copies and stale
+      temporary files; `start_gc_schedule` runs it periodically on a daemon thread.
+
+    Services and processes can share the cache directory: the ledger is read and merged
+    under a file lock on every change, documents in use by any manager of the process are
+    kept, and nothing younger than the grace period is collected (other processes).
+    """
+
+    LEDGER_FILENAME = "uploads.json"
+
+    def __init__(self, client: Client, uri_cache: PersistentURICache,
+                 in_use: Optional[Callable[[], Dict[str, str]]] = None,
+                 grace_seconds: Optional[float] = None, blob_max_bytes: Optional[int] = None):
+        self.client = client
+        self.uri_cache = uri_cache
+        self.cache_dir = uri_cache.cache_dir
+        self.blob_dir = os.path.join(self.cache_dir, "blobs")
+        self.ledger_path = os.path.join(self.cache_dir, self.LEDGER_FILENAME)
+        # Documents currently loaded ({content_hash: remote name}): never collected
+        self.in_use = in_use or (lambda: {})
+        self.grace_seconds = grace_seconds if grace_seconds is not None else float(
+            os.environ.get("GEMINI_GC_GRACE_SECONDS", DEFAULT_GC_GRACE_SECONDS))
+        self.blob_max_bytes = blob_max_bytes if blob_max_bytes is not None else int(
+            os.environ.get("GEMINI_BLOB_MAX_BYTES", DEFAULT_BLOB_MAX_BYTES))
+        self._lock = threading.RLock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._ledger: Dict[str, dict] = read_json(self.ledger_path)  # remote name -> upload record
+        self._key = os.path.abspath(self.cache_dir)
+        with _registry_lock:
+            _managers.setdefault(self._key, weakref.WeakSet()).add(self)
+
+    # --- Persistence ---
+
+    def _update_ledger(self, added: Optional[Dict[str, dict]] = None, removed: Iterable[str] = ()) -> Dict[str, dict]:
+        """Applies changes to the ledger on disk (re-read under the file lock, so no other writer's update is lost)."""
+        with self._lock, file_lock(self.ledger_path):
+            ledger = read_json(self.ledger_path)
+            ledger.update(added or {})
+            for name in removed:
+                ledger.pop(name, None)
+            write_json(self.ledger_path, ledger)
+            self._ledger = ledger
+            return ledger
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.blob_dir, content_hash)
+
+    def _process_in_use(self) -> Dict[str, str]:
+        """Documents in use by every manager of this cache directory in the process."""
+        with _registry_lock:
+            managers = list(_managers.get(self._key, ())) or [self]
+        documents = {}
+        for manager in managers:
+            try:
+                documents.update(manager.in_use())
+            except Exception as e:
+                logger.warning("Could not list the documents in use", str(e))
+        return documents
+
+    # --- Recording ---
+
+    def _store_blob(self, content_hash: str, payload: UploadPayload) -> bool:
+        """Keeps a local copy of an in-memory payload, within the blob budget. False if it does not fit."""
+        blob_path = self._blob_path(content_hash)
+        if os.path.exists(blob_path):
+            return True
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            size = memoryview(payload).nbytes
+        else:
+            position = payload.tell()
+            size = payload.seek(0, os.SEEK_END)
+            payload.seek(position)
+        if size > self.blob_max_bytes:
+            logger.warning(f"Upload {content_hash} is larger than the local copy budget", "It cannot be re-uploaded once expired")
+            return False
+        self._evict_blobs(self.blob_max_bytes - size)
+
+        tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+        else:
+            position = payload.tell()
+            payload.seek(0)
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(payload, f)
+            payload.seek(position)
+        os.replace(tmp_path, blob_path)
+        return True
+
+    def _evict_blobs(self, max_bytes: int):
+        """Deletes the oldest local copies not in use until they take at most `max_bytes`."""
+        in_use = self._process_in_use()
+        blobs = []
+        for filename in os.listdir(self.blob_dir):
+            path = os.path.join(self.blob_dir, filename)
+            if not filename.endswith(".tmp") and os.path.isfile(path):
+                stat = os.stat(path)
+                blobs.append((stat.st_mtime, stat.st_size, filename, path))
+        total = sum(size for _, size, _, _ in blobs)
+        for _, size, filename, path in sorted(blobs):
+            if total <= max_bytes:
+                break
+            if filename in in_use:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def record(self, content_hash: str, name: str, payload: UploadPayload, mime_type: str, display_name: str):
+        """
+        Records an upload and how to upload it again: its source path for a payload read
+        from disk, otherwise a local copy of the payload (within the blob budget).
+        """
+        record = {
+            "content_hash": content_hash,
+            "mime_type": mime_type,
+            "display_name": display_name,
+            "uploaded_at": time.time(),
+        }
+        if isinstance(payload, (str, os.PathLike)):
+            path = os.path.abspath(payload)
+            if path != os.path.abspath(self._blob_path(content_hash)):
+                stat = os.stat(path)
+                record.update(source_path=path, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+        else:
+            self._store_blob(content_hash, payload)
+        self._update_ledger(added={name: record})
+
+    def uploads(self) -> Dict[str, dict]:
+        """Recorded uploads (remote name -> content_hash, mime_type, display_name, uploaded_at)."""
+        with self._lock:
+            self._ledger = read_json(self.ledger_path)
+            return {name: dict(record) for name, record in self._ledger.items()}
+
+    def _local_copy(self, content_hash: str) -> Optional[str]:
+        """Path of a file holding the payload of `content_hash`: its local copy or an unchanged source file."""
+        blob_path = self._blob_path(content_hash)
+        if os.path.exists(blob_path):
+            return blob_path
+        for record in self.uploads().values():
+            path = record.get("source_path")
+            if record.get("content_hash") != content_hash or not path:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (record.get("source_size"), record.get("source_mtime_ns")):
+                return path
+        return None
+
+    # --- Validation ---
+
+    def _needs_upload(self, name: str) -> bool:
+        """True if the remote file is gone, failed or expires within the safety margin."""
+        try:
+            remote = self.client.files.get(name=name)
+        except errors.ClientError as e:
+            if e.code in (403, 404):
+                return True
+            raise
+        if remote.state == types.FileState.FAILED:
+            return True
+        if remote.expiration_time:
+            margin = datetime.timedelta(seconds=EXPIRY_MARGIN_SECONDS)
+            return remote.expiration_time - margin <= datetime.datetime.now(datetime.timezone.utc)
+        return False
+
+    def reupload(self, content_hash: str, name: str) -> str:
+        """Uploads the local copy (or source file) of a file again and returns the new remote name."""
+        record = self.uploads().get(name, {})
+        local_path = self._local_copy(content_hash)
+        if local_path is None:
+            raise FileNotFoundError(f"No local copy of {record.get('display_name', name)} to re-upload")
+        file_ref = self.client.files.upload(
+            file=local_path,
+            config=types.UploadFileConfig(mime_type=record.get("mime_type"), display_name=record.get("display_name")),
+        )
+        self.uri_cache.put(content_hash, file_ref.name, size=os.path.getsize(local_path))
+        self.record(content_hash, file_ref.name, local_path, record.get("mime_type"), record.get("display_name"))
+        logger.info(f"Re-uploaded expired file {name}", f"New file: {file_ref.name}")
+        return file_ref.name
+
+    def validate(self, documents: Dict[str, str]) -> Dict[str, dict]:
+        """
+        Checks the remote files of {content_hash: remote name} and re-uploads the expired
+        ones. Returns {content_hash: {"name": new name}} for re-uploaded files and
+        {content_hash: {"error": message}} for files that could not be checked or restored.
+        """
+        results = {}
+        for content_hash, name in documents.items():
+            try:
+                if self._needs_upload(name):
+                    results[content_hash] = {"name": self.reupload(content_hash, name)}
+            except Exception as e:
+                results[content_hash] = {"error": str(e)}
+        return results
+
+    def start_validation(self, documents: Dict[str, str]) -> concurrent.futures.Future:
+        """Runs `validate` on the process's background worker; the future resolves to its result."""
+        return _validation_executor().submit(self.validate, dict(documents))
+
+    # --- Garbage collection ---
+
+    def collect_garbage(self) -> Dict[str, int]:
+        """
+        Deletes remote uploads superseded by a newer upload of the same content (or whose
+        content left the upload cache), local copies of content no longer cached, and
+        stale temporary files. Documents in use in the process, current uploads of the
+        shared upload cache and anything younger than the grace period are always kept.
+        The ledger stays locked meanwhile, so other processes' uploads are seen. Returns the counts.
+        """
+        in_use = self._process_in_use()
+        in_use_names = set(in_use.values())
+        now = time.time()
+        removed = {"remote": 0, "local": 0}
+
+        with self._lock, file_lock(self.ledger_path):
+            ledger = read_json(self.ledger_path)
+            dropped = []
+            for name, record in ledger.items():
+                content_hash = record.get("content_hash")
+                entry = self.uri_cache.get_entry(content_hash)  # Re-read if another process changed it
+                age = now - record.get("uploaded_at", 0)
+                if name in in_use_names or (entry and entry["name"] == name) or age < self.grace_seconds:
+                    continue
+                if age < REMOTE_FILE_TTL_SECONDS:
+                    try:
+                        self.client.files.delete(name=name)
+                        removed["remote"] += 1
+                    except errors.ClientError as e:
+                        if e.code not in (403, 404):
+                            logger.warning(f"Could not delete remote file {name}", str(e))
+                            continue
+                # Past the TTL the remote file is already gone: only the record is dropped
+                dropped.append(name)
+            for name in dropped:
+                del ledger[name]
+            write_json(self.ledger_path, ledger)
+            self._ledger = ledger
+
+            referenced = {record.get("content_hash") for record in ledger.values()} | set(in_use)
+            for filename in os.listdir(self.blob_dir):
+                path = os.path.join(self.blob_dir, filename)
+                age = now - os.path.getmtime(path)
+                if filename.endswith(".tmp"):
+                    collect = age > STALE_TMP_SECONDS
+                else:
+                    collect = (age >= self.grace_seconds and filename not in referenced
+                               and self.uri_cache.get_entry(filename) is None)
+                if collect:
+                    os.remove(path)
+                    removed["local"] += 1
+
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.endswith(".tmp") and os.path.isfile(path) and now - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                os.remove(path)
+                removed["local"] += 1
+        return removed
+
+    def start_gc_schedule(self, interval_seconds: Optional[int] = None):
+        """
+        Runs `collect_garbage` every `interval_seconds` (GEMINI_GC_INTERVAL_SECONDS) on a
+        daemon thread. One thread per cache directory and process, whatever the number of
+        managers: it runs with any manager still alive and stops when none is left.
+        """
+        if interval_seconds is None:
+            interval_seconds = int(os.environ.get("GEMINI_GC_INTERVAL_SECONDS", DEFAULT_GC_INTERVAL_SECONDS))
+        with _registry_lock:
+            if interval_seconds <= 0 or self._key in _gc_schedules:
+                return
+            stop = _gc_schedules[self._key] = threading.Event()
+        key = self._key
+
+        def _loop():
+            while not stop.wait(interval_seconds):
+                with _registry_lock:
+                    managers = list(_managers.get(key, ()))
+                if not managers:
+                    break
+                try:
+                    removed = managers[0].collect_garbage()
+                    logger.info("File garbage collection", f"{removed['remote']} remote, {removed['local']} local files removed")
+                except Exception as e:
+                    logger.warning("File garbage collection failed", str(e))
+                del managers
+            with _registry_lock:
+                if _gc_schedules.get(key) is stop:
+                    del _gc_schedules[key]
+
+        threading.Thread(target=_loop, name="file-gc", daemon=True).start()
+
+    def stop(self):
+        """Unregisters the manager; the scheduled garbage collection stops with the last one of its directory."""
+        with _registry_lock:
+            managers = _managers.get(self._key)
+            if managers is not None:
+                managers.discard(self)
+                if not managers and self._key in _gc_schedules:
+                    _gc_schedules.pop(self._key).set()
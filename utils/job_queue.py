@@ -0,0 +1,162 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, Optional, Set, Tuple
+
+DEFAULT_QUEUE_PATH = os.path.join(".gemini_cache", "jobs.sqlite")
+# A running job whose worker has not reported for this long is handed to another worker
+DEFAULT_STALE_SECONDS = 900
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+# Columns returned by `get` and `list_jobs` (the payload can be large and is only read by `claim`)
+JOB_COLUMNS = "id, status, params, total, completed, errors, worker, error, created_at, started_at, heartbeat_at, finished_at"
+
+
+class JobQueue:
+    """
+    Local queue of batch analysis jobs shared by the web process and worker processes
+    through a SQLite database (WAL mode, so pollers never block workers).
+
+    The web process `submit`s a job (batch parameters plus the service state to analyze)
+    and polls `get` / `results`. Workers `claim` the oldest queued job, append its results
+    as rows complete (`add_result`, which also acts as a heartbeat) and `finish` it. A
+    running job whose worker stopped reporting for `stale_after` seconds is claimed again.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, stale_after: float = DEFAULT_STALE_SECONDS):
+        self.path = path
+        self.stale_after = stale_after
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return contextlib.closing(conn)
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        if "payload" in job:
+            job["payload"] = json.loads(job["payload"])
+        return job
+
+    def submit(self, params: dict, payload: dict, total: int = 0) -> str:
+        """Queues a job and returns its id."""
+        job_id = f"job-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        with self._connect() as conn:
+            conn.execute("INSERT INTO jobs (id, status, params, payload, total, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, QUEUED, json.dumps(params), json.dumps(payload, default=str), total, time.time()))
+        return job_id
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """
+        Takes the oldest queued job (or a running job whose worker went silent) for `worker`.
+        Returns the job with its params and payload; `resumed` is True for a re-claimed job.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # One claimer at a time
+            row = conn.execute(f"SELECT {JOB_COLUMNS}, payload FROM jobs WHERE status = ? OR (status = ? AND heartbeat_at < ?) "
+                               "ORDER BY created_at LIMIT 1", (QUEUED, RUNNING, now - self.stale_after)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = ?, worker = ?, started_at = COALESCE(started_at, ?), heartbeat_at = ? WHERE id = ?",
+                         (RUNNING, worker, now, now, row["id"]))
+            conn.execute("COMMIT")
+        job = self._job(row)
+        job["resumed"] = job["status"] == RUNNING
+        job.update(status=RUNNING, worker=worker)
+        return job
+
+    def heartbeat(self, job_id: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING))
+
+    def add_result(self, job_id: str, result: dict):
+        """Appends a batch result to the job (success and error results count towards its progress)."""
+        status = result.get("status")
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO job_results (job_id, seq, result) "
+                         "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM job_results WHERE job_id = ?), ?)",
+                         (job_id, job_id, json.dumps(result, default=str)))
+            conn.execute("UPDATE jobs SET completed = completed + ?, errors = errors + ?, heartbeat_at = ? WHERE id = ?",
+                         (int(status == "success"), int(status == "error"), time.time(), job_id))
+            conn.execute("COMMIT")
+
+    def completed_rows(self, job_id: str) -> Set[int]:
+        """Indices of the rows with a successful result appended to the job (one scan of its results)."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT json_extract(result, '$.index') FROM job_results WHERE job_id = ? "
+                                "AND json_extract(result, '$.status') = 'success'", (job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def finish(self, job_id: str, error: str = None):
+        """Marks a running job done (or failed with `error`). Cancelled jobs stay cancelled."""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                         (FAILED if error else DONE, error, time.time(), job_id, RUNNING))
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels a queued or running job (its worker stops at its next result). Returns whether it was active."""
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                                  (CANCELLED, time.time(), job_id, QUEUED, RUNNING))
+            return cursor.rowcount > 0
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def list_jobs(self, limit: int = 20) -> List[dict]:
+        """Most recent jobs first."""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def results(self, job_id: str, after_seq: int = 0) -> List[Tuple[int, dict]]:
+        """Results appended after `after_seq`, as (seq, result) in order."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT seq, result FROM job_results WHERE job_id = ? AND seq > ? ORDER BY seq",
+                                (job_id, after_seq)).fetchall()
+        return [(row["seq"], json.loads(row["result"])) for row in rows]
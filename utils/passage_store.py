@@ -0,0 +1,64 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+DEFAULT_MAX_AGE_DAYS = 30
+
+
+class PassageStore:
+    """
+    Indexed passages of loaded documents in SQLite, keyed by content hash, shared by the
+    web process and the worker processes of the same cache directory. A state snapshot
+    (`ComplianceService.export_state`) then references the documents it needs instead of
+    copying their text into every job. Entries not referenced for `max_age_seconds` are
+    purged when the store is opened.
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS passages (content_hash TEXT PRIMARY KEY, passages TEXT NOT NULL, "
+              "used_at REAL NOT NULL)")
+
+    def __init__(self, path: str, max_age_seconds: float = DEFAULT_MAX_AGE_DAYS * 86400):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with contextlib.closing(sqlite3.connect(path, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self.SCHEMA)
+            conn.execute("DELETE FROM passages WHERE used_at < ?", (time.time() - max_age_seconds,))
+            conn.commit()
+
+    def missing(self, content_hashes: Iterable[str]) -> List[str]:
+        """Content hashes among `content_hashes` not stored yet; the stored ones are marked as used."""
+        hashes = list(content_hashes)
+        stored = set()
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            for start in range(0, len(hashes), 500):  # Below SQLite's host parameter limit
+                chunk = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                conn.execute(f"UPDATE passages SET used_at = ? WHERE content_hash IN ({placeholders})", (time.time(), *chunk))
+                stored.update(row[0] for row in conn.execute(
+                    f"SELECT content_hash FROM passages WHERE content_hash IN ({placeholders})", chunk))
+            conn.commit()
+        return [h for h in hashes if h not in stored]
+
+    def put_many(self, passages: Dict[str, List[Tuple[str, str]]]):
+        """Stores the passages of each content hash (a content hash always has the same passages)."""
+        now = time.time()
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.executemany("INSERT OR REPLACE INTO passages (content_hash, passages, used_at) VALUES (?, ?, ?)",
+                             [(h, json.dumps(doc_passages), now) for h, doc_passages in passages.items()])
+            conn.commit()
+
+    def get_many(self, content_hashes: Iterable[str]) -> Dict[str, List[Tuple[str, str]]]:
+        """Passages of the stored `content_hashes` (missing ones are left out)."""
+        hashes = list(content_hashes)
+        found = {}
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                rows = conn.execute(f"SELECT content_hash, passages FROM passages WHERE content_hash IN ({','.join('?' * len(chunk))})",
+                                    chunk).fetchall()
+                found.update((h, [tuple(p) for p in json.loads(passages)]) for h, passages in rows)
+        return found
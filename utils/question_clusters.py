@@ -0,0 +1,67 @@
+import math
+import re
+from collections import Counter
+from typing import List
+
+import numpy as np
+
+from utils.retrieval import TOKEN_PATTERN
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+NUMBER_PATTERN = re.compile(r"\d+")
+# Rows of the similarity matrix computed at once (bounds memory to BLOCK_ROWS x questions)
+BLOCK_ROWS = 512
+
+
+def _features(text: str) -> List[str]:
+    """Word unigrams and bigrams. Stopwords are kept: "non", "not" change the meaning of a question."""
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def cluster_questions(texts: List[str], threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> List[int]:
+    """
+    Groups near-duplicate questions by TF-IDF cosine similarity (word unigrams and bigrams).
+
+    Returns, for each text, the position of its cluster's representative: the first
+    member in checklist order (a text that is its own representative has no duplicate
+    before it). Texts are only grouped with a representative whose similarity reaches
+    `threshold` and that contains exactly the same numbers ("Art. 5" is not "Art. 6").
+    """
+    n = len(texts)
+    representative = list(range(n))
+    if n < 2:
+        return representative
+
+    counts = [Counter(_features(text)) for text in texts]
+    df = Counter(feature for text_counts in counts for feature in text_counts)
+    # Features of a single text never contribute to a similarity: they only count in the norm
+    shared = {feature: j for j, feature in enumerate(f for f, d in df.items() if d > 1)}
+    if not shared:
+        return representative
+
+    matrix = np.zeros((n, len(shared)), dtype=np.float32)
+    for i, text_counts in enumerate(counts):
+        norm = 0.0
+        for feature, tf in text_counts.items():
+            weight = (1 + math.log(tf)) * (math.log((1 + n) / (1 + df[feature])) + 1)
+            norm += weight * weight
+            j = shared.get(feature)
+            if j is not None:
+                matrix[i, j] = weight
+        matrix[i] /= math.sqrt(norm) or 1.0
+
+    numbers = [sorted(NUMBER_PATTERN.findall(text)) for text in texts]
+    assigned = [False] * n
+    for start in range(0, n, BLOCK_ROWS):
+        similarities = matrix[start:start + BLOCK_ROWS] @ matrix.T
+        for offset, row in enumerate(similarities):
+            i = start + offset
+            if assigned[i]:
+                continue
+            assigned[i] = True
+            for j in np.nonzero(row[i + 1:] >= threshold)[0] + i + 1:
+                if not assigned[j] and numbers[j] == numbers[i]:
+                    assigned[j] = True
+                    representative[j] = i
+    return representative
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+
+# Rough size of a token for estimates (Gemini averages ~4 characters per token)
+CHARS_PER_TOKEN = 4
+# Output allowance counted for a request that does not set max_output_tokens
+DEFAULT_OUTPUT_TOKENS = 1024
+
+
+def _file_name(uri: str) -> str:
+    """Remote file name ("files/abc") of a file name or a full file URI."""
+    index = uri.find("files/")
+    return uri[index:] if index >= 0 else uri
+
+
+def estimate_request_tokens(llm_request, file_tokens: Optional[Dict[str, int]] = None, cached_tokens: int = 0) -> int:
+    """
+    Estimated tokens of an ADK LlmRequest: its text (instruction and contents), the files it
+    attaches (`file_tokens`: estimate per remote file name or URI), the cached content it
+    references (`cached_tokens`), plus the output allowance.
+    """
+    chars = 0
+    tokens = cached_tokens
+    files = {_file_name(uri): count for uri, count in (file_tokens or {}).items()}
+    config = llm_request.config
+    if isinstance(config.system_instruction, str):
+        chars += len(config.system_instruction)
+    for content in llm_request.contents or []:
+        for part in content.parts or []:
+            if part.text:
+                chars += len(part.text)
+            elif part.file_data and part.file_data.file_uri:
+                tokens += files.get(_file_name(part.file_data.file_uri), 0)
+    return tokens + chars // CHARS_PER_TOKEN + (config.max_output_tokens or DEFAULT_OUTPUT_TOKENS)
+
+
+class TokenBucketLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets, as two token buckets refilled
+    continuously (each holds at most one minute of budget).
+
+    Callers reserve capacity under a lock and then wait until their reservation is
+    covered: buckets go into debt, so every caller waits behind the ones that reserved
+    before it (first come, first served), whichever thread or event loop it runs on.
+    A reservation whose request is never sent (e.g. its row hit its deadline or was
+    stopped while waiting) is refunded. A budget of 0 is not enforced.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self._lock = threading.Lock()
+        self._updated = time.monotonic()
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute: int, tokens_per_minute: int):
+        """Sets the budgets (full buckets)."""
+        with self._lock:
+            self.requests_per_minute = max(0, requests_per_minute)
+            self.tokens_per_minute = max(0, tokens_per_minute)
+            self._requests = float(self.requests_per_minute)
+            self._tokens = float(self.tokens_per_minute)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests_per_minute or self.tokens_per_minute)
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserves one request and `tokens` tokens. Returns the seconds to wait before sending it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0
+            if self.requests_per_minute:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # A request larger than the whole budget waits for a full bucket, not forever
+                self._tokens -= min(tokens, self.tokens_per_minute)
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60 / self.tokens_per_minute)
+            return wait
+
+    def refund(self, tokens: int = 0):
+        """Gives back a reservation of one request and `tokens` tokens whose request was not sent."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.requests_per_minute:
+                self._requests = min(self.requests_per_minute, self._requests + 1)
+            if self.tokens_per_minute:
+                self._tokens = min(self.tokens_per_minute, self._tokens + min(tokens, self.tokens_per_minute))
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocks until the request may be sent. Returns the time waited."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """
+        Waits (without blocking the event loop) until the request may be sent. Returns the
+        time waited. Cancelled while waiting (row deadline, Stop), the reservation is refunded.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.refund(tokens)
+                raise
+        return wait
+
+
+_shared_limiter: Optional[TokenBucketLimiter] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_limiter(requests_per_minute: int = 0, tokens_per_minute: int = 0) -> TokenBucketLimiter:
+    """
+    Returns the process-wide limiter (one per process, shared by every service and
+    Streamlit session), reconfigured if the budgets changed.
+    """
+    global _shared_limiter
+    with _shared_lock:
+        if _shared_limiter is None:
+            _shared_limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+        elif (_shared_limiter.requests_per_minute, _shared_limiter.tokens_per_minute) != (requests_per_minute, tokens_per_minute):
+            _shared_limiter.configure(requests_per_minute, tokens_per_minute)
+        return _shared_limiter
@@ -0,0 +1,101 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional
+
+import aiosqlite
+
+DEFAULT_MAX_AGE_DAYS = 30
+
+
+def normalize_text(text: str) -> str:
+    """Case and whitespace insensitive form of a question or description."""
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+
+def result_key(question: str, description: str, context_hashes: Iterable[str], target_hashes: Iterable[str],
+               model: str, prompt_version: str, packed: bool = False) -> str:
+    """
+    Key of a row analysis: same question, same documents, same model and prompts -> same answer.
+    Answers given within a packed request (another prompt) get their own keys with `packed`.
+    """
+    fields = {
+        "question": normalize_text(question),
+        "description": normalize_text(description),
+        "context": sorted(h for h in context_hashes if h),
+        "target": sorted(h for h in target_hashes if h),
+        "model": model,
+        "prompt_version": prompt_version,
+    }
+    if packed:
+        fields["packed"] = True
+    payload = json.dumps(fields, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent memo of row analyses (parsed Risposta/Confidenza/Giustificazione) in SQLite,
+    keyed by `result_key`. Entries older than `max_age_seconds` are ignored and purged.
+
+    `get`/`put` are for synchronous callers; `aget_many`/`aput` use aiosqlite so the
+    batch event loop is never blocked on disk.
+    """
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+
+    def __init__(self, path: str, max_age_seconds: float = DEFAULT_MAX_AGE_DAYS * 86400):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with contextlib.closing(sqlite3.connect(path, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self.SCHEMA)
+            conn.execute("DELETE FROM results WHERE created_at < ?", (self._oldest(),))
+            conn.commit()
+
+    def _oldest(self) -> float:
+        return time.time() - self.max_age_seconds
+
+    def get(self, key: str) -> Optional[dict]:
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            row = conn.execute("SELECT result FROM results WHERE key = ? AND created_at >= ?",
+                               (key, self._oldest())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, result: dict):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.execute("INSERT OR REPLACE INTO results (key, result, created_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(result), time.time()))
+            conn.commit()
+
+    async def aget_many(self, keys: List[str]) -> Dict[str, dict]:
+        """Cached results of `keys` (missing keys are left out)."""
+        found = {}
+        async with aiosqlite.connect(self.path, timeout=30) as conn:
+            for start in range(0, len(keys), 500):  # Below SQLite's host parameter limit
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                async with conn.execute(f"SELECT key, result FROM results WHERE key IN ({placeholders}) AND created_at >= ?",
+                                        (*chunk, self._oldest())) as cursor:
+                    async for key, result in cursor:
+                        found[key] = json.loads(result)
+        return found
+
+    async def aget(self, key: str) -> Optional[dict]:
+        return (await self.aget_many([key])).get(key)
+
+    async def aput(self, key: str, result: dict):
+        async with aiosqlite.connect(self.path, timeout=30) as conn:
+            await conn.execute("INSERT OR REPLACE INTO results (key, result, created_at) VALUES (?, ?, ?)",
+                               (key, json.dumps(result), time.time()))
+            await conn.commit()
+
+    def clear(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.execute("DELETE FROM results")
+            conn.commit()
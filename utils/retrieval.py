@@ -0,0 +1,153 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# Very common Italian/English words carry no signal for matching checklist questions
+STOPWORDS = frozenset("""
+a ad al alla alle allo agli ai anche che chi ci con da dal dalla dalle dei del della delle dello
+di e ed gli ha hanno i il in la le lo ma nei nel nella nelle non o per piu se si sono su sul
+sulla tra un una uno è
+an and are as at be by for from has have in is it its of on or that the this to was were will with
+""".split())
+
+DEFAULT_PASSAGE_CHARS = 1200
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens, without stopwords and single characters."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def chunk_paragraphs(paragraphs: Iterable[str], label: str = "Paragraphs",
+                     max_chars: int = DEFAULT_PASSAGE_CHARS) -> List[Tuple[str, str]]:
+    """
+    Groups consecutive non-empty paragraphs into passages of about `max_chars` characters.
+    Returns (location, text) tuples such as ("Paragraphs 4-9", "...").
+    """
+    passages = []
+    current, first = [], None
+    size = 0
+    for number, paragraph in enumerate(paragraphs, start=1):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and size + len(paragraph) > max_chars:
+            passages.append((_range_label(label, first, last), "\n".join(current)))
+            current, size = [], 0
+        if not current:
+            first = number
+        current.append(paragraph)
+        size += len(paragraph)
+        last = number
+    if current:
+        passages.append((_range_label(label, first, last), "\n".join(current)))
+    return passages
+
+
+def _range_label(label: str, first: int, last: int) -> str:
+    return f"{label} {first}" if first == last else f"{label} {first}-{last}"
+
+
+class LexicalIndex:
+    """
+    In-process BM25 index over document passages (pages or paragraph groups).
+
+    Built once per document at load time; `search` returns the best passages with their
+    real filename and location, so evidence can be cited without an LLM retrieval step.
+    Thread-safe: documents are added from the parallel upload workers.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._passages: Dict[int, dict] = {}
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)  # term -> {passage_id: tf}
+        self._lengths: Dict[int, int] = {}
+        self._documents: Dict[str, List[int]] = {}  # content_hash -> passage ids
+        self._total_length = 0
+        self._next_id = 0
+
+    def has_document(self, content_hash: str) -> bool:
+        return content_hash in self._documents
+
+    def add_document(self, content_hash: str, filename: str, passages: List[Tuple[str, str]]):
+        """Indexes the (location, text) passages of a document, replacing any previous version."""
+        with self._lock:
+            self.remove_document(content_hash)
+            ids = []
+            for location, text in passages:
+                tokens = tokenize(text)
+                if not tokens:
+                    continue
+                passage_id = self._next_id
+                self._next_id += 1
+                self._passages[passage_id] = {
+                    "content_hash": content_hash,
+                    "filename": filename,
+                    "location": location,
+                    "text": text,
+                }
+                for term, tf in Counter(tokens).items():
+                    self._postings[term][passage_id] = tf
+                self._lengths[passage_id] = len(tokens)
+                self._total_length += len(tokens)
+                ids.append(passage_id)
+            self._documents[content_hash] = ids
+
+    def remove_document(self, content_hash: str):
+        with self._lock:
+            for passage_id in self._documents.pop(content_hash, []):
+                passage = self._passages.pop(passage_id)
+                for term in set(tokenize(passage["text"])):
+                    postings = self._postings.get(term)
+                    if postings is not None:
+                        postings.pop(passage_id, None)
+                        if not postings:
+                            del self._postings[term]
+                self._total_length -= self._lengths.pop(passage_id)
+
+    def document_text(self, content_hash: str) -> str:
+        """Full indexed text of a document (empty if it could not be indexed)."""
+        with self._lock:
+            return "\n".join(self._passages[i]["text"] for i in self._documents.get(content_hash, []))
+
+    def document_passages(self, content_hash: str) -> List[Tuple[str, str]]:
+        """Indexed (location, text) passages of a document, as given to `add_document`."""
+        with self._lock:
+            return [(self._passages[i]["location"], self._passages[i]["text"]) for i in self._documents.get(content_hash, [])]
+
+    def search(self, query: str, k: int = 5, content_hashes: Optional[Iterable[str]] = None) -> List[dict]:
+        """
+        Returns the top-k passages for a query as dicts with filename, location, text
+        and score, optionally restricted to some documents.
+        """
+        with self._lock:
+            if not self._passages:
+                return []
+            allowed = None
+            if content_hashes is not None:
+                allowed = {i for h in content_hashes for i in self._documents.get(h, [])}
+                if not allowed:
+                    return []
+
+            n = len(self._passages)
+            avg_length = self._total_length / n
+            scores: Dict[int, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for passage_id, tf in postings.items():
+                    if allowed is not None and passage_id not in allowed:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[passage_id] / avg_length)
+                    scores[passage_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+            return [dict(self._passages[i], score=round(score, 4)) for i, score in best]
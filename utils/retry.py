@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+from google.genai import errors
+
+from utils.cancellation import DeadlineExceeded
+from utils.concurrency import is_rate_limit_error
+
+T = TypeVar("T")
+
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+TRANSIENT_STATUS_CODES = {408, 500, 502, 503, 504}
+TRANSIENT_MARKERS = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL", "timed out", "Connection reset")
+
+
+def classify_error(exc: BaseException) -> str:
+    """
+    Sorts an agent call failure into RATE_LIMIT (quota, retry later), TRANSIENT
+    (server or network hiccup, retry) or PERMANENT (bad request, missing document...).
+    """
+    if isinstance(exc, DeadlineExceeded):
+        return PERMANENT  # The row's time budget is spent
+    if is_rate_limit_error(exc):
+        return RATE_LIMIT
+    if isinstance(exc, errors.APIError):
+        return TRANSIENT if exc.code in TRANSIENT_STATUS_CODES else PERMANENT
+    if isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return TRANSIENT
+    message = str(exc)
+    if any(marker in message for marker in TRANSIENT_MARKERS):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter: attempt n waits uniform(0, min(max_delay, base * 2**n))."""
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when the backend stayed unavailable for longer than the breaker waits."""
+
+
+class CircuitBreaker:
+    """
+    Pauses every caller while the backend is clearly down.
+
+    After `failure_threshold` consecutive transient failures the circuit opens: callers
+    wait in `before_call` instead of failing. After `reset_timeout` seconds a single probe
+    call is let through (half-open); its success closes the circuit, its failure reopens
+    it. If the circuit stays open for more than `give_up_after` seconds, callers get a
+    CircuitOpenError, so a long outage does not hang the batch forever.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, give_up_after: float = 600.0,
+                 on_state_change: Optional[Callable[[str], None]] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.give_up_after = give_up_after
+        self.on_state_change = on_state_change
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._down_since: Optional[float] = None  # First opening of the current outage
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            if self.on_state_change:
+                self.on_state_change(state)
+
+    async def before_call(self):
+        """Returns when a call may be made; waits while the circuit is open."""
+        while True:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self._down_since is not None and now - self._down_since > self.give_up_after:
+                raise CircuitOpenError(f"Backend unavailable for more than {self.give_up_after:.0f}s")
+            if self.state == self.OPEN and now >= self._opened_at + self.reset_timeout:
+                self._set_state(self.HALF_OPEN)  # This caller is the probe
+                return
+            wait = self._opened_at + self.reset_timeout - now if self.state == self.OPEN else 0.1
+            await asyncio.sleep(max(wait, 0.01))
+
+    def record_success(self):
+        """The backend answered (even with a permanent error): close the circuit."""
+        self.failures = 0
+        self._down_since = None
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self._down_since is None:
+                self._down_since = self._opened_at
+            self._set_state(self.OPEN)
+
+
+async def call_with_retry(operation: Callable[[], Awaitable[T]], policy: RetryPolicy,
+                          breaker: Optional[CircuitBreaker] = None,
+                          on_retry: Optional[Callable[[int, str, float, BaseException], None]] = None) -> T:
+    """
+    Awaits `operation()`, retrying rate-limit and transient failures with backoff until
+    `policy.max_attempts`; permanent failures are raised at once. `on_retry(attempt, kind,
+    delay, error)` is called before each wait.
+    """
+    attempt = 0
+    while True:
+        if breaker is not None:
+            await breaker.before_call()
+        try:
+            result = await operation()
+        except Exception as e:
+            kind = classify_error(e)
+            if breaker is not None:
+                if kind == TRANSIENT:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            attempt += 1
+            if kind == PERMANENT or attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt)
+            if on_retry is not None:
+                on_retry(attempt, kind, delay, e)
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
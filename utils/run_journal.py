@@ -0,0 +1,171 @@
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+DEFAULT_JOURNAL_DIR = os.path.join(".gemini_cache", "runs")
+# Journals not written for this long are deleted, unless RUN_JOURNAL_RETENTION_DAYS is set
+DEFAULT_RETENTION_DAYS = 7
+# Bytes read from the end of a journal to find its last records when listing runs
+TAIL_BYTES = 64 * 1024
+
+
+def new_run_id() -> str:
+    """Sortable, unique id of a batch run: start time plus a random suffix."""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+class RunJournal:
+    """
+    Append-only JSONL journals of batch runs, one file per run in `directory`.
+
+    The first record of a run holds its parameters (rows, settings, checklist fingerprint);
+    then one record per completed row is appended and synced to disk as soon as the row
+    finishes, so a crash or redeploy loses at most the rows in flight. A truncated last
+    line (crash mid-write) is ignored. Each result record carries the number of rows
+    completed so far, so runs are listed from their first and last records only.
+
+    A run that went to the end has nothing left to resume: `finish` deletes its journal.
+    Journals of abandoned runs are deleted once they are `retention_days` old.
+    """
+
+    def __init__(self, directory: str = DEFAULT_JOURNAL_DIR, retention_days: Optional[float] = None):
+        self.directory = directory
+        if retention_days is None:
+            retention_days = float(os.environ.get("RUN_JOURNAL_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+        self.retention_seconds = retention_days * 86400
+        # Rows journaled per run by this process: run_id -> row indices
+        self._completed: Dict[str, Set[int]] = {}
+        os.makedirs(directory, exist_ok=True)
+        self.purge()
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self.directory, f"{run_id}.jsonl")
+
+    def _append(self, run_id: str, record: dict):
+        with open(self._path(run_id), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def exists(self, run_id: str) -> bool:
+        return os.path.exists(self._path(run_id))
+
+    def start(self, run_id: str, row_indices: List[int], params: dict, fingerprint: str):
+        """Opens the journal of a new run, or marks an existing one as resumed."""
+        if self.exists(run_id):
+            self._completed[run_id] = set(self.load(run_id)[1])
+            self._append(run_id, {"type": "resume", "time": time.time()})
+        else:
+            self._completed[run_id] = set()
+            self._append(run_id, {"type": "start", "run_id": run_id, "time": time.time(),
+                                  "row_indices": list(row_indices), "params": params, "fingerprint": fingerprint})
+
+    def record(self, run_id: str, row_index: int, data: dict, derived_from: int = None):
+        """Appends the result of a completed row."""
+        if run_id not in self._completed:
+            self._completed[run_id] = set(self.load(run_id)[1]) if self.exists(run_id) else set()
+        completed = self._completed[run_id]
+        completed.add(row_index)
+        self._append(run_id, {"type": "result", "index": row_index, "data": data, "derived_from": derived_from,
+                              "completed": len(completed)})
+
+    def finish(self, run_id: str):
+        """Closes a run that went to the end and deletes its journal (marked finished if it cannot be deleted)."""
+        self._append(run_id, {"type": "finish", "time": time.time()})
+        self._completed.pop(run_id, None)
+        try:
+            os.remove(self._path(run_id))
+        except OSError:
+            pass
+
+    def load(self, run_id: str) -> Tuple[dict, Dict[int, dict], bool]:
+        """Returns the run's start record, its completed rows {index: record} and whether it finished."""
+        header, results, finished = None, {}, False
+        with open(self._path(run_id), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partial write of a crashed process
+                if record.get("type") == "start":
+                    header = record
+                elif record.get("type") == "result":
+                    results[int(record["index"])] = record
+                elif record.get("type") == "finish":
+                    finished = True
+                elif record.get("type") == "resume":
+                    finished = False
+        if header is None:
+            raise ValueError(f"Run journal without a start record: {run_id}")
+        return header, results, finished
+
+    def _summary(self, run_id: str) -> Tuple[dict, int, bool]:
+        """
+        The run's start record, completed row count and finished flag, read from the first
+        line and the last `TAIL_BYTES` of the journal (whole file for journals without counts).
+        """
+        path = self._path(run_id)
+        with open(path, "rb") as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - TAIL_BYTES))
+            tail = f.read().decode("utf-8", errors="ignore").splitlines()
+        if not isinstance(header, dict) or header.get("type") != "start":
+            raise ValueError(f"Run journal without a start record: {run_id}")
+        finished = None
+        for line in reversed(tail):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Partial write, or a line cut by the tail
+            if finished is None and record.get("type") in ("finish", "resume", "result"):
+                finished = record["type"] == "finish"
+            if record.get("type") == "result" and "completed" in record:
+                return header, int(record["completed"]), finished
+            if record.get("type") == "start":
+                return header, 0, bool(finished)
+        _, results, finished = self.load(run_id)
+        return header, len(set(results) & set(header["row_indices"])), finished
+
+    def purge(self) -> int:
+        """Deletes the journals not written for `retention_days`. Returns the number deleted."""
+        cutoff = time.time() - self.retention_seconds
+        deleted = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".jsonl") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except OSError:
+                continue  # Deleted by another process
+        return deleted
+
+    def list_runs(self, fingerprint: Optional[str] = None, include_finished: bool = False) -> List[dict]:
+        """
+        Summaries of the journaled runs, most recent first: run_id, start time, rows, completed
+        rows and finished flag. With `fingerprint`, only runs of that checklist and documents.
+        Finished runs are left out unless `include_finished`; expired journals are deleted first.
+        """
+        self.purge()
+        runs = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".jsonl"):
+                continue
+            run_id = name[:-len(".jsonl")]
+            try:
+                header, completed, finished = self._summary(run_id)
+            except (OSError, ValueError):
+                continue
+            if fingerprint is not None and header.get("fingerprint") != fingerprint:
+                continue
+            if finished and not include_finished:
+                continue
+            runs.append({"run_id": run_id, "started_at": header.get("time"), "rows": len(header["row_indices"]),
+                         "completed": min(completed, len(header["row_indices"])), "finished": finished})
+        return sorted(runs, key=lambda run: run["started_at"] or 0, reverse=True)
@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from google.adk.sessions import BaseSessionService
+from google.adk.sessions.base_session_service import GetSessionConfig
+
+# Budgets unless SESSION_MEMORY_BUDGET_MB, SESSION_MAX_COUNT and SESSION_COMPACT_KB are set
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_SESSIONS = 2000
+# A session whose history grows past this is compacted to its last `keep_events` events
+DEFAULT_COMPACT_BYTES = 256 * 1024
+DEFAULT_KEEP_EVENTS = 10
+# Sessions created at the same time by `aprepare`
+DEFAULT_PREPARE_CONCURRENCY = 32
+# Fixed cost of an event (ids, timestamps, actions) on top of its text
+EVENT_OVERHEAD_BYTES = 512
+
+
+def content_size(content) -> int:
+    """Approximate memory held by an event or message: its text parts plus a fixed overhead."""
+    content = getattr(content, "content", content)  # Events wrap their content
+    parts = getattr(content, "parts", None) or []
+    return EVENT_OVERHEAD_BYTES + sum(len(part.text) for part in parts if getattr(part, "text", None))
+
+
+class SessionUsage:
+    """Bytes added to a session during one run (the new message and the events received)."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def add(self, content):
+        self.bytes += content_size(content)
+
+
+class SessionManager:
+    """
+    Keeps the ADK sessions of a service within a memory budget.
+
+    Every run goes through `use`, which creates the session if needed and tracks its
+    approximate size in an LRU registry:
+    - with `reset`, a session that already holds a previous run is recreated empty (row
+      analyses are self-contained: their old history would only be re-sent and grow);
+    - sessions larger than `compact_bytes` (chats) are compacted to their last
+      `keep_events` events before the run;
+    - after the run, the least recently used idle sessions are deleted until the total
+      is under `max_bytes` and `max_sessions`. Sessions running are never evicted.
+
+    Sessions known to the registry and still empty are used as they are: `aprepare`
+    creates the sessions of a whole batch upfront, so its runs make no session lookup.
+    """
+
+    def __init__(self, session_service: BaseSessionService, app_name: str = "agents",
+                 max_bytes: Optional[int] = None, max_sessions: Optional[int] = None,
+                 compact_bytes: Optional[int] = None, keep_events: int = DEFAULT_KEEP_EVENTS):
+        self.session_service = session_service
+        self.app_name = app_name
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            float(os.environ.get("SESSION_MEMORY_BUDGET_MB", DEFAULT_MAX_BYTES / 1024 ** 2)) * 1024 * 1024)
+        self.max_sessions = max_sessions if max_sessions is not None else int(
+            os.environ.get("SESSION_MAX_COUNT", DEFAULT_MAX_SESSIONS))
+        self.compact_bytes = compact_bytes if compact_bytes is not None else int(
+            float(os.environ.get("SESSION_COMPACT_KB", DEFAULT_COMPACT_BYTES / 1024)) * 1024)
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        # (user_id, session_id) -> {"bytes": approximate size, "active": runs in progress}, LRU first
+        self._entries: "OrderedDict[Tuple[str, str], dict]" = OrderedDict()
+        self.evicted = 0
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._entries.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._entries
+
+    def size_of(self, user_id: str, session_id: str) -> Optional[int]:
+        entry = self._entries.get((user_id, session_id))
+        return entry["bytes"] if entry else None
+
+    async def _create(self, user_id: str, session_id: str, state: dict):
+        return await self.session_service.create_session(
+            app_name=self.app_name, user_id=user_id, session_id=session_id, state=state)
+
+    async def _delete(self, user_id: str, session_id: str):
+        try:
+            await self.session_service.delete_session(app_name=self.app_name, user_id=user_id, session_id=session_id)
+        except Exception:
+            pass  # Already gone
+
+    async def _compact(self, user_id: str, session_id: str, state: dict) -> int:
+        """Recreates the session with its state and last `keep_events` events. Returns its new size."""
+        session = await self.session_service.get_session(
+            app_name=self.app_name, user_id=user_id, session_id=session_id,
+            config=GetSessionConfig(num_recent_events=self.keep_events))
+        if session is None:
+            await self._create(user_id, session_id, state)
+            return 0
+        recent = list(session.events)
+        await self._delete(user_id, session_id)
+        compacted = await self._create(user_id, session_id, {**state, **session.state})
+        for event in recent:
+            await self.session_service.append_event(compacted, event)
+        return sum(content_size(event) for event in recent)
+
+    async def aopen(self, user_id: str, session_id: str, state: Optional[dict] = None, reset: bool = False):
+        """Makes sure the session exists (empty with `reset`, compacted if too large) and marks it active."""
+        key = (user_id, session_id)
+        state = state or {}
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None:
+            session = None
+            try:
+                session = await self.session_service.get_session(
+                    app_name=self.app_name, user_id=user_id, session_id=session_id)
+            except Exception:
+                pass
+            size = sum(content_size(event) for event in session.events) if session is not None else 0
+            if session is None:
+                await self._create(user_id, session_id, state)
+            elif reset and size:
+                await self._delete(user_id, session_id)
+                await self._create(user_id, session_id, state)
+                size = 0
+        elif reset and entry["bytes"] and not entry["active"]:
+            await self._delete(user_id, session_id)
+            await self._create(user_id, session_id, state)
+            size = 0
+        elif entry["bytes"] > self.compact_bytes and not entry["active"]:
+            size = await self._compact(user_id, session_id, state)
+        else:
+            size = entry["bytes"]
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {"bytes": 0, "active": 0})
+            entry["bytes"] = size
+            entry["active"] += 1
+            self._entries.move_to_end(key)
+
+    async def aprepare(self, user_id: str, session_ids: Iterable[str], state: Optional[dict] = None,
+                       reset: bool = False, concurrency: int = DEFAULT_PREPARE_CONCURRENCY) -> int:
+        """
+        Creates many sessions at once (emptied first with `reset`): one listing of the
+        user's sessions, then concurrent creations. Sessions that exist with an unknown
+        history and no `reset` are left to `aopen`. Returns the number of sessions prepared.
+        """
+        state = state or {}
+        session_ids = list(dict.fromkeys(session_ids))
+        with self._lock:
+            unknown = [sid for sid in session_ids if (user_id, sid) not in self._entries]
+            stale = [sid for sid in session_ids
+                     if reset and self._entries.get((user_id, sid), {}).get("bytes") and not self._entries[(user_id, sid)]["active"]]
+        if not unknown and not stale:
+            return 0
+
+        existing = set()
+        if unknown:
+            try:
+                listed = await self.session_service.list_sessions(app_name=self.app_name, user_id=user_id)
+                existing = {session.id for session in listed.sessions}
+            except Exception:
+                return 0  # Cannot tell which sessions exist: let `aopen` check them one by one
+        to_create = [sid for sid in unknown if sid not in existing]
+        to_recreate = stale + ([sid for sid in unknown if sid in existing] if reset else [])
+        gate = asyncio.Semaphore(concurrency)
+
+        async def _prepare(session_id: str, recreate: bool):
+            async with gate:
+                if recreate:
+                    await self._delete(user_id, session_id)
+                await self._create(user_id, session_id, state)
+            with self._lock:
+                entry = self._entries.setdefault((user_id, session_id), {"bytes": 0, "active": 0})
+                entry["bytes"] = 0
+                self._entries.move_to_end((user_id, session_id))
+
+        await asyncio.gather(*([_prepare(sid, False) for sid in to_create] + [_prepare(sid, True) for sid in to_recreate]))
+        return len(to_create) + len(to_recreate)
+
+    async def aclose(self, user_id: str, session_id: str, added_bytes: int = 0):
+        """Marks the run finished, records the bytes it added and evicts idle sessions over budget."""
+        key = (user_id, session_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["bytes"] += added_bytes
+                entry["active"] = max(0, entry["active"] - 1)
+        await self.aevict()
+
+    async def aevict(self) -> int:
+        """Deletes least recently used idle sessions while over budget. Returns how many were deleted."""
+        victims = []
+        with self._lock:
+            total = sum(entry["bytes"] for entry in self._entries.values())
+            count = len(self._entries)
+            for key, entry in list(self._entries.items()):
+                if total <= self.max_bytes and count <= self.max_sessions:
+                    break
+                if entry["active"]:
+                    continue
+                del self._entries[key]
+                total -= entry["bytes"]
+                count -= 1
+                victims.append(key)
+            self.evicted += len(victims)
+        for user_id, session_id in victims:
+            await self._delete(user_id, session_id)
+        return len(victims)
+
+    async def adiscard(self, user_id: str, session_id: str):
+        """Deletes a session and forgets it."""
+        with self._lock:
+            self._entries.pop((user_id, session_id), None)
+        await self._delete(user_id, session_id)
+
+    @contextlib.asynccontextmanager
+    async def use(self, user_id: str, session_id: str, state: Optional[dict] = None, reset: bool = False):
+        """
+        Wraps one run: `async with manager.use(...) as usage:` then `usage.add(...)` the
+        message and each event, so the session's size stays known.
+        """
+        await self.aopen(user_id, session_id, state, reset)
+        usage = SessionUsage()
+        try:
+            yield usage
+        finally:
+            await self.aclose(user_id, session_id, usage.bytes)
@@ -0,0 +1,289 @@
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiosqlite
+from google.adk.errors.already_exists_error import AlreadyExistsError
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, InMemorySessionService, Session
+from google.adk.sessions import _session_util
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
+from google.adk.sessions.state import State
+
+DEFAULT_DB_PATH = os.path.join(".gemini_cache", "sessions.sqlite")
+# Appended events are written together once this many are pending, or after FLUSH_DELAY_SECONDS
+APPEND_BATCH_SIZE = 64
+FLUSH_DELAY_SECONDS = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    update_time REAL NOT NULL,
+    PRIMARY KEY (app_name, user_id, id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_session ON events (app_name, user_id, session_id, timestamp);
+CREATE TABLE IF NOT EXISTS app_states (
+    app_name TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_states (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id)
+);
+"""
+# State deltas are merged into the stored JSON (keys set to None are removed)
+UPSERT_APP_STATE = ("INSERT INTO app_states (app_name, state) VALUES (?, ?) "
+                    "ON CONFLICT (app_name) DO UPDATE SET state = json_patch(state, excluded.state)")
+UPSERT_USER_STATE = ("INSERT INTO user_states (app_name, user_id, state) VALUES (?, ?, ?) "
+                     "ON CONFLICT (app_name, user_id) DO UPDATE SET state = json_patch(state, excluded.state)")
+
+
+class SQLiteSessionService(BaseSessionService):
+    """
+    ADK session service persisted in a SQLite database (WAL mode), so sessions survive
+    restarts and live on disk instead of the process heap.
+
+    Reads and writes go through aiosqlite. `append_event` updates the caller's session
+    object at once but queues the database write: queued events are written in a single
+    transaction when APPEND_BATCH_SIZE are pending, after FLUSH_DELAY_SECONDS, before any
+    read of the database and at exit. App- and user-scoped state ("app:", "user:" keys)
+    is stored once and merged into the sessions, like InMemorySessionService.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with contextlib.closing(sqlite3.connect(db_path, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            conn.commit()
+        # (app_name, user_id, session_id, timestamp, event JSON, state delta) of events not written yet
+        self._pending: List[tuple] = []
+        self._pending_lock = threading.Lock()
+        self._flush_loop = None  # Loop on which a delayed flush is scheduled
+        atexit.register(self.flush_sync)
+
+    @contextlib.asynccontextmanager
+    async def _connect(self):
+        async with aiosqlite.connect(self.db_path, timeout=30) as db:
+            await db.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, much faster commits
+            yield db
+
+    # --- Event batching ---
+
+    def _take_pending(self) -> List[tuple]:
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            self._flush_loop = None
+        return pending
+
+    @staticmethod
+    def _statements(pending: List[tuple]) -> List[Tuple[str, list]]:
+        """
+        SQL writing queued events: one insert for all event rows, then one merge per
+        touched app, user and session state. States are merged with SQLite's json_patch.
+        """
+        events, app_deltas, user_deltas, session_deltas, touched = [], {}, {}, {}, {}
+        for app_name, user_id, session_id, timestamp, data, state_delta in pending:
+            events.append((app_name, user_id, session_id, timestamp, data))
+            touched[(app_name, user_id, session_id)] = timestamp
+            if state_delta:
+                deltas = _session_util.extract_state_delta(state_delta)
+                app_deltas.setdefault(app_name, {}).update(deltas["app"])
+                user_deltas.setdefault((app_name, user_id), {}).update(deltas["user"])
+                session_deltas.setdefault((app_name, user_id, session_id), {}).update(deltas["session"])
+
+        statements = [("INSERT INTO events (app_name, user_id, session_id, timestamp, data) VALUES (?, ?, ?, ?, ?)", events)]
+        statements += [(UPSERT_APP_STATE, [(app_name, json.dumps(delta))])
+                       for app_name, delta in app_deltas.items() if delta]
+        statements += [(UPSERT_USER_STATE, [(app_name, user_id, json.dumps(delta))])
+                       for (app_name, user_id), delta in user_deltas.items() if delta]
+        statements.append((
+            "UPDATE sessions SET state = json_patch(state, ?), update_time = ? WHERE app_name = ? AND user_id = ? AND id = ?",
+            [(json.dumps(session_deltas.get(key, {})), update_time, *key) for key, update_time in touched.items()]))
+        return statements
+
+    async def flush(self):
+        """Writes the queued events in one transaction."""
+        pending = self._take_pending()
+        if not pending:
+            return
+        try:
+            async with self._connect() as db:
+                for sql, rows in self._statements(pending):
+                    await db.executemany(sql, rows)
+                await db.commit()
+        except BaseException:
+            # Not written (e.g. its loop shut down): keep the events for the next flush
+            with self._pending_lock:
+                self._pending[:0] = pending
+            raise
+
+    def flush_sync(self):
+        """Writes the queued events without an event loop (e.g. at exit)."""
+        pending = self._take_pending()
+        if not pending:
+            return
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=30)) as conn:
+            for sql, rows in self._statements(pending):
+                conn.executemany(sql, rows)
+            conn.commit()
+
+    def purge(self, max_age_seconds: float) -> int:
+        """
+        Deletes the sessions not updated for `max_age_seconds`, with their events, and the
+        user state left without sessions (e.g. of service instances that are gone). Run
+        without an event loop, e.g. at startup. Returns how many sessions were deleted.
+        """
+        self.flush_sync()
+        cutoff = time.time() - max_age_seconds
+        with contextlib.closing(sqlite3.connect(self.db_path, timeout=30)) as conn:
+            purged = conn.execute("DELETE FROM sessions WHERE update_time < ?", (cutoff,)).rowcount
+            if purged:
+                conn.execute("DELETE FROM events WHERE NOT EXISTS (SELECT 1 FROM sessions s WHERE s.app_name = events.app_name "
+                             "AND s.user_id = events.user_id AND s.id = events.session_id)")
+                conn.execute("DELETE FROM user_states WHERE NOT EXISTS (SELECT 1 FROM sessions s "
+                             "WHERE s.app_name = user_states.app_name AND s.user_id = user_states.user_id)")
+            conn.commit()
+        return purged
+
+    def _schedule_flush(self):
+        loop = asyncio.get_running_loop()
+        with self._pending_lock:
+            # A flush scheduled on another (possibly finished) loop may never run
+            if self._flush_loop is loop:
+                return
+            self._flush_loop = loop
+        loop.call_later(FLUSH_DELAY_SECONDS, lambda: asyncio.ensure_future(self.flush()))
+
+    # --- BaseSessionService ---
+
+    async def _merged_state(self, db, app_name: str, user_id: str, session_state: Dict[str, Any]) -> Dict[str, Any]:
+        """Session state with the app ("app:") and user ("user:") state merged in."""
+        state = dict(session_state)
+        async with db.execute("SELECT state FROM app_states WHERE app_name = ?", (app_name,)) as cursor:
+            row = await cursor.fetchone()
+        for key, value in (json.loads(row[0]) if row else {}).items():
+            state[State.APP_PREFIX + key] = value
+        async with db.execute("SELECT state FROM user_states WHERE app_name = ? AND user_id = ?",
+                              (app_name, user_id)) as cursor:
+            row = await cursor.fetchone()
+        for key, value in (json.loads(row[0]) if row else {}).items():
+            state[State.USER_PREFIX + key] = value
+        return state
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[Dict[str, Any]] = None,
+                             session_id: Optional[str] = None) -> Session:
+        await self.flush()
+        session_id = session_id.strip() if session_id and session_id.strip() else str(uuid.uuid4())
+        deltas = _session_util.extract_state_delta(state)
+        now = time.time()
+        async with self._connect() as db:
+            try:
+                await db.execute("INSERT INTO sessions (app_name, user_id, id, state, update_time) VALUES (?, ?, ?, ?, ?)",
+                                 (app_name, user_id, session_id, json.dumps(deltas["session"]), now))
+            except sqlite3.IntegrityError:
+                raise AlreadyExistsError(f"Session with id {session_id} already exists.")
+            if deltas["app"]:
+                await db.execute(UPSERT_APP_STATE, (app_name, json.dumps(deltas["app"])))
+            if deltas["user"]:
+                await db.execute(UPSERT_USER_STATE, (app_name, user_id, json.dumps(deltas["user"])))
+            await db.commit()
+            merged = await self._merged_state(db, app_name, user_id, deltas["session"])
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=merged, last_update_time=now)
+
+    async def get_session(self, *, app_name: str, user_id: str, session_id: str,
+                          config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        await self.flush()
+        async with self._connect() as db:
+            async with db.execute("SELECT state, update_time FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?",
+                                  (app_name, user_id, session_id)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            query = "SELECT data FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?"
+            params: list = [app_name, user_id, session_id]
+            if config and config.after_timestamp:
+                query += " AND timestamp >= ?"
+                params.append(config.after_timestamp)
+            query += " ORDER BY timestamp DESC, seq DESC"
+            if config and config.num_recent_events:
+                query += " LIMIT ?"
+                params.append(config.num_recent_events)
+            async with db.execute(query, params) as cursor:
+                events = [Event.model_validate_json(data) for (data,) in await cursor.fetchall()]
+            merged = await self._merged_state(db, app_name, user_id, json.loads(row[0]))
+        events.reverse()
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=merged,
+                       events=events, last_update_time=row[1])
+
+    async def list_sessions(self, *, app_name: str, user_id: Optional[str] = None) -> ListSessionsResponse:
+        await self.flush()
+        query = "SELECT user_id, id, state, update_time FROM sessions WHERE app_name = ?"
+        params: list = [app_name]
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        sessions = []
+        async with self._connect() as db:
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+            for row_user_id, session_id, state, update_time in rows:
+                merged = await self._merged_state(db, app_name, row_user_id, json.loads(state))
+                sessions.append(Session(app_name=app_name, user_id=row_user_id, id=session_id,
+                                        state=merged, last_update_time=update_time))
+        return ListSessionsResponse(sessions=sessions)
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        await self.flush()
+        async with self._connect() as db:
+            await db.execute("DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?",
+                             (app_name, user_id, session_id))
+            await db.execute("DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?",
+                             (app_name, user_id, session_id))
+            await db.commit()
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
+        event = await super().append_event(session=session, event=event)
+        session.last_update_time = event.timestamp
+        with self._pending_lock:
+            self._pending.append((session.app_name, session.user_id, session.id, event.timestamp,
+                                  event.model_dump_json(exclude_none=True),
+                                  dict(event.actions.state_delta) if event.actions else None))
+            full = len(self._pending) >= APPEND_BATCH_SIZE
+        if full:
+            await self.flush()
+        else:
+            self._schedule_flush()
+        return event
+
+
+def create_session_service(backend: str = "memory", db_path: str = DEFAULT_DB_PATH) -> BaseSessionService:
+    """Session service of the `SESSION_BACKEND` setting: "memory" (default) or "sqlite"."""
+    if backend == "memory":
+        return InMemorySessionService()
+    if backend == "sqlite":
+        return SQLiteSessionService(db_path)
+    raise ValueError(f"Unsupported session backend: {backend}")
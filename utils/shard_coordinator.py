@@ -0,0 +1,170 @@
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+DEFAULT_COORDINATOR_PATH = os.path.join(".gemini_cache", "shards.sqlite")
+# A shard whose lease is not renewed for this long is handed to another worker
+DEFAULT_LEASE_SECONDS = 300
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+
+class ShardCoordinator(ABC):
+    """
+    Hands out the shards (lists of row indices) of sharded batch runs to workers on any
+    number of nodes and merges their results.
+
+    A worker `lease`s a shard for `lease_seconds`, keeps `renew`ing the lease while it
+    works and `complete`s the shard with its results. A shard whose lease expires (its
+    worker died or hung) is leased again by another worker; results of a worker that
+    lost its lease are rejected, so each shard's results come from exactly one worker.
+    """
+
+    @abstractmethod
+    def create_run(self, row_shards: List[List[int]], params: dict, payload: dict) -> str:
+        """Registers a run of shards with its batch parameters and service state. Returns its id."""
+
+    @abstractmethod
+    def run_info(self, run_id: str) -> Optional[dict]:
+        """Params and payload of a run."""
+
+    @abstractmethod
+    def lease(self, worker: str, run_id: str = None) -> Optional[dict]:
+        """Takes a pending or expired shard (of `run_id`, or of the oldest unfinished run)."""
+
+    @abstractmethod
+    def renew(self, run_id: str, shard: int, worker: str) -> bool:
+        """Extends a lease. False if the worker no longer holds the shard."""
+
+    @abstractmethod
+    def complete(self, run_id: str, shard: int, worker: str, results: Dict[int, dict]) -> bool:
+        """Stores a shard's results {row index: result} and marks it done. False if the lease was lost."""
+
+    @abstractmethod
+    def progress(self, run_id: str) -> dict:
+        """Shard counts of a run by status, plus the number of rows with a result."""
+
+    @abstractmethod
+    def results(self, run_id: str) -> Dict[int, dict]:
+        """Merged results of a run's completed shards."""
+
+
+class SQLiteShardCoordinator(ShardCoordinator):
+    """
+    Coordinator backed by one SQLite database: a local stand-in for tests and single-host
+    runs, or several nodes sharing a volume with reliable file locking. It keeps SQLite's
+    rollback journal, because WAL mode does not work across machines.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS shard_runs (
+        id TEXT PRIMARY KEY,
+        params TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS shards (
+        run_id TEXT NOT NULL,
+        shard INTEGER NOT NULL,
+        row_indices TEXT NOT NULL,
+        status TEXT NOT NULL,
+        worker TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (run_id, shard)
+    );
+    CREATE INDEX IF NOT EXISTS idx_shards_status ON shards (status, lease_expires);
+    CREATE TABLE IF NOT EXISTS shard_results (
+        run_id TEXT NOT NULL,
+        row_index INTEGER NOT NULL,
+        result TEXT NOT NULL,
+        PRIMARY KEY (run_id, row_index)
+    );
+    """
+
+    def __init__(self, path: str = DEFAULT_COORDINATOR_PATH, lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return contextlib.closing(conn)
+
+    def create_run(self, row_shards: List[List[int]], params: dict, payload: dict) -> str:
+        run_id = f"shards-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO shard_runs (id, params, payload, created_at) VALUES (?, ?, ?, ?)",
+                         (run_id, json.dumps(params), json.dumps(payload, default=str), time.time()))
+            conn.executemany("INSERT INTO shards (run_id, shard, row_indices, status) VALUES (?, ?, ?, ?)",
+                             [(run_id, i, json.dumps(rows), PENDING) for i, rows in enumerate(row_shards)])
+            conn.execute("COMMIT")
+        return run_id
+
+    def run_info(self, run_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT params, payload FROM shard_runs WHERE id = ?", (run_id,)).fetchone()
+        return {"params": json.loads(row["params"]), "payload": json.loads(row["payload"])} if row else None
+
+    def lease(self, worker: str, run_id: str = None) -> Optional[dict]:
+        now = time.time()
+        query = ("SELECT s.run_id, s.shard, s.row_indices, s.attempts FROM shards s JOIN shard_runs r ON r.id = s.run_id "
+                 "WHERE (s.status = ? OR (s.status = ? AND s.lease_expires < ?))")
+        params = [PENDING, LEASED, now]
+        if run_id is not None:
+            query += " AND s.run_id = ?"
+            params.append(run_id)
+        query += " ORDER BY r.created_at, s.shard LIMIT 1"
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # One leaser at a time
+            row = conn.execute(query, params).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE shards SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                         "WHERE run_id = ? AND shard = ?", (LEASED, worker, now + self.lease_seconds, row["run_id"], row["shard"]))
+            conn.execute("COMMIT")
+        return {"run_id": row["run_id"], "shard": row["shard"], "row_indices": json.loads(row["row_indices"]),
+                "attempt": row["attempts"] + 1}
+
+    def renew(self, run_id: str, shard: int, worker: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE shards SET lease_expires = ? WHERE run_id = ? AND shard = ? AND worker = ? AND status = ?",
+                                  (time.time() + self.lease_seconds, run_id, shard, worker, LEASED))
+            return cursor.rowcount > 0
+
+    def complete(self, run_id: str, shard: int, worker: str, results: Dict[int, dict]) -> bool:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute("UPDATE shards SET status = ?, lease_expires = NULL WHERE run_id = ? AND shard = ? AND worker = ? AND status = ?",
+                                  (DONE, run_id, shard, worker, LEASED))
+            if cursor.rowcount == 0:
+                conn.execute("ROLLBACK")  # Lease expired and taken over: the new holder reports
+                return False
+            conn.executemany("INSERT OR REPLACE INTO shard_results (run_id, row_index, result) VALUES (?, ?, ?)",
+                             [(run_id, int(idx), json.dumps(result, default=str)) for idx, result in results.items()])
+            conn.execute("COMMIT")
+        return True
+
+    def progress(self, run_id: str) -> dict:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM shards WHERE run_id = ? GROUP BY status", (run_id,)).fetchall())
+            rows = conn.execute("SELECT COUNT(*) FROM shard_results WHERE run_id = ?", (run_id,)).fetchone()[0]
+        return {"shards": sum(counts.values()), PENDING: counts.get(PENDING, 0), LEASED: counts.get(LEASED, 0),
+                DONE: counts.get(DONE, 0), "rows": rows}
+
+    def results(self, run_id: str) -> Dict[int, dict]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT row_index, result FROM shard_results WHERE run_id = ?", (run_id,)).fetchall()
+        return {row["row_index"]: json.loads(row["result"]) for row in rows}
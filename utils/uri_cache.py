@@ -0,0 +1,272 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are serialized
+    fcntl = None
+
+# Files uploaded through the Gemini File API are deleted server-side after 48 hours.
+# Entries are considered stale a little earlier so we never hand out a URI that is
+# about to disappear in the middle of a batch.
+REMOTE_FILE_TTL_SECONDS = 48 * 3600
+EXPIRY_MARGIN_SECONDS = 2 * 3600
+
+DEFAULT_CACHE_DIR = ".gemini_cache"
+# Size budget of the cached uploads, unless GEMINI_CACHE_MAX_BYTES is set
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+# Access times refreshed by cache hits are written at most this often
+ACCESS_WRITE_INTERVAL_SECONDS = 60
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Exclusive lock on `path` + ".lock", held across processes (advisory, POSIX) while in the block."""
+    with open(f"{path}.lock", "a+") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read_json(path: str) -> dict:
+    """Loads a JSON object from disk, ignoring a missing or corrupted file."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path: str, data: dict):
+    """Writes a JSON object atomically so a crash never leaves a truncated file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class PersistentURICache:
+    """
+    On-disk cache mapping content hashes to uploaded Gemini file names.
+
+    Survives process restarts (stored as JSON under the cache directory) and evicts
+    entries that are past the remote file TTL or that exceed the configured size budget
+    (least recently used first). Supports the subset of the dict protocol the loaders
+    use (`in`, `[]`, `get`), so it can replace the former in-memory `uri_cache` dict.
+
+    Several processes can share the directory: every write re-reads the index under a
+    file lock and merges this instance's changes into it, and reads pick up the index
+    again when another process changed it. Within a process, use `get_uri_cache` so all
+    services share one instance.
+    """
+
+    INDEX_FILENAME = "uri_cache.json"
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR,
+                 ttl_seconds: int = REMOTE_FILE_TTL_SECONDS - EXPIRY_MARGIN_SECONDS,
+                 max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get("GEMINI_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.index_path = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self._lock = threading.RLock()
+        # Changes not written yet: hashes put here, access times of cache hits, removed uploads (hash -> name)
+        self._put = set()
+        self._used: Dict[str, float] = {}
+        self._removed: Dict[str, str] = {}
+        self._index_mtime = None
+        self._last_write = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries: Dict[str, dict] = self._read_index()
+        if self.evict():
+            self._write_index()
+
+    # --- Persistence ---
+
+    def _index_stamp(self):
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_index(self) -> Dict[str, dict]:
+        """Loads the index from disk, ignoring a missing or corrupted file."""
+        self._index_mtime = self._index_stamp()
+        return read_json(self.index_path)
+
+    def _merge(self, on_disk: Dict[str, dict]) -> Dict[str, dict]:
+        """
+        The index on disk with this instance's pending changes applied: removals of the
+        same upload, puts (the most recent upload of a hash wins), then access times of
+        entries still present.
+        """
+        merged = {file_hash: dict(entry) for file_hash, entry in on_disk.items()}
+        for file_hash, name in self._removed.items():
+            if merged.get(file_hash, {}).get("name") == name:
+                del merged[file_hash]
+        for file_hash in self._put:
+            local, disk = self._entries.get(file_hash), merged.get(file_hash)
+            if local is not None and (disk is None or local.get("uploaded_at", 0) >= disk.get("uploaded_at", 0)):
+                merged[file_hash] = dict(local)
+        for file_hash, last_used in self._used.items():
+            if file_hash in merged:
+                merged[file_hash]["last_used"] = max(last_used, merged[file_hash].get("last_used", 0))
+        return merged
+
+    def _refresh(self):
+        """Picks up the index again if another process wrote it since it was last read."""
+        if self._index_stamp() != self._index_mtime:
+            self._entries = self._merge(self._read_index())
+
+    def _write_index(self):
+        """Merges this instance's changes into the index on disk, under the file lock."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with file_lock(self.index_path):
+            self._entries = self._merge(read_json(self.index_path))
+            self._put.clear()
+            self._used.clear()
+            self._removed.clear()
+            self.evict()
+            write_json(self.index_path, self._entries)
+            self._index_mtime = self._index_stamp()
+        self._last_write = time.time()
+
+    def flush(self):
+        """Writes access times not persisted yet."""
+        with self._lock:
+            if self._put or self._used or self._removed:
+                self._write_index()
+
+    # --- Eviction ---
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return now - entry.get("uploaded_at", 0) >= self.ttl_seconds
+
+    def evict(self) -> int:
+        """
+        Drops expired entries, then least recently used ones until the total size
+        fits the budget. Returns the number of evicted entries (index not persisted).
+        """
+        with self._lock:
+            now = time.time()
+            evicted = [h for h, e in self._entries.items() if self._is_expired(e, now)]
+            for file_hash in evicted:
+                del self._entries[file_hash]
+
+            total = sum(e.get("size", 0) for e in self._entries.values())
+            if total > self.max_bytes:
+                by_last_use = sorted(self._entries.items(), key=lambda item: item[1].get("last_used", 0))
+                for file_hash, entry in by_last_use:
+                    if total <= self.max_bytes:
+                        break
+                    total -= entry.get("size", 0)
+                    del self._entries[file_hash]
+                    evicted.append(file_hash)
+            return len(evicted)
+
+    # --- Public API ---
+
+    def get_entry(self, file_hash: str) -> Optional[dict]:
+        """Returns a copy of the entry (name, uploaded_at, size, last_used) if still valid."""
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(file_hash)
+            if entry is None:
+                return None
+            if self._is_expired(entry, time.time()):
+                self.remove(file_hash)
+                return None
+            return dict(entry)
+
+    def get(self, file_hash: str, default: Optional[str] = None) -> Optional[str]:
+        """Returns the remote file name for a hash, refreshing its LRU position (persisted in batches)."""
+        with self._lock:
+            entry = self.get_entry(file_hash)
+            if entry is None:
+                return default
+            self._entries[file_hash]["last_used"] = self._used[file_hash] = time.time()
+            if time.time() - self._last_write >= ACCESS_WRITE_INTERVAL_SECONDS:
+                self._write_index()
+            return entry["name"]
+
+    def put(self, file_hash: str, name: str, size: int = 0, uploaded_at: Optional[float] = None):
+        """Records an upload and persists the index, evicting entries over budget."""
+        with self._lock:
+            now = time.time()
+            self._entries[file_hash] = {
+                "name": name,
+                "uploaded_at": uploaded_at if uploaded_at is not None else now,
+                "size": size,
+                "last_used": now,
+            }
+            self._put.add(file_hash)
+            self._removed.pop(file_hash, None)
+            self._write_index()
+
+    def remove(self, file_hash: str):
+        with self._lock:
+            entry = self._entries.pop(file_hash, None)
+            if entry is not None:
+                self._put.discard(file_hash)
+                self._used.pop(file_hash, None)
+                self._removed[file_hash] = entry["name"]
+                self._write_index()
+
+    def clear(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock, file_lock(self.index_path):
+            self._entries = {}
+            self._put.clear()
+            self._used.clear()
+            self._removed.clear()
+            write_json(self.index_path, self._entries)
+            self._index_mtime = self._index_stamp()
+
+    def total_size(self) -> int:
+        with self._lock:
+            return sum(e.get("size", 0) for e in self._entries.values())
+
+    def __contains__(self, file_hash: str) -> bool:
+        return self.get_entry(file_hash) is not None
+
+    def __getitem__(self, file_hash: str) -> str:
+        name = self.get(file_hash)
+        if name is None:
+            raise KeyError(file_hash)
+        return name
+
+    def __setitem__(self, file_hash: str, name: str):
+        self.put(file_hash, name)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+
+_shared_caches: Dict[str, PersistentURICache] = {}
+_shared_lock = threading.Lock()
+
+
+def get_uri_cache(cache_dir: str = DEFAULT_CACHE_DIR) -> PersistentURICache:
+    """
+    Returns the process-wide cache of `cache_dir` (one per directory, shared by every
+    service and Streamlit session); pending access times are written at exit.
+    """
+    key = os.path.abspath(cache_dir)
+    with _shared_lock:
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = _shared_caches[key] = PersistentURICache(cache_dir)
+            atexit.register(cache.flush)
+        return cache